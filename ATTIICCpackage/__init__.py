@@ -1,14 +1,89 @@
 
+import importlib
+
 # Import functions from package modules
 from ATTIICCpackage.util import load_csv_files_from_subfolders,merge_and_clean_dataframes,create_directories
+from ATTIICCpackage.util import load_all_channels_from_subfolders, index_channel_csv_files, load_indexed_channels, join_channel_dataframes
 # from ATTIICCpackage.util import run_imagej_macro
 
-from ATTIICCpackage.object_matching import object_matching
+from ATTIICCpackage.object_matching import object_matching, link_cells, track_cells
 
-from ATTIICCpackage.cell_segmentation_cp import seg_subfolder, display_images_with_masks, seg_all_subfolders
-from ATTIICCpackage.cell_segmentation_cp import is_zip_file_empty, move_empty_zip_files_recursively
+from ATTIICCpackage.image_feature_analysis import classify_cell_types, correct_cell_types, process_classified_data, calculate_proximity, calculate_moving_speed_and_mean
+from ATTIICCpackage.image_feature_analysis import process_and_save_cell_count,fill_missing_frames,add_trends_to_dataframe,add_event_column
+from ATTIICCpackage.image_feature_analysis import detect_killing_events
 
-from ATTIICCpackage.image_preprocessing import read_image, write_image, gaussian_smoothing, background_subtraction, process_images_bg, process_images_bg_rolling_ball
+from ATTIICCpackage.timeseries_store import WellTimeSeriesStore
+from ATTIICCpackage.partitioned_analysis import run_partitioned_analysis, analyze_partition, process_partition, combine_partitions
+from ATTIICCpackage.checkpoint import Manifest, CheckpointedBatch, atomic_write, remove_partial_outputs
+from ATTIICCpackage import instrumentation
+from ATTIICCpackage.microwells import WellGrid, detect_wells, detect_field_wells, crop_field_wells, phase_correlation_shift
+from ATTIICCpackage.qc_montage import MontageWriter, compose_montage, write_montage, downsample
 
-from ATTIICCpackage.image_feature_analysis import classify_cell_types, correct_cell_types, process_classified_data, calculate_proximity, calculate_moving_speed_and_mean
-from ATTIICCpackage.image_feature_analysis import process_and_save_cell_count,fill_missing_frames,add_trends_to_dataframe,add_event_column
\ No newline at end of file
+# Segmentation (cellpose -> torch, matplotlib), preprocessing and measurement (cv2, scipy, skimage) are slow to import,
+# so their functions are imported on first access instead of when the package is imported
+_LAZY_ATTRIBUTES = {
+    'seg_subfolder': 'ATTIICCpackage.cell_segmentation_cp',
+    'display_images_with_masks': 'ATTIICCpackage.cell_segmentation_cp',
+    'seg_all_subfolders': 'ATTIICCpackage.cell_segmentation_cp',
+    'is_zip_file_empty': 'ATTIICCpackage.cell_segmentation_cp',
+    'move_empty_zip_files_recursively': 'ATTIICCpackage.cell_segmentation_cp',
+    'read_image': 'ATTIICCpackage.image_preprocessing',
+    'write_image': 'ATTIICCpackage.image_preprocessing',
+    'gaussian_smoothing': 'ATTIICCpackage.image_preprocessing',
+    'background_subtraction': 'ATTIICCpackage.image_preprocessing',
+    'process_images_bg': 'ATTIICCpackage.image_preprocessing',
+    'process_images_bg_rolling_ball': 'ATTIICCpackage.image_preprocessing',
+    'measure_cells': 'ATTIICCpackage.cell_measurement',
+    'measure_field': 'ATTIICCpackage.cell_measurement',
+}
+
+# The modules with a command line (python -m ATTIICCpackage.<module>) must not be imported by the package itself,
+# otherwise runpy warns and executes a second copy of the module as __main__
+_LAZY_ATTRIBUTES.update({
+    'Stage': 'ATTIICCpackage.pipeline',
+    'Pipeline': 'ATTIICCpackage.pipeline',
+    'build_default_pipeline': 'ATTIICCpackage.pipeline',
+    'run_pipeline': 'ATTIICCpackage.pipeline',
+    'LiveProcessor': 'ATTIICCpackage.live',
+    'replay_frames': 'ATTIICCpackage.live',
+    'cellpose_segmenter': 'ATTIICCpackage.live',
+    'assign_shards': 'ATTIICCpackage.sharding',
+    'run_shard': 'ATTIICCpackage.sharding',
+    'merge_shards': 'ATTIICCpackage.sharding',
+    'launch_local_shards': 'ATTIICCpackage.sharding',
+    'generate_plate': 'ATTIICCpackage.synthetic',
+    'microwell_grid': 'ATTIICCpackage.synthetic',
+    'simulate_cells': 'ATTIICCpackage.synthetic',
+    'render_frame': 'ATTIICCpackage.synthetic',
+})
+
+# Names exported by "from ATTIICCpackage import *"; the lazy names are listed too, so a star import still
+# provides them (and imports their modules)
+__all__ = [
+    'load_csv_files_from_subfolders', 'merge_and_clean_dataframes', 'create_directories',
+    'load_all_channels_from_subfolders', 'index_channel_csv_files', 'load_indexed_channels', 'join_channel_dataframes',
+    'object_matching', 'link_cells', 'track_cells',
+    'classify_cell_types', 'correct_cell_types', 'process_classified_data', 'calculate_proximity',
+    'calculate_moving_speed_and_mean', 'process_and_save_cell_count', 'fill_missing_frames', 'add_trends_to_dataframe',
+    'add_event_column', 'detect_killing_events',
+    'WellTimeSeriesStore',
+    'run_partitioned_analysis', 'analyze_partition', 'process_partition', 'combine_partitions',
+    'Manifest', 'CheckpointedBatch', 'atomic_write', 'remove_partial_outputs',
+    'instrumentation',
+    'WellGrid', 'detect_wells', 'detect_field_wells', 'crop_field_wells', 'phase_correlation_shift',
+    'MontageWriter', 'compose_montage', 'write_montage', 'downsample',
+] + list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name), name)
+    # Cache it, so later accesses do not go through __getattr__ again
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
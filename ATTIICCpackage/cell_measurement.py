@@ -0,0 +1,150 @@
+# cell_measurement.py
+
+import os
+import re
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from skimage.measure import regionprops_table
+
+
+def measure_cells(label_image, intensity_images, well_map=None, well_shift=(0, 0)):
+    """
+    Measures every labelled cell of a segmentation mask, like the ImageJ measure macro does
+    ("area shape mean centroid"), without going through ROI files.
+
+    Parameters:
+    label_image (np.ndarray): The segmentation mask, 0 for background and 1..n for the cells.
+    intensity_images (dict): {channel: image} of the (background-subtracted) channels to measure, e.g. {'d0': img}.
+    well_map (np.ndarray or None): An image of the same shape holding the well ID of every pixel (0 outside the
+                                   wells). The well of a cell is the well under its centroid. If None, every cell
+                                   gets well 0.
+    well_shift (tuple): The (dy, dx) drift of the image relative to well_map (see WellGrid.shift).
+
+    Returns:
+    pd.DataFrame: One row per cell with 'cell', 'well', 'X', 'Y', 'area', 'mean_intensity_<channel>', 'circ.',
+                  'ar', 'round' and 'solidity' columns. X, Y are in pixels of the full image.
+    """
+    label_image = np.asarray(label_image)
+    props = regionprops_table(label_image, properties=('label', 'area', 'centroid', 'perimeter',
+                                                       'major_axis_length', 'minor_axis_length', 'solidity'))
+    labels = props['label']
+    area = props['area'].astype(float)
+    perimeter = props['perimeter']
+    major = props['major_axis_length']
+    minor = props['minor_axis_length']
+
+    df = pd.DataFrame({'cell': np.arange(1, len(labels) + 1), 'X': props['centroid-1'], 'Y': props['centroid-0'],
+                       'area': area})
+
+    # One pass over each channel for the means of all labels
+    for channel, image in intensity_images.items():
+        df[f'mean_intensity_{channel}'] = ndimage.mean(np.asarray(image, dtype=float), label_image, labels) if len(labels) else []
+
+    # Shape descriptors with the ImageJ definitions, circularity capped at 1 as ImageJ does
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['circ.'] = np.minimum(np.where(perimeter > 0, 4 * np.pi * area / perimeter ** 2, 1.0), 1.0)
+        df['ar'] = np.where(minor > 0, major / minor, 1.0)
+        df['round'] = np.where(major > 0, 4 * area / (np.pi * major ** 2), 1.0)
+    df['solidity'] = props['solidity']
+
+    if well_map is None:
+        df['well'] = 0
+    else:
+        rows = np.clip(np.rint(df['Y'].to_numpy() - well_shift[0]).astype(int), 0, well_map.shape[0] - 1)
+        cols = np.clip(np.rint(df['X'].to_numpy() - well_shift[1]).astype(int), 0, well_map.shape[1] - 1)
+        df['well'] = np.asarray(well_map)[rows, cols].astype(int)
+
+    return df[['cell', 'well', 'X', 'Y', 'area'] + [f'mean_intensity_{c}' for c in intensity_images] +
+              ['circ.', 'ar', 'round', 'solidity']]
+
+
+def channel_image_name(name, channel):
+    """
+    Returns the name of the image of another channel of the same frame. As in the ImageJ macros, the channel
+    digit is the last character of the third '_' token ('p00_0_f00d3_...' -> 'p00_0_f00d0_...' for 'd0').
+
+    Parameters:
+    name (str): An image name without extension.
+    channel (str): The channel suffix (e.g. 'd0').
+
+    Returns:
+    str: The image name of that channel.
+    """
+    tokens = name.split('_')
+    if len(tokens) >= 3:
+        tokens[2] = tokens[2][:-1] + channel[-1]
+    return '_'.join(tokens)
+
+
+def measure_field(field, background_dir, segmentation_dir, channels=('d0', 'd1', 'd2'), well_map=None, grid=None,
+                  d3_dir=None):
+    """
+    Measures every segmented image of a field against the background-subtracted images of its channels,
+    producing the same per-cell table as the ImageJ measurement followed by merge_and_clean_dataframes.
+
+    Parameters:
+    field (str): The field (e.g. 'f00').
+    background_dir (str): The folder with the 'fNNd0', 'fNNd1', ... background-subtracted images ('*_bg.png').
+    segmentation_dir (str): The folder with the 'fNNd3_png' label images ('*_label.*') from seg_subfolder.
+    channels (tuple): The intensity channels.
+    well_map (np.ndarray or None): Well ID image of the field (see measure_cells). If None (and no grid), the well
+                                   is read from the fifth token of the image name, as for the cropped single-well
+                                   images.
+    grid (WellGrid or None): The well grid of the field, used instead of well_map. The drift of every frame is
+                             estimated on its d3 image in d3_dir.
+    d3_dir (str or None): The folder with the 'fNNd3_png' images, for the drift of each frame. If None, frames
+                          are assumed not to drift.
+
+    Returns:
+    pd.DataFrame: One row per cell with the columns of join_channel_dataframes, sorted by 'field', 'well',
+                  'frame' and 'cell'.
+    """
+    import cv2
+
+    seg_folder = os.path.join(segmentation_dir, f'{field}d3_png')
+    tables = []
+    for file_name in sorted(os.listdir(seg_folder)):
+        match = re.match(r'^(p\d+.*)_label\.\w+$', file_name)
+        if not match:
+            continue
+        name = match.group(1)
+
+        intensity_images = {}
+        for channel in channels:
+            image_path = os.path.join(background_dir, f'{field}{channel}', channel_image_name(name, channel) + '_bg.png')
+            intensity_images[channel] = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+        missing = [c for c, image in intensity_images.items() if image is None]
+        if missing:
+            print(f"Skipping {file_name}: no background-subtracted image for channels {missing}")
+            continue
+
+        masks = cv2.imread(os.path.join(seg_folder, file_name), cv2.IMREAD_UNCHANGED)
+        if grid is not None:
+            shift = (0, 0)
+            if d3_dir is not None:
+                d3_image = cv2.imread(os.path.join(d3_dir, f'{field}d3_png', name + '.png'), cv2.IMREAD_UNCHANGED)
+                if d3_image is not None:
+                    shift = grid.shift(d3_image)
+            cells = measure_cells(masks, intensity_images, grid.well_map, shift)
+        else:
+            cells = measure_cells(masks, intensity_images, well_map)
+
+        tokens = re.split(r'[_:]', name)
+        cells['field'] = field
+        cells['frame'] = int(tokens[0][1:])
+        if well_map is None and grid is None and len(tokens) > 4 and tokens[4].isdigit():
+            cells['well'] = int(tokens[4])
+        for channel in channels[:-1]:
+            cells[f'label_{channel}'] = channel_image_name(name, channel)
+        cells['label'] = channel_image_name(name, channels[-1])
+        cells['cell_ID'] = cells['cell'].astype(str)
+        tables.append(cells)
+
+    # Same layout as join_channel_dataframes, so the table can replace the merged ImageJ measurements
+    columns = ['field', 'well', 'frame', 'cell', 'X', 'Y'] + [f'mean_intensity_{c}' for c in channels] + \
+              ['area', 'circ.', 'ar', 'round', 'solidity'] + [f'label_{c}' for c in channels[:-1]] + ['label', 'cell_ID']
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(tables, ignore_index=True)[columns]
+    return df.sort_values(by=['field', 'well', 'frame', 'cell'], kind='stable').reset_index(drop=True)
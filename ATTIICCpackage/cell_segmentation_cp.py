@@ -1,17 +1,23 @@
 # below is for running pretrained model on the whole dataset, process one subfolder at a time
 import os
-import matplotlib.pyplot as plt
 from skimage import io
 from cellpose import models, io as cellpose_io
 import zipfile
 import shutil
+from ATTIICCpackage.checkpoint import CheckpointedBatch, input_signature
+from ATTIICCpackage.instrumentation import logger, timed, count
+from ATTIICCpackage.qc_montage import MontageWriter
 
-def seg_subfolder(saved_model_path, input_subfolder, output_subfolder):
+@timed('seg_subfolder')
+def seg_subfolder(saved_model_path, input_subfolder, output_subfolder, manifest_path=None):
     # Create output subfolder if it doesn't exist
     os.makedirs(output_subfolder, exist_ok=True)
     
-    # Load the existing model
-    model = models.CellposeModel(gpu=True, pretrained_model=saved_model_path)
+    # Completed images are recorded in a manifest, so a restarted run skips them and redoes partial ones
+    batch = CheckpointedBatch(output_subfolder, manifest_path)
+    
+    # The model is only loaded once there is an image left to segment
+    model = None
     
     # List all image files in the subfolder
     image_files = [f for f in os.listdir(input_subfolder) if f.endswith(('.png', '.jpg', '.jpeg', '.tif', '.tiff'))]
@@ -20,29 +26,47 @@ def seg_subfolder(saved_model_path, input_subfolder, output_subfolder):
     # Process each image
     segmented_images = []
     for i, image_file in enumerate(image_files):
-        # Load the image
         image_path = os.path.join(input_subfolder, image_file)
+        base = os.path.basename(image_file)
+        name, ext = os.path.splitext(base)
+        label_path = os.path.join(output_subfolder, f"{name}_label{ext}")
+        # save_rois appends '_rois.zip' to the name it is given, so f"{name}_rois.zip" is saved as f"{name}_rois_rois.zip"
+        rois_path = os.path.join(output_subfolder, f"{name}_rois_rois.zip")
+        
+        # Skip images already segmented with the same model whose outputs are intact
+        params = {'model': saved_model_path, **input_signature(image_path)}
+        if batch.skip(image_file, params):
+            continue
+        
+        # Load the existing model
+        if model is None:
+            model = models.CellposeModel(gpu=True, pretrained_model=saved_model_path)
+        
+        # Load the image
         image = io.imread(image_path)
         
         # Run the Cellpose model
         masks, flows, styles = model.eval(image, diameter=None, channels=[0, 0])
         
-        # Save the mask image
-        base = os.path.basename(image_file)
-        name, ext = os.path.splitext(base)
-        
-        # Save the mask image using Cellpose I/O
-        io.imsave(os.path.join(output_subfolder, f"{name}_label{ext}"), masks.astype('uint16'))  # Save masks as 16-bit image
-        
-        # Save the mask image as a rois.zip file using Cellpose's built-in io.save_rois function
-        cellpose_io.save_rois(masks, os.path.join(output_subfolder, f"{name}_rois.zip"))
+        # Outputs only appear under their final names once both are complete
+        with batch.write(image_file, [label_path, rois_path], params) as (label_temp_path, rois_temp_path):
+            # Save the mask image as a 16-bit image
+            io.imsave(label_temp_path, masks.astype('uint16'))
+            # Save the mask image as a rois.zip file using Cellpose's built-in io.save_rois function
+            cellpose_io.save_rois(masks, rois_temp_path[:-len('_rois.zip')] + '.zip')
         
         # Store original image, mask, and file name for later display
         segmented_images.append((image, masks, image_file))
+        count()
+    
+    batch.report()
         
     return segmented_images
 
 def display_images_with_masks(segmented_images):
+    # Interactive display for notebooks; batch runs write QC montages instead (see seg_all_subfolders)
+    import matplotlib.pyplot as plt
+
     # Limit to 16 images for display
     n_images = min(len(segmented_images), 16)
     
@@ -65,28 +89,38 @@ def display_images_with_masks(segmented_images):
     plt.tight_layout()
     plt.show()
 
-# Main function to process all subfolders and display images
-def seg_all_subfolders(saved_model_path, input_directory, output_directory):
+# Main function to process all subfolders and write QC montages
+def seg_all_subfolders(saved_model_path, input_directory, output_directory, qc_directory=None, qc_format='png',
+                       display=False):
     """
     Process all subfolders in the input directory and save segmentation results in the output directory.
+    A QC montage of the first images of every subfolder and their masks is written in the background
+    while the next subfolder is segmented.
     
     Parameters:
     saved_model_path (str): Path to the saved model for segmentation.
     input_directory (str): Path to the input directory containing subfolders with images.
     output_directory (str): Path to the output directory where results will be saved.
+    qc_directory (str or None): Path where the '<subfolder>_montage.<qc_format>' QC montages are written.
+                                Defaults to output_directory/qc.
+    qc_format (str): 'png' or 'jpg'.
+    display (bool): Also show the images and masks with matplotlib (blocks until the figure is closed).
     """
-    for root, dirs, _ in os.walk(input_directory):
-        for subfolder in dirs:
-            input_subfolder = os.path.join(root, subfolder)
-            output_subfolder = os.path.join(output_directory, subfolder)  # Create matching subfolder in output directory
-            
-            # Process the subfolder and get segmented images
-            segmented_images = seg_subfolder(saved_model_path, input_subfolder, output_subfolder)
-            
-            # Display the images and masks
-            if segmented_images:
-                print(f"Displaying images from subfolder: {subfolder}")
-                display_images_with_masks(segmented_images)
+    qc_directory = qc_directory or os.path.join(output_directory, 'qc')
+    with MontageWriter() as montage_writer:
+        for root, dirs, _ in os.walk(input_directory):
+            for subfolder in dirs:
+                input_subfolder = os.path.join(root, subfolder)
+                output_subfolder = os.path.join(output_directory, subfolder)  # Create matching subfolder in output directory
+                
+                # Process the subfolder and get segmented images
+                segmented_images = seg_subfolder(saved_model_path, input_subfolder, output_subfolder)
+                
+                # Queue the QC montage of the images and masks
+                if segmented_images:
+                    montage_writer.submit(segmented_images, os.path.join(qc_directory, f"{subfolder}_montage.{qc_format}"))
+                    if display:
+                        display_images_with_masks(segmented_images)
 
 ###############
 
@@ -97,6 +131,7 @@ def is_zip_file_empty(zip_path):
             return True
     return False
 
+@timed('move_empty_zip_files')
 def move_empty_zip_files_recursively(source_directory, destination_directory):
     """Move all empty zip files from the source directory and its subfolders to the destination directory, preserving folder structure."""
     # Walk through all the directories and subdirectories
@@ -116,5 +151,6 @@ def move_empty_zip_files_recursively(source_directory, destination_directory):
                     
                     # Move the empty zip file to the corresponding destination subfolder
                     dest_path = os.path.join(dest_subfolder, file)
-                    print(f"Moving empty ROI file: {zip_path} to {dest_path}")
+                    logger.debug("Moving empty ROI file: %s to %s", zip_path, dest_path)
                     shutil.move(zip_path, dest_path)
+                    count()
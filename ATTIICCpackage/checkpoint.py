@@ -0,0 +1,224 @@
+# checkpoint.py
+
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager, ExitStack
+
+# Outputs are written under this prefix and renamed when complete, so a crash never leaves a partial file
+# under its final name
+PARTIAL_PREFIX = '.partial_'
+
+
+########### Atomic outputs ############
+def partial_path(path):
+    """Return the temporary path an output is written to before it is renamed to path (same extension)."""
+    folder, file_name = os.path.split(path)
+    return os.path.join(folder, PARTIAL_PREFIX + file_name)
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    Context manager yielding a temporary path to write an output to; the file only becomes visible under
+    path, through an atomic rename, when the block completes without an exception.
+
+    Parameters:
+    path (str): The final output path.
+
+    Raises:
+    FileNotFoundError: If the block completes without writing the temporary path (e.g. an image writer that
+                       reports failure instead of raising).
+    """
+    temp_path = partial_path(path)
+    try:
+        yield temp_path
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if not os.path.exists(temp_path):
+        raise FileNotFoundError(f"{path} was not written")
+    os.replace(temp_path, path)
+
+
+def remove_partial_outputs(folder):
+    """
+    Delete the partial outputs a crashed run left behind in a folder tree.
+
+    Parameters:
+    folder (str): The output folder.
+
+    Returns:
+    int: The number of files removed.
+    """
+    removed = 0
+    for root, dirs, files in os.walk(folder):
+        for file_name in files:
+            if file_name.startswith(PARTIAL_PREFIX):
+                os.remove(os.path.join(root, file_name))
+                removed += 1
+    return removed
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """Return the BLAKE2b checksum of a file."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def input_signature(path):
+    """Size and modification time of an input file, used to notice that an input changed since it was processed."""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+########### Manifest ############
+def default_manifest_path(output_folder):
+    """Return the manifest path of a batch stage writing to output_folder: a sibling file, so it never shows up
+    among the outputs that the ImageJ macros and loaders list."""
+    return os.path.normpath(output_folder) + '_manifest.jsonl'
+
+
+class Manifest:
+    """
+    Append-only JSON-lines record of the work items a batch stage completed.
+
+    Every line holds the item name, the parameters it was processed with and the checksum of each of its outputs.
+    Lines are only appended after the outputs were renamed into place, so an item is either fully recorded or
+    redone. A line cut short by a crash is ignored when the manifest is read back.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry['item']] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_complete(self, item, params=None, verify=True):
+        """
+        Check whether an item was completed with the same parameters and its outputs are intact.
+
+        Parameters:
+        item (str): The work item (e.g. the relative path of an input image).
+        params (dict or None): The parameters the item would be processed with now.
+        verify (bool): Also compare the checksum of every output with the recorded one.
+
+        Returns:
+        bool: True if the item can be skipped.
+        """
+        entry = self.entries.get(item)
+        # An entry without outputs never proves the item was done
+        if entry is None or not entry.get('outputs'):
+            return False
+        # Compare the parameters the way they were stored (tuples become lists in JSON)
+        if entry.get('params') != json.loads(json.dumps(params or {})):
+            return False
+        for output_path, checksum in entry['outputs'].items():
+            if not os.path.exists(output_path):
+                return False
+            if verify and file_checksum(output_path) != checksum:
+                return False
+        return True
+
+    def record(self, item, output_paths, params=None):
+        """
+        Append a completed item, with the checksum of each of its outputs.
+
+        Parameters:
+        item (str): The work item.
+        output_paths (list): The final paths of the outputs of the item.
+        params (dict or None): The parameters the item was processed with.
+
+        Raises:
+        FileNotFoundError: If an output does not exist (or no output is given); nothing is recorded then.
+        """
+        missing = [p for p in output_paths if not os.path.exists(p)]
+        if missing or not output_paths:
+            raise FileNotFoundError(f"Cannot record {item}: missing outputs {missing}")
+        entry = {'item': item, 'params': json.loads(json.dumps(params or {})),
+                 'outputs': {p: file_checksum(p) for p in output_paths}}
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[item] = entry
+
+
+########### Checkpointed batch stages ############
+class CheckpointedBatch:
+    """
+    The manifest bookkeeping of a batch stage that writes one or more outputs per work item: partial outputs of
+    a crashed run are removed, items completed with the same parameters are skipped, and the outputs of the
+    other items are written atomically and recorded.
+
+    Usage:
+        batch = CheckpointedBatch(output_folder, manifest_path)
+        for item, params, output_path in work:
+            if batch.skip(item, params):
+                continue
+            with batch.write(item, [output_path], params) as (temp_path,):
+                write_image(result, temp_path)
+        batch.report()
+    """
+
+    def __init__(self, output_folder, manifest_path=None):
+        """
+        Parameters:
+        output_folder (str): The output folder of the stage.
+        manifest_path (str or None): The manifest file. If None, default_manifest_path(output_folder).
+        """
+        self.manifest = Manifest(manifest_path or default_manifest_path(output_folder))
+        if os.path.exists(output_folder):
+            remove_partial_outputs(output_folder)
+        self.n_skipped = 0
+
+    def skip(self, item, params=None):
+        """Return True (and count it) if the item was completed by a previous run with the same parameters."""
+        if self.manifest.is_complete(item, params):
+            self.n_skipped += 1
+            return True
+        return False
+
+    @contextmanager
+    def write(self, item, output_paths, params=None):
+        """
+        Context manager yielding the temporary paths to write the outputs of an item to. When the block completes,
+        every output is renamed into place and the item is recorded; if the block raises or does not write every
+        output, nothing is renamed or recorded.
+
+        Parameters:
+        item (str): The work item.
+        output_paths (list): The final paths of the outputs of the item.
+        params (dict or None): The parameters the item is processed with.
+        """
+        with ExitStack() as stack:
+            temp_paths = [stack.enter_context(atomic_write(path)) for path in output_paths]
+            yield temp_paths
+            # Check every output before the first one is renamed, so an item is never left half replaced
+            missing = [path for path, temp_path in zip(output_paths, temp_paths) if not os.path.exists(temp_path)]
+            if missing:
+                raise FileNotFoundError(f"{item}: outputs were not written: {missing}")
+        self.manifest.record(item, output_paths, params)
+
+    def report(self):
+        """Print how many items were skipped, if any."""
+        if self.n_skipped:
+            print(f"Skipped {self.n_skipped} images completed by a previous run")
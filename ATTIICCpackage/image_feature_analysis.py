@@ -1,5 +1,8 @@
 import os
+import logging
 import pandas as pd
+from ATTIICCpackage.timeseries_store import WellTimeSeriesStore, step_distances
+from ATTIICCpackage.instrumentation import logger, timed, count
 
 ########### process_and_save_cell_count ############
 def process_and_save_cell_count(df, output_csv_path):
@@ -27,6 +30,7 @@ def process_and_save_cell_count(df, output_csv_path):
     
     return df
 ##################### fill_missing_frames ################
+@timed('fill_missing_frames')
 def fill_missing_frames(df, frames_required=None, output_csv_path=None):
     """
     This function fills in missing frames for each well within each field by adding rows with Cell_Count=0
@@ -49,33 +53,23 @@ def fill_missing_frames(df, frames_required=None, output_csv_path=None):
     if frames_required is None:
         frames_required = sorted(df['frame'].unique())  # Use the frames already present in the data if not provided
 
-    # Create an empty list to hold all the new rows
-    new_rows = []
-
-    # Iterate over each unique field in the data
-    for field in df_filled['field'].unique():
-        
-        # Iterate over each unique well in this field
-        for well in df_filled[df_filled['field'] == field]['well'].unique():
-            print(f"Processing Field: {field}, Well: {well}")
-        
-            # Get the frames that are currently present for this well in the specific field
-            frames_present = df_filled[(df_filled['well'] == well) & (df_filled['field'] == field)]['frame'].unique()
-            print(f"Frames present for Well {well} in Field {field}: {frames_present}")
-        
-            # Determine which frames are missing
-            frames_missing = [frame for frame in frames_required if frame not in frames_present]
-            print(f"Frames missing for Well {well} in Field {field}: {frames_missing}")
-        
-            # For each missing frame, add a new row with Cell_Count = 0 and other fields set to 'na'
-            for frame in frames_missing:
-                new_row = {'frame': frame, 'well': well, 'field': field, 'cell': 'na', 'mean_intensity_d0': 'na', 
-                           'X': 'na', 'Y': 'na', 'area': 'na', 'circ.': 'na', 'ar': 'na', 'round': 'na', 
-                           'rolidity': 'na', 'label': 'na', 'cell_ID': 'na', 'cell_count': 0}
-                new_rows.append(new_row)
-
-    # Convert the list of new rows into a DataFrame
-    new_rows_df = pd.DataFrame(new_rows)
+    # The frames present in every well come from the presence matrix of the store, built on the key columns only
+    missing = pd.DataFrame(columns=['field', 'well', 'frame'])
+    if len(df_filled):
+        store = WellTimeSeriesStore.from_dataframe(df_filled[['field', 'well', 'frame', 'cell']])
+        count(store.n_wells)
+        missing = store.missing_frames(frames_required)
+    if len(missing) and logger.isEnabledFor(logging.DEBUG):
+        for (field, well), frames_missing in missing.groupby(['field', 'well'], sort=False)['frame']:
+            logger.debug("Frames missing for Well %s in Field %s: %s", well, field, list(frames_missing))
+
+    # For each missing frame, add a new row with Cell_Count = 0 and other fields set to 'na'
+    new_rows_df = pd.DataFrame()
+    if len(missing):
+        new_rows_df = pd.DataFrame({'frame': missing['frame'], 'well': missing['well'], 'field': missing['field']})
+        for column in ['cell', 'mean_intensity_d0', 'X', 'Y', 'area', 'circ.', 'ar', 'round', 'rolidity', 'label', 'cell_ID']:
+            new_rows_df[column] = 'na'
+        new_rows_df['cell_count'] = 0
 
     # Concatenate the new rows with the original DataFrame
     df_filled = pd.concat([df_filled, new_rows_df], ignore_index=True)
@@ -105,55 +99,9 @@ def add_trends_to_dataframe(df, frames_required, output_csv_path=None):
     pd.DataFrame: The updated dataframe with 'Trend_1' and 'Trend_2' columns added.
     """
     
-    # Function to calculate Trend_1 and Trend_2 for each well within each field
-    def calculate_trends(group):
-        trend_1 = []
-        trend_2 = []
-        
-        # Get the well and field for labeling
-        well = group['well'].iloc[0]
-        field = group['field'].iloc[0]
-        
-        # Track the last Cell_Count to identify trends
-        last_count = None
-        
-        # Iterate over the frames for this well within the field
-        for frame in frames_required:
-            row = group[group['frame'] == frame]
-            
-            if not row.empty:
-                current_count = row['cell_count'].values[0]
-                
-                # Check if the Cell_Count has changed compared to the last frame
-                if last_count is None or current_count != last_count:
-                    # Add to Trend_1 in the format frame_count
-                    trend_1.append(f"{frame}_{int(current_count)}")
-                    
-                    # If last_count is not None, calculate the trend (increase or decrease)
-                    if last_count is not None:
-                        if current_count > last_count:
-                            trend_2.append(f"{frame}_increase")
-                        elif current_count < last_count:
-                            trend_2.append(f"{frame}_decrease")
-                    
-                    # Update last_count to the current value
-                    last_count = current_count
-        
-        # Join the trends into strings with Well and Field number prefixed
-        trend_1_str = f"{field}_well_{well}_" + "_".join(trend_1)
-        trend_2_str = f"{field}_well_{well}_" + "_".join(trend_2)
-        
-        return pd.Series([trend_1_str, trend_2_str], index=['Trend_1', 'Trend_2'])
-    
-    # Apply the trend calculation function to each well within each field
-    df[['trend_1', 'trend_2']] = df.groupby(['field', 'well']).apply(calculate_trends).reset_index(drop=True)
-    
-    # Sort the dataframe by 'field', 'well', and 'frame'
-    df = df.sort_values(by=['field', 'well', 'frame']).reset_index(drop=True)        
-    # delete the rows where na in trend_1 and trend_2
-    df = df[(pd.notna(df['trend_1'])) & (pd.notna(df['trend_2']))]
-    # only keep the columns 'trend_1' and 'trend_2'
-    df=df[['trend_1','trend_2']]
+    # Trends of the 'cell_count' column of every well, computed on the (well x frame) matrices of the store
+    store = WellTimeSeriesStore.from_dataframe(df[['field', 'well', 'frame', 'cell']])
+    df = store.trends(frames_required, counts=store.slot_matrix(df, 'cell_count'))[['trend_1', 'trend_2']]
     # extract the well and field from the trend_1 column
     df['well'] = df['trend_1'].str.extract(r'well_(\d+)_')
     df['field'] = df['trend_1'].str.extract(r'f(\d+)_')
@@ -163,8 +111,6 @@ def add_trends_to_dataframe(df, frames_required, output_csv_path=None):
     # Save to CSV if an output path is provided
     if output_csv_path:
         df.to_csv(output_csv_path, index=False)
-    # save the cleaned dataframe as a csv file
-    df.to_csv('/Users/lieli/Documents/PROJECTS/test_1a/measurements_using_seg_ori_d3/cropped_d1_output_filled_trends_cleaned.csv', index=False)
     
     return df
 """
@@ -243,27 +189,13 @@ def calculate_moving_speed_and_mean(df, output_single_cells_csv, output_mean_mov
     # Filter for single cells (where cell_count is 1)
     df_single_cells = df[df['cell_count'] == 1].copy()
     
-    # Initialize the 'moving_speed' column with NaN values
-    df_single_cells['moving_speed'] = np.nan
-
     # Sort the DataFrame by field, well, and frame
     df_single_cells = df_single_cells.sort_values(by=['field', 'well', 'frame'])
 
-    # Loop through each field and well, and calculate the distance between sequential frames
-    for field in df_single_cells['field'].unique():
-        for well in df_single_cells['well'].unique():
-            well_df = df_single_cells[(df_single_cells['field'] == field) & (df_single_cells['well'] == well)].sort_values('frame')
-            
-            # Loop through frames sequentially to calculate the distance (Euclidean)
-            for i in range(1, len(well_df)):
-                x1, y1 = well_df.iloc[i - 1][['X', 'Y']]
-                x2, y2 = well_df.iloc[i][['X', 'Y']]
-                
-                # Calculate the Euclidean distance
-                distance = round((np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)), 2)
-                
-                # Update the moving_speed for the current frame
-                df_single_cells.loc[well_df.index[i], 'moving_speed'] = distance
+    # Distance (Euclidean) between sequential frames of every well, as one array kernel over all wells
+    wells = df_single_cells.groupby(['field', 'well'], sort=False).ngroup().to_numpy()
+    df_single_cells['moving_speed'] = step_distances(wells, df_single_cells['X'].to_numpy(dtype=float),
+                                                     df_single_cells['Y'].to_numpy(dtype=float))
 
     # Save the updated dataframe with 'moving_speed' column
     df_single_cells.to_csv(output_single_cells_csv, index=False)
@@ -401,38 +333,56 @@ def calculate_proximity(df):
     pd.DataFrame: A dataframe containing well-wise proximity calculations between E and T cells.
     """
 
-    # Initialize a list to store results
-    proximity_results = []
-
-    # Group the data by 'field' and 'well'
-    for (field, frame, well), group in df.groupby(['field', 'frame','well']):
-        # Filter the group to get E (effector) and T (target) cells
-        E_cells = group[group['cell_type'] == 'E']
-        T_cells = group[group['cell_type'] == 'T']
-
-        # Only proceed if both E and T cells are present in the well
-        if not E_cells.empty and not T_cells.empty:
-            # Calculate proximity (Euclidean distance) between each E and T cell
-            for _, e_row in E_cells.iterrows():
-                e_x, e_y = e_row['X'], e_row['Y']
-                
-                # Calculate the Euclidean distance to each T cell
-                for _, t_row in T_cells.iterrows():
-                    t_x, t_y = t_row['X'], t_row['Y']
-                    distance = np.sqrt((e_x - t_x)**2 + (e_y - t_y)**2)
-                    
-                    # Store the results
-                    proximity_results.append({
-                        'field': field,
-                        'frame': frame,
-                        'well': well,
-                        'E_cell_ID': e_row['cell'],
-                        'T_cell_ID': t_row['cell'],
-                        'E-T_distance': distance
-                    })
-
-    # Convert the proximity results into a DataFrame
-    proximity_df = pd.DataFrame(proximity_results)
-
-    return proximity_df
+    # Pair the E and T cells of every (field, frame, well) with array kernels instead of nested iterrows
+    return WellTimeSeriesStore.from_dataframe(df).proximity(effector_type='E', target_type='T')
+
+
+########### detect_killing_events ################
+def detect_killing_events(df, contact_distance, proximity_df=None, effector_type='E', target_type='T',
+                          death_column='death', min_death_frames=1, frame_interval=1, max_link_distance=50,
+                          output_csv_path=None):
+    """
+    Detect the contacts and deaths of every target cell over its track and derive its killing kinetics: first
+    contact frame, contact duration, death frame and time to kill. All wells are processed at once with array
+    operations (see WellTimeSeriesStore.killing_events).
+
+    Parameters:
+    df (pd.DataFrame): The classified cells, as returned by process_classified_data, with a 'track_id' column
+                       (see track_cells). Cells without one are tracked first with track_cells.
+    contact_distance (float): The maximum effector-target distance of a contact (in pixels).
+    proximity_df (pd.DataFrame or None): The E-T distances from calculate_proximity. If None, they are computed.
+    effector_type (str): The 'cell_type' value of effector cells.
+    target_type (str): The 'cell_type' value of target cells.
+    death_column (str): The column flagging dead cells.
+    min_death_frames (int): The number of consecutive dead frames that make a death, to ignore single-frame flicker.
+    frame_interval (float): The time between two frames, the unit of 'contact_duration' and 'time_to_kill'.
+    max_link_distance (float): The maximum distance a cell moves between two frames, used if df is not tracked.
+    output_csv_path (str or None): The path to save the events as a CSV file. If None, they are not saved.
+
+    Returns:
+    pd.DataFrame: One row per target track with 'field', 'well', 'track_id', 'first_frame', 'last_frame',
+                  'n_frames', 'first_contact_frame', 'E_cell_ID', 'contact_duration', 'death_frame', 'killed'
+                  and 'time_to_kill'.
+    """
+    if 'track_id' not in df.columns:
+        from ATTIICCpackage.object_matching import track_cells
+        df = track_cells(df, max_link_distance)
+
+    if proximity_df is not None:
+        # Keep the nearest effector of every target cell and attach it to the cell
+        nearest = proximity_df.sort_values('E-T_distance', kind='stable').drop_duplicates(
+            ['field', 'frame', 'well', 'T_cell_ID'])
+        nearest = nearest.assign(_cell=pd.to_numeric(nearest['T_cell_ID'], errors='coerce'))
+        df = df.drop(columns=['E-T_distance', 'E_cell_ID'], errors='ignore')
+        df = df.assign(_cell=pd.to_numeric(df['cell'], errors='coerce')).merge(
+            nearest[['field', 'frame', 'well', '_cell', 'E_cell_ID', 'E-T_distance']],
+            on=['field', 'frame', 'well', '_cell'], how='left').drop(columns='_cell')
+
+    events = WellTimeSeriesStore.from_dataframe(df).killing_events(
+        contact_distance, effector_type, target_type, death_column=death_column,
+        min_death_frames=min_death_frames, frame_interval=frame_interval)
 
+    if output_csv_path:
+        events.to_csv(output_csv_path, index=False)
+        print(f"Killing events saved to: {output_csv_path}")
+    return events
@@ -4,6 +4,8 @@ import os
 from scipy.ndimage import gaussian_filter
 #import imagej
 from skimage import restoration
+from ATTIICCpackage.checkpoint import CheckpointedBatch, input_signature
+from ATTIICCpackage.instrumentation import logger, timed, count
 
 #############gaussian_filter##############
 def read_image(file_path):
@@ -20,7 +22,11 @@ def background_subtraction(original_image, background_image):
     corrected_image[corrected_image < 0] = 0  # Set negative values to zero
     return corrected_image.astype(np.uint16)
 
-def process_images_bg(input_folder, output_folder, sigma_d0, sigma_d1, sigma_d2):
+@timed('process_images_bg')
+def process_images_bg(input_folder, output_folder, sigma_d0, sigma_d1, sigma_d2, manifest_path=None):
+    # Completed images are recorded in a manifest, so a restarted run skips them and redoes partial ones
+    batch = CheckpointedBatch(output_folder, manifest_path)
+
     # Walk through the directory tree
     for root, dirs, files in os.walk(input_folder):
         # Determine the relative path of the current directory
@@ -47,6 +53,12 @@ def process_images_bg(input_folder, output_folder, sigma_d0, sigma_d1, sigma_d2)
                 input_image_path = os.path.join(root, file_name)
                 output_image_path = os.path.join(output_subfolder, file_name.replace('.png', '_bg.png'))
 
+                # Skip images already processed with the same parameters whose output is intact
+                item = os.path.relpath(input_image_path, input_folder)
+                params = {'method': 'gaussian', 'sigma': sigma, **input_signature(input_image_path)}
+                if batch.skip(item, params):
+                    continue
+
                 # Read the input image
                 original_image = read_image(input_image_path)
 
@@ -56,10 +68,14 @@ def process_images_bg(input_folder, output_folder, sigma_d0, sigma_d1, sigma_d2)
                 # Subtract the background image from the original image
                 corrected_image = background_subtraction(original_image, background_image)
 
-                # Write the corrected image to the output folder
-                write_image(corrected_image, output_image_path)
+                # Write the corrected image to the output folder; it only appears under its final name once complete
+                with batch.write(item, [output_image_path], params) as (temp_path,):
+                    write_image(corrected_image, temp_path)
 
-                print(f"Processed and saved: {output_image_path}")
+                logger.debug("Processed and saved: %s", output_image_path)
+                count()
+
+    batch.report()
 
 
 ########## Rolling Ball Algorithm ##########
@@ -80,7 +96,11 @@ def background_subtraction(original_image, background_image):
     corrected_image[corrected_image < 0] = 0  # Set negative values to zero
     return corrected_image.astype(np.uint16)
 
-def process_images_bg_rolling_ball(input_folder, output_folder, radius_d0, radius_d1, radius_d2):
+@timed('process_images_bg_rolling_ball')
+def process_images_bg_rolling_ball(input_folder, output_folder, radius_d0, radius_d1, radius_d2, manifest_path=None):
+    # Completed images are recorded in a manifest, so a restarted run skips them and redoes partial ones
+    batch = CheckpointedBatch(output_folder, manifest_path)
+
     # Walk through the directory tree
     for root, dirs, files in os.walk(input_folder):
         # Determine the relative path of the current directory
@@ -107,6 +127,12 @@ def process_images_bg_rolling_ball(input_folder, output_folder, radius_d0, radiu
                 input_image_path = os.path.join(root, file_name)
                 output_image_path = os.path.join(output_subfolder, file_name.replace('.png', '_bg.png'))
 
+                # Skip images already processed with the same parameters whose output is intact
+                item = os.path.relpath(input_image_path, input_folder)
+                params = {'method': 'rolling_ball', 'radius': radius, **input_signature(input_image_path)}
+                if batch.skip(item, params):
+                    continue
+
                 # Read the input image
                 original_image = read_image(input_image_path)
 
@@ -116,10 +142,11 @@ def process_images_bg_rolling_ball(input_folder, output_folder, radius_d0, radiu
                 # Subtract the background image from the original image
                 corrected_image = background_subtraction(original_image, background_image)
 
-                # Write the corrected image to the output folder
-                write_image(corrected_image, output_image_path)
-
-                print(f"Processed and saved: {output_image_path}")
-
+                # Write the corrected image to the output folder; it only appears under its final name once complete
+                with batch.write(item, [output_image_path], params) as (temp_path,):
+                    write_image(corrected_image, temp_path)
 
+                logger.debug("Processed and saved: %s", output_image_path)
+                count()
 
+    batch.report()
@@ -0,0 +1,293 @@
+# instrumentation.py
+#
+# Lightweight per-stage instrumentation: stage timers, item counters, peak RSS sampling and optional cProfile
+# hooks, reported through the 'ATTIICCpackage' logger and as a JSON run report.
+#
+# Instrumentation is off by default; stage() then returns a shared no-op object, so the hooks left in the hot
+# loops cost one function call and a flag check.
+#
+# Usage:
+#     from ATTIICCpackage import instrumentation
+#     instrumentation.enable(profile_dir='profiles')
+#     process_images_bg(...)
+#     instrumentation.write_report('run_report.json')
+
+import os
+import sys
+import json
+import time
+import logging
+import functools
+import platform
+import threading
+
+logger = logging.getLogger('ATTIICCpackage')
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_stages = {}
+_active = set()
+_run = {}
+_sampler = None
+_profile_dir = None
+_profiling = False
+
+
+########### Memory ############
+def current_rss():
+    """
+    Return the resident set size of the process in bytes, or None if it cannot be read on this platform.
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class _RSSSampler(threading.Thread):
+    """Background thread sampling the RSS and raising the peak of every stage running at that moment."""
+
+    def __init__(self, interval):
+        super().__init__(name='attiicc-rss-sampler', daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        rss = current_rss()
+        if rss is None:
+            return
+        with _lock:
+            self.peak = max(self.peak, rss)
+            for active in _active:
+                active.peak_rss = max(active.peak_rss, rss)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+########### Stages ############
+class _NullStage:
+    """Returned by stage() while instrumentation is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, n=1):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """One timed execution of a stage; its figures are added to the stage totals when it ends."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.peak_rss = 0
+        self._profiler = None
+
+    def add(self, n=1):
+        """Count n processed items (images, files, wells, ...)."""
+        self.items += n
+
+    def __enter__(self):
+        global _profiling
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        # Only one stage is profiled at a time: cProfile does not support nested or concurrent profilers
+        if _profile_dir is not None and not stack:
+            with _lock:
+                if not _profiling:
+                    import cProfile
+                    self._profiler = cProfile.Profile()
+                    _profiling = True
+        stack.append(self)
+        with _lock:
+            _active.add(self)
+        if _sampler is not None:
+            _sampler.sample()
+        self._start = time.perf_counter()
+        self._cpu_start = time.thread_time()
+        if self._profiler is not None:
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _profiling
+        if self._profiler is not None:
+            self._profiler.disable()
+        seconds = time.perf_counter() - self._start
+        cpu_seconds = time.thread_time() - self._cpu_start
+        if _sampler is not None:
+            _sampler.sample()
+        _local.stack.pop()
+
+        with _lock:
+            _active.discard(self)
+            totals = _stages.setdefault(self.name, {'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0,
+                                                    'peak_rss_mb': 0.0, 'errors': 0})
+            totals['calls'] += 1
+            totals['seconds'] += seconds
+            totals['cpu_seconds'] += cpu_seconds
+            totals['items'] += self.items
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'], self.peak_rss / 2 ** 20)
+            totals['errors'] += exc_type is not None
+
+        if self._profiler is not None:
+            os.makedirs(_profile_dir, exist_ok=True)
+            profile_path = os.path.join(_profile_dir, f"{self.name}_{time.strftime('%Y%m%d-%H%M%S')}_{id(self):x}.prof")
+            self._profiler.dump_stats(profile_path)
+            with _lock:
+                totals.setdefault('profiles', []).append(profile_path)
+                _profiling = False
+
+        rate = f", {self.items / seconds:.1f} items/s" if self.items and seconds > 0 else ''
+        logger.info("%s: %d items in %.3fs%s, peak RSS %.1f MB", self.name, self.items, seconds, rate,
+                    self.peak_rss / 2 ** 20)
+        return False
+
+
+def stage(name):
+    """
+    Context manager timing one execution of a stage. Call add(n) on the returned object to count the items it
+    processed. Times, item counts and peak RSS are accumulated per stage name.
+
+    Parameters:
+    name (str): The stage name.
+
+    Returns:
+    A context manager; a shared no-op one while instrumentation is disabled.
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def timed(name):
+    """
+    Decorator running every call of a function as a stage; use count() inside it to count items.
+
+    Parameters:
+    name (str): The stage name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(n=1):
+    """Count n items in the innermost running stage of the current thread (no-op when disabled)."""
+    if not _enabled:
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].items += n
+
+
+########### Run ############
+def enable(rss_interval=0.2, profile_dir=None):
+    """
+    Turn instrumentation on and start a new run report.
+
+    Parameters:
+    rss_interval (float or None): Seconds between two RSS samples; None disables the sampling thread (RSS is then
+                                  only sampled when stages start and end).
+    profile_dir (str or None): If given, outermost stages run under cProfile and their stats are dumped to this
+                               folder ('<stage>_<time>_<id>.prof', readable with pstats). Stages running while
+                               another one is profiled (in other threads) are only timed.
+    """
+    global _enabled, _sampler, _profile_dir
+    disable()
+    with _lock:
+        _stages.clear()
+        _active.clear()
+        _run.clear()
+        _run.update({'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'start': time.perf_counter(),
+                     'python': platform.python_version(), 'platform': platform.platform(), 'argv': sys.argv})
+    _profile_dir = profile_dir
+    _sampler = _RSSSampler(rss_interval or 0)
+    if rss_interval:
+        _sampler.start()
+    _enabled = True
+
+
+def disable():
+    """Turn instrumentation off; the figures collected so far are kept for report()."""
+    global _enabled, _sampler
+    _enabled = False
+    if _sampler is not None:
+        _sampler.stop()
+        with _lock:
+            _run['peak_rss_mb'] = _sampler.peak / 2 ** 20
+        _sampler = None
+    if 'start' in _run and 'seconds' not in _run:
+        _run['seconds'] = time.perf_counter() - _run['start']
+
+
+def is_enabled():
+    return _enabled
+
+
+def report():
+    """
+    Return the run report.
+
+    Returns:
+    dict: 'run' (start time, duration, peak RSS, environment) and 'stages' ({name: calls, seconds, cpu_seconds,
+          items, items_per_second, peak_rss_mb, errors and, when profiling, the profile files}).
+    """
+    with _lock:
+        run = {k: v for k, v in _run.items() if k != 'start'}
+        if _enabled and 'start' in _run:
+            run['seconds'] = time.perf_counter() - _run['start']
+            run['peak_rss_mb'] = _sampler.peak / 2 ** 20 if _sampler is not None else None
+        stages = {}
+        for name, totals in _stages.items():
+            stages[name] = dict(totals)
+            stages[name]['items_per_second'] = totals['items'] / totals['seconds'] if totals['seconds'] > 0 else None
+    return {'run': run, 'stages': stages}
+
+
+def write_report(path):
+    """
+    Write the run report as JSON.
+
+    Parameters:
+    path (str): The output path.
+
+    Returns:
+    dict: The report.
+    """
+    run_report = report()
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(run_report, f, indent=1)
+    os.replace(temp_path, path)
+    logger.info("Run report written to %s", path)
+    return run_report
@@ -0,0 +1,407 @@
+# live.py
+#
+# Live ingestion of a time-lapse acquisition: frames are processed as soon as the microscope has written all of
+# their channels, instead of after the last frame.
+#
+# Usage: python -m ATTIICCpackage.live watch INPUT_DIR OUTPUT_DIR --model MODEL [--sigmas 50 50 50] [--interval 2]
+#        python -m ATTIICCpackage.live replay SOURCE_DIR INPUT_DIR [--rate 0.5]
+
+import os
+import re
+import csv
+import time
+import shutil
+import argparse
+import numpy as np
+
+from ATTIICCpackage.checkpoint import atomic_write
+from ATTIICCpackage.object_matching import link_cells
+
+# Channel folders are 'fNNd0', 'fNNd1', 'fNNd2' and 'fNNd3_png'; frame files start with 'pNN'
+CHANNEL_FOLDER_PATTERN = re.compile(r'^(f\d+)(d\d)')
+FRAME_FILE_PATTERN = re.compile(r'^p(\d+)')
+IMAGE_EXTENSIONS = ('.png', '.tif', '.tiff')
+
+
+def scan_frames(input_dir):
+    """
+    List the frame images of an acquisition tree.
+
+    Parameters:
+    input_dir (str): A folder with 'fNNdK' channel subfolders.
+
+    Returns:
+    dict: {(field, frame): {channel: path}}.
+    """
+    frames = {}
+    if not os.path.isdir(input_dir):
+        return frames
+    for folder in os.scandir(input_dir):
+        match = CHANNEL_FOLDER_PATTERN.match(folder.name)
+        if not folder.is_dir() or not match:
+            continue
+        field, channel = match.groups()
+        for entry in os.scandir(folder.path):
+            frame_match = FRAME_FILE_PATTERN.match(entry.name)
+            if frame_match and entry.name.endswith(IMAGE_EXTENSIONS):
+                frames.setdefault((field, int(frame_match.group(1))), {})[channel] = entry.path
+    return frames
+
+
+def cellpose_segmenter(saved_model_path):
+    """
+    Return a segment(image) -> masks function running a pretrained Cellpose model, loaded once on first use.
+
+    Parameters:
+    saved_model_path (str): Path to the saved model for segmentation.
+    """
+    model = []
+
+    def segment(image):
+        if not model:
+            from cellpose import models
+            model.append(models.CellposeModel(gpu=True, pretrained_model=saved_model_path))
+        masks, flows, styles = model[0].eval(image, diameter=None, channels=[0, 0])
+        return masks
+
+    return segment
+
+
+########### Live processing ############
+class LiveProcessor:
+    """
+    Watches an acquisition tree by polling and processes every frame once all of its channels are written:
+    background subtraction of the intensity channels, segmentation of the segmentation channel, measurement of
+    the cells and incremental tracking against the previous frame of the same well. Cells, cell counts and
+    count-change events are appended to CSV files in output_dir as frames complete:
+
+    live_cells.csv   one row per cell with 'field', 'well', 'frame', 'cell', 'track_id', 'X', 'Y', intensities, shape
+    live_counts.csv  'field', 'well', 'frame', 'cell_count'
+    live_events.csv  'field', 'well', 'frame', 'event' ('increase' / 'decrease'), 'previous_count', 'cell_count'
+    live_frames.csv  'field', 'frame', 'n_cells' of every processed frame, appended once its other rows are written
+
+    Frames of a field are processed in frame order. A file counts as written once its size did not change
+    between two polls. A processor started on the output_dir of a previous run continues where that run
+    stopped: the frames in live_frames.csv are not processed again and the counts, events and tracks go on
+    from the tables (see _resume).
+    """
+
+    def __init__(self, input_dir, output_dir, segment, sigmas=None, channels=('d0', 'd1', 'd2'),
+                 seg_channel='d3', well_maps=None, detect_wells=False, max_link_distance=20, on_update=None):
+        """
+        Parameters:
+        input_dir (str): The acquisition tree, with 'fNNd0', ..., 'fNNd3_png' subfolders.
+        output_dir (str): The folder for the live tables, background-subtracted images and masks.
+        segment (callable): segment(image) -> label image, e.g. cellpose_segmenter(model_path).
+        sigmas (dict or None): {channel: sigma} for the Gaussian background subtraction; None to skip it.
+        channels (tuple): The intensity channels.
+        seg_channel (str): The channel that is segmented.
+        well_maps (dict or None): {field: well ID image} used to assign cells to wells (see measure_cells).
+        detect_wells (bool or dict): Detect the well grid of each field (not in well_maps) on its first frame of the
+                                     segmentation channel and assign the cells of later frames to wells after
+                                     correcting their drift. A dict is passed as options to WellGrid.detect.
+        max_link_distance (float): The maximum distance a cell moves between two frames.
+        on_update (callable or None): Called as on_update(field, frame, cells_df) after each processed frame.
+        """
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.segment = segment
+        self.sigmas = sigmas
+        self.channels = tuple(channels)
+        self.seg_channel = seg_channel
+        self.well_maps = well_maps or {}
+        self.detect_wells = detect_wells
+        self.well_grids = {}
+        self.max_link_distance = max_link_distance
+        self.on_update = on_update
+
+        self.processed = set()
+        self.counts = {}
+        self.events = []
+        self._last_count = {}
+        self._sizes = {}
+        self._last_cells = {}
+        self._next_track = {}
+        os.makedirs(output_dir, exist_ok=True)
+        self._resume()
+
+    def _is_written(self, path):
+        size = os.path.getsize(path)
+        stable = size > 0 and self._sizes.get(path) == size
+        self._sizes[path] = size
+        return stable
+
+    def ready_frames(self):
+        """Return the (field, frame, paths) that can be processed now, in processing order."""
+        needed = self.channels + (self.seg_channel,)
+        ready = []
+        blocked_fields = set()
+        for (field, frame), paths in sorted(self.scan().items()):
+            if (field, frame) in self.processed:
+                continue
+            # Check every channel of every pending frame, also behind a frame that is still being written, so all
+            # sizes are recorded and a backlog of frames becomes ready in one poll
+            written = [channel in paths and self._is_written(paths[channel]) for channel in needed]
+            if all(written) and field not in blocked_fields:
+                ready.append((field, frame, paths))
+            else:
+                # Keep frame order within a field
+                blocked_fields.add(field)
+        return ready
+
+    def scan(self):
+        return scan_frames(self.input_dir)
+
+    def process_frame(self, field, frame, paths):
+        """
+        Process one complete frame and update the live tables.
+
+        Returns:
+        pd.DataFrame: The cells of the frame.
+        """
+        import cv2
+        from ATTIICCpackage.image_preprocessing import gaussian_smoothing, background_subtraction
+        from ATTIICCpackage.cell_measurement import measure_cells
+
+        # Background subtraction of the intensity channels
+        intensity_images = {}
+        for channel in self.channels:
+            image = cv2.imread(paths[channel], cv2.IMREAD_UNCHANGED)
+            if self.sigmas is not None:
+                image = background_subtraction(image, gaussian_smoothing(image, self.sigmas[channel]))
+                self._save_image(image, 'background', paths[channel], '_bg')
+            intensity_images[channel] = image
+
+        # Segmentation and measurement
+        seg_image = cv2.imread(paths[self.seg_channel], cv2.IMREAD_UNCHANGED)
+        masks = np.asarray(self.segment(seg_image))
+        self._save_image(masks.astype(np.uint16), 'segmentation', paths[self.seg_channel], '_label')
+        if self.detect_wells and field not in self.well_maps:
+            cells = measure_cells(masks, intensity_images, *self._well_grid(field, seg_image))
+        else:
+            cells = measure_cells(masks, intensity_images, self.well_maps.get(field))
+        cells['field'] = field
+        cells['frame'] = frame
+        cells['track_id'] = self._track(field, cells)
+        cells = cells[['field', 'well', 'frame', 'cell', 'track_id'] +
+                      [c for c in cells.columns if c not in ('field', 'well', 'frame', 'cell', 'track_id')]]
+
+        self._update_counts(field, frame, cells)
+        self._append_csv('live_cells.csv', cells.columns, cells.itertuples(index=False))
+        # Logged last: a frame interrupted before this line is redone by a restarted run
+        self._append_csv('live_frames.csv', ['field', 'frame', 'n_cells'], [(field, frame, len(cells))])
+        self.processed.add((field, frame))
+
+        if self.on_update is not None:
+            self.on_update(field, frame, cells)
+        return cells
+
+    def _well_grid(self, field, seg_image):
+        """Return the well map of the field and the drift of seg_image, detecting the grid on the first frame."""
+        grid = self.well_grids.get(field)
+        if grid is None:
+            from ATTIICCpackage.microwells import WellGrid
+            grid_path = os.path.join(self.output_dir, 'wells', f'{field}.npz')
+            if os.path.exists(grid_path):
+                # Detected by a previous run: keep its reference frame, so the drift is measured against it
+                grid = self.well_grids[field] = WellGrid.load(grid_path)
+                return grid.well_map, grid.shift(seg_image)
+            options = self.detect_wells if isinstance(self.detect_wells, dict) else {}
+            grid = self.well_grids[field] = WellGrid.detect(seg_image, **options)
+            grid.save(grid_path)
+            print(f"Detected {len(grid)} wells in field {field}")
+            return grid.well_map, (0, 0)
+        return grid.well_map, grid.shift(seg_image)
+
+    def _save_image(self, image, stage, input_path, suffix):
+        import cv2
+        folder = os.path.join(self.output_dir, stage, os.path.basename(os.path.dirname(input_path)))
+        os.makedirs(folder, exist_ok=True)
+        name, ext = os.path.splitext(os.path.basename(input_path))
+        with atomic_write(os.path.join(folder, f"{name}{suffix}{ext}")) as temp_path:
+            cv2.imwrite(temp_path, image)
+
+    def _track(self, field, cells):
+        # Link each well to the cells of its previous processed frame; unmatched cells start new tracks
+        track_ids = np.empty(len(cells), dtype=np.int64)
+        xy = cells[['X', 'Y']].to_numpy(dtype=float)
+        wells = cells['well'].to_numpy()
+        for well in np.unique(wells):
+            rows = np.flatnonzero(wells == well)
+            previous_xy, previous_ids = self._last_cells.get((field, well), (np.empty((0, 2)), np.empty(0, dtype=np.int64)))
+            matches = link_cells(previous_xy, xy[rows], self.max_link_distance)
+            for row, match in zip(rows, matches):
+                if match >= 0:
+                    track_ids[row] = previous_ids[match]
+                else:
+                    track_ids[row] = self._next_track.get(field, 0)
+                    self._next_track[field] = track_ids[row] + 1
+            self._last_cells[(field, well)] = (xy[rows], track_ids[rows])
+        # Wells that lost all their cells have no previous cells for the next frame
+        for key in [k for k in self._last_cells if k[0] == field and k[1] not in wells]:
+            del self._last_cells[key]
+        return track_ids
+
+    def _update_counts(self, field, frame, cells):
+        wells, counts = np.unique(cells['well'].to_numpy(), return_counts=True)
+        frame_counts = dict(zip(wells.tolist(), counts.tolist()))
+        # Wells seen before but empty now count as 0
+        for (f, well) in self._last_count:
+            if f == field:
+                frame_counts.setdefault(well, 0)
+
+        count_rows, event_rows = [], []
+        for well, count in sorted(frame_counts.items()):
+            previous = self._last_count.get((field, well))
+            self.counts[(field, well, frame)] = count
+            self._last_count[(field, well)] = count
+            count_rows.append((field, well, frame, count))
+            if previous is not None and previous != count:
+                event = (field, well, frame, 'increase' if count > previous else 'decrease', previous, count)
+                self.events.append(event)
+                event_rows.append(event)
+
+        self._append_csv('live_counts.csv', ['field', 'well', 'frame', 'cell_count'], count_rows)
+        self._append_csv('live_events.csv', ['field', 'well', 'frame', 'event', 'previous_count', 'cell_count'], event_rows)
+
+    def _resume(self):
+        """
+        Rebuild the state of a previous run on the same output_dir from its live tables: the processed frames,
+        the last count of every well, the events, the cells of the last frame of every field (to link the next
+        frame to) and the next track id of every field. Rows of a frame that was interrupted before it was logged
+        in live_frames.csv are dropped, since the frame is processed again.
+        """
+        import pandas as pd
+
+        frames_path = os.path.join(self.output_dir, 'live_frames.csv')
+        if not os.path.exists(frames_path):
+            return
+        df_frames = pd.read_csv(frames_path)
+        self.processed = set(zip(df_frames['field'].tolist(), df_frames['frame'].tolist()))
+
+        tables = {}
+        for file_name in ('live_cells.csv', 'live_counts.csv', 'live_events.csv'):
+            path = os.path.join(self.output_dir, file_name)
+            if not os.path.exists(path):
+                continue
+            df = pd.read_csv(path)
+            done = pd.MultiIndex.from_arrays([df['field'], df['frame']]).isin(list(self.processed))
+            if not done.all():
+                df = df[done]
+                with atomic_write(path) as temp_path:
+                    df.to_csv(temp_path, index=False)
+                print(f"Dropped {int((~done).sum())} rows of unfinished frames from {file_name}")
+            tables[file_name] = df
+
+        if 'live_counts.csv' in tables:
+            df_counts = tables['live_counts.csv'].sort_values('frame', kind='stable')
+            for field, well, frame, count in df_counts[['field', 'well', 'frame', 'cell_count']].itertuples(index=False):
+                self.counts[(field, well, frame)] = count
+                self._last_count[(field, well)] = count
+        if 'live_events.csv' in tables:
+            self.events = list(tables['live_events.csv'].itertuples(index=False, name=None))
+        if 'live_cells.csv' in tables:
+            df_cells = tables['live_cells.csv']
+            for field, df_field in df_cells.groupby('field'):
+                self._next_track[field] = int(df_field['track_id'].max()) + 1
+                last_frame = max(frame for (f, frame) in self.processed if f == field)
+                for well, df_well in df_field[df_field['frame'] == last_frame].groupby('well'):
+                    self._last_cells[(field, well)] = (df_well[['X', 'Y']].to_numpy(dtype=float),
+                                                       df_well['track_id'].to_numpy(dtype=np.int64))
+        print(f"Resuming after {len(self.processed)} frames processed by a previous run")
+
+    def _append_csv(self, file_name, columns, rows):
+        path = os.path.join(self.output_dir, file_name)
+        write_header = not os.path.exists(path)
+        with open(path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(list(columns))
+            writer.writerows(rows)
+
+    def poll(self):
+        """Process every frame that became complete since the last poll. Returns the number of frames processed."""
+        ready = self.ready_frames()
+        for field, frame, paths in ready:
+            self.process_frame(field, frame, paths)
+            print(f"Processed live frame: field {field}, frame {frame}")
+        return len(ready)
+
+    def run(self, poll_interval=2.0, idle_timeout=None):
+        """
+        Poll the input tree until interrupted, or until no new frame completed for idle_timeout seconds.
+
+        Parameters:
+        poll_interval (float): Seconds between two polls.
+        idle_timeout (float or None): Stop after this many seconds without a new frame. If None, run until interrupted.
+        """
+        last_activity = time.monotonic()
+        try:
+            while True:
+                if self.poll():
+                    last_activity = time.monotonic()
+                elif idle_timeout is not None and time.monotonic() - last_activity > idle_timeout:
+                    break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        print(f"Live processing stopped after {len(self.processed)} frames")
+
+
+########### Replay ############
+def replay_frames(source_dir, target_dir, frames_per_second=1.0):
+    """
+    Replay a finished acquisition into target_dir frame by frame, to test the live mode locally. All channel
+    files of a frame are copied at once (each one moved into place by an atomic rename), then the replay waits
+    1 / frames_per_second seconds before the next frame.
+
+    Parameters:
+    source_dir (str): A finished acquisition tree with 'fNNdK' channel subfolders.
+    target_dir (str): The folder watched by the live processor.
+    frames_per_second (float): The replay rate.
+    """
+    frames = scan_frames(source_dir)
+    for frame in sorted({frame for (_, frame) in frames}):
+        for (field, f), paths in sorted(frames.items()):
+            if f != frame:
+                continue
+            for channel, path in paths.items():
+                relative_path = os.path.relpath(path, source_dir)
+                target_path = os.path.join(target_dir, relative_path)
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                with atomic_write(target_path) as temp_path:
+                    shutil.copyfile(path, temp_path)
+        print(f"Replayed frame {frame}")
+        time.sleep(1.0 / frames_per_second)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Live processing of a time-lapse acquisition.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    watch = subparsers.add_parser('watch', help="process frames as they are written")
+    watch.add_argument('input_dir')
+    watch.add_argument('output_dir')
+    watch.add_argument('--model', required=True, help="path to the pretrained Cellpose model")
+    watch.add_argument('--sigmas', type=float, nargs=3, metavar=('D0', 'D1', 'D2'), help="background sigmas")
+    watch.add_argument('--interval', type=float, default=2.0, help="seconds between polls")
+    watch.add_argument('--idle-timeout', type=float, default=None, help="stop after this many idle seconds")
+    watch.add_argument('--detect-wells', action='store_true', help="detect the well grid on the first frame")
+
+    replay = subparsers.add_parser('replay', help="replay a finished acquisition at a chosen rate")
+    replay.add_argument('source_dir')
+    replay.add_argument('target_dir')
+    replay.add_argument('--rate', type=float, default=1.0, help="frames per second")
+
+    args = parser.parse_args(argv)
+    if args.command == 'watch':
+        sigmas = dict(zip(('d0', 'd1', 'd2'), args.sigmas)) if args.sigmas else None
+        processor = LiveProcessor(args.input_dir, args.output_dir, cellpose_segmenter(args.model), sigmas=sigmas,
+                                  detect_wells=args.detect_wells)
+        processor.run(poll_interval=args.interval, idle_timeout=args.idle_timeout)
+    else:
+        replay_frames(args.source_dir, args.target_dir, args.rate)
+
+
+if __name__ == '__main__':
+    main()
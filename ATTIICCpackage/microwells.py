@@ -0,0 +1,310 @@
+# microwells.py
+#
+# Microwell grid detection. The grid is detected once per field from a d3 (brightfield) frame and kept as a
+# compact array of well boxes; every other frame only needs its drift relative to that frame, which is found
+# by phase correlation, to crop the wells, measure them and assign cells to wells.
+
+import os
+import re
+import numpy as np
+
+from ATTIICCpackage.checkpoint import atomic_write
+
+# Columns of the well box array: well ID (1..n, 0 is outside every well) and the box in pixels of the reference
+# frame
+WELL_BOX_COLUMNS = ['well', 'x', 'y', 'width', 'height']
+
+
+def well_map_from_boxes(boxes, shape):
+    """
+    Rasterize well boxes into an image holding the well ID of every pixel (0 outside the wells), as used by
+    measure_cells.
+
+    Parameters:
+    boxes (np.ndarray): The well boxes (see WELL_BOX_COLUMNS).
+    shape (tuple): The (height, width) of the image.
+
+    Returns:
+    np.ndarray: The uint16 well map.
+    """
+    well_map = np.zeros(shape, dtype=np.uint16)
+    for well, x, y, width, height in boxes:
+        well_map[max(y, 0):max(y + height, 0), max(x, 0):max(x + width, 0)] = well
+    return well_map
+
+
+########### Detection ############
+def detect_wells(image, wells_dark=True, smooth_sigma=2, min_area=100, size_tolerance=0.3, exclude_border=True):
+    """
+    Detect the microwells of a d3 (brightfield) image: threshold the smoothed image with Otsu's method, fill the
+    wells, keep the components whose size is close to the median well and number them in row-major order.
+
+    Parameters:
+    image (np.ndarray): The d3 image.
+    wells_dark (bool): True if the well interiors are darker than the walls between them.
+    smooth_sigma (float): Sigma of the Gaussian smoothing applied before thresholding.
+    min_area (int): Components smaller than this (in pixels) are ignored.
+    size_tolerance (float): Allowed relative difference between the width and height of a well and the median.
+    exclude_border (bool): Drop wells cut by the image border.
+
+    Returns:
+    np.ndarray: The (n_wells, 5) int32 array of well boxes (see WELL_BOX_COLUMNS).
+    """
+    from scipy import ndimage
+    from skimage.filters import threshold_otsu
+
+    smoothed = ndimage.gaussian_filter(np.asarray(image, dtype=np.float32), smooth_sigma)
+    threshold = threshold_otsu(smoothed)
+    mask = smoothed < threshold if wells_dark else smoothed > threshold
+    mask = ndimage.binary_fill_holes(ndimage.binary_opening(mask, iterations=2))
+
+    labels, n = ndimage.label(mask)
+    if n == 0:
+        return np.empty((0, 5), dtype=np.int32)
+    slices = ndimage.find_objects(labels)
+    areas = ndimage.sum(mask, labels, np.arange(1, n + 1))
+    boxes = np.array([[s[1].start, s[0].start, s[1].stop - s[1].start, s[0].stop - s[0].start] for s in slices])
+
+    keep = areas >= min_area
+    if exclude_border:
+        keep &= (boxes[:, 0] > 0) & (boxes[:, 1] > 0) & (boxes[:, 0] + boxes[:, 2] < mask.shape[1]) & \
+                (boxes[:, 1] + boxes[:, 3] < mask.shape[0])
+    if keep.any():
+        median_size = np.median(boxes[keep, 2:], axis=0)
+        keep &= np.all(np.abs(boxes[:, 2:] - median_size) <= size_tolerance * median_size, axis=1)
+        # Wells are filled boxes; merged or irregular blobs are not
+        keep &= areas >= 0.5 * boxes[:, 2] * boxes[:, 3]
+    boxes = boxes[keep]
+    if not len(boxes):
+        return np.empty((0, 5), dtype=np.int32)
+
+    # Row-major order: a new row starts where the box centers jump by more than half a well height
+    centers_y = boxes[:, 1] + boxes[:, 3] / 2
+    order = np.argsort(centers_y, kind='stable')
+    row = np.concatenate([[0], np.cumsum(np.diff(centers_y[order]) > np.median(boxes[:, 3]) / 2)])
+    rows = np.empty(len(boxes), dtype=int)
+    rows[order] = row
+    boxes = boxes[np.lexsort((boxes[:, 0], rows))]
+
+    return np.column_stack([np.arange(1, len(boxes) + 1), boxes]).astype(np.int32)
+
+
+########### Drift ############
+def _prepare(image, downsample):
+    image = np.asarray(image, dtype=np.float32)[::downsample, ::downsample]
+    image = image - image.mean()
+    # A window keeps the image borders from dominating the correlation
+    window = np.outer(np.hanning(image.shape[0]), np.hanning(image.shape[1])).astype(np.float32)
+    return image * window
+
+
+def phase_correlation_shift(reference_fft, image, downsample=1):
+    """
+    Estimate the translation of an image relative to a reference by phase correlation.
+
+    Parameters:
+    reference_fft (np.ndarray): np.fft.rfft2 of the prepared reference (see WellGrid).
+    image (np.ndarray): The image, same shape as the reference.
+    downsample (int): The factor the reference was downsampled by.
+
+    Returns:
+    tuple: The (dy, dx) shift in pixels such that image[y + dy, x + dx] corresponds to reference[y, x].
+    """
+    prepared = _prepare(image, downsample)
+    cross_power = np.fft.rfft2(prepared) * np.conj(reference_fft)
+    cross_power /= np.abs(cross_power) + 1e-12
+    correlation = np.fft.irfft2(cross_power, s=prepared.shape)
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    shift = [p - s if p > s // 2 else p for p, s in zip(peak, correlation.shape)]
+    return int(shift[0] * downsample), int(shift[1] * downsample)
+
+
+########### Grid ############
+class WellGrid:
+    """
+    The microwell grid of a field: the well boxes detected on a reference d3 frame, and the Fourier transform of
+    that frame to find the drift of later frames.
+    """
+
+    def __init__(self, boxes, shape, reference=None, downsample=1):
+        """
+        Parameters:
+        boxes (np.ndarray): The well boxes (see WELL_BOX_COLUMNS).
+        shape (tuple): The (height, width) of the field images.
+        reference (np.ndarray or None): The reference d3 frame; without it, shift() always returns (0, 0).
+        downsample (int): Factor the frames are downsampled by for the drift estimation; the drift is then only
+                          found to a multiple of this factor.
+        """
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 5)
+        self.shape = tuple(int(s) for s in shape)
+        self.downsample = int(downsample)
+        self.reference = reference
+        self._reference_fft = np.fft.rfft2(_prepare(reference, self.downsample)) if reference is not None else None
+        self._well_map = None
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __repr__(self):
+        return f"WellGrid({len(self)} wells, shape={self.shape})"
+
+    @classmethod
+    def detect(cls, image, downsample=1, **options):
+        """
+        Detect the grid on a d3 frame, which becomes the reference frame.
+
+        Parameters:
+        image (np.ndarray): The d3 frame.
+        downsample (int): See __init__.
+        options: Passed to detect_wells.
+
+        Returns:
+        WellGrid: The grid.
+        """
+        return cls(detect_wells(image, **options), image.shape, reference=image, downsample=downsample)
+
+    @property
+    def well_map(self):
+        """The well ID of every pixel of the reference frame (computed once)."""
+        if self._well_map is None:
+            self._well_map = well_map_from_boxes(self.boxes, self.shape)
+        return self._well_map
+
+    def shift(self, image):
+        """Return the (dy, dx) drift of a frame relative to the reference frame."""
+        if self._reference_fft is None or image.shape != self.shape:
+            return (0, 0)
+        return phase_correlation_shift(self._reference_fft, image, self.downsample)
+
+    def shifted_boxes(self, shift=(0, 0)):
+        """Return the well boxes moved by a (dy, dx) drift."""
+        boxes = self.boxes.copy()
+        boxes[:, 1] += shift[1]
+        boxes[:, 2] += shift[0]
+        return boxes
+
+    def assign(self, x, y, shift=(0, 0)):
+        """
+        Return the well of points of a frame (0 outside every well).
+
+        Parameters:
+        x, y (np.ndarray): Point coordinates in pixels of the frame.
+        shift (tuple): The (dy, dx) drift of the frame.
+
+        Returns:
+        np.ndarray: The well IDs.
+        """
+        rows = np.rint(np.asarray(y, dtype=float) - shift[0]).astype(int)
+        cols = np.rint(np.asarray(x, dtype=float) - shift[1]).astype(int)
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        wells = np.zeros(len(rows), dtype=int)
+        wells[inside] = self.well_map[rows[inside], cols[inside]]
+        return wells
+
+    def crop(self, image, shift=(0, 0)):
+        """
+        Yield (well, crop) for every well of a frame, the box clipped to the image.
+
+        Parameters:
+        image (np.ndarray): The frame (any channel).
+        shift (tuple): The (dy, dx) drift of the frame.
+        """
+        for well, x, y, width, height in self.shifted_boxes(shift):
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + width, image.shape[1]), min(y + height, image.shape[0])
+            if x1 > x0 and y1 > y0:
+                yield int(well), image[y0:y1, x0:x1]
+
+    def save(self, path):
+        """Save the grid as a compressed .npz file."""
+        arrays = {'boxes': self.boxes, 'shape': np.array(self.shape), 'downsample': np.array(self.downsample)}
+        if self.reference is not None:
+            arrays['reference'] = self.reference
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Written through a file object, since np.savez would append '.npz' to the temporary name
+        with atomic_write(path) as temp_path:
+            with open(temp_path, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Load a grid saved with save()."""
+        with np.load(path) as data:
+            reference = data['reference'] if 'reference' in data else None
+            return cls(data['boxes'], tuple(data['shape']), reference=reference, downsample=int(data['downsample']))
+
+
+########### Fields ############
+def _frame_files(folder):
+    return sorted(f for f in os.listdir(folder) if re.match(r'^p\d+.*\.(png|tif|tiff)$', f))
+
+
+def detect_field_wells(field, d3_dir, output_path=None, downsample=1, **options):
+    """
+    Detect the well grid of a field on its first d3 frame.
+
+    Parameters:
+    field (str): The field (e.g. 'f00').
+    d3_dir (str): The folder with the 'fNNd3_png' subfolders.
+    output_path (str or None): If given, the grid is saved there (.npz).
+    downsample (int): See WellGrid.
+    options: Passed to detect_wells.
+
+    Returns:
+    WellGrid: The grid.
+    """
+    import cv2
+
+    folder = os.path.join(d3_dir, f'{field}d3_png')
+    files = _frame_files(folder)
+    if not files:
+        raise FileNotFoundError(f"No d3 frames in {folder}")
+    grid = WellGrid.detect(cv2.imread(os.path.join(folder, files[0]), cv2.IMREAD_UNCHANGED),
+                           downsample=downsample, **options)
+    print(f"Detected {len(grid)} wells in field {field} on {files[0]}")
+    if output_path:
+        grid.save(output_path)
+    return grid
+
+
+def crop_field_wells(field, input_dir, output_dir, grid, channels=('d0', 'd1', 'd2', 'd3')):
+    """
+    Crop every well of every frame of a field, like the crop macros but with the grid detected once: the drift
+    of each frame is estimated on its d3 image and applied to all its channels.
+
+    Outputs are named like the macro outputs: output_dir/<channel folder>/pNN_0_fNNdK_well_WWWW.png.
+
+    Parameters:
+    field (str): The field (e.g. 'f00').
+    input_dir (str): The folder with the 'fNNd0', ..., 'fNNd3_png' subfolders.
+    output_dir (str): The folder to write the crops to.
+    grid (WellGrid): The grid of the field.
+    channels (tuple): The channels to crop.
+
+    Returns:
+    dict: {frame file name: (dy, dx) drift}.
+    """
+    import cv2
+    from ATTIICCpackage.cell_measurement import channel_image_name
+
+    folder_of = {c: f'{field}d3_png' if c == 'd3' else f'{field}{c}' for c in channels}
+    for channel in channels:
+        os.makedirs(os.path.join(output_dir, folder_of[channel]), exist_ok=True)
+
+    d3_folder = os.path.join(input_dir, f'{field}d3_png')
+    shifts = {}
+    for file_name in _frame_files(d3_folder):
+        name, ext = os.path.splitext(file_name)
+        shift = grid.shift(cv2.imread(os.path.join(d3_folder, file_name), cv2.IMREAD_UNCHANGED))
+        shifts[file_name] = shift
+        for channel in channels:
+            channel_name = channel_image_name(name, channel)
+            image = cv2.imread(os.path.join(input_dir, folder_of[channel], channel_name + ext), cv2.IMREAD_UNCHANGED)
+            if image is None:
+                continue
+            for well, crop in grid.crop(image, shift):
+                output_path = os.path.join(output_dir, folder_of[channel], f'{channel_name}_well_{well:04d}.png')
+                with atomic_write(output_path) as temp_path:
+                    cv2.imwrite(temp_path, crop)
+    print(f"Cropped {len(grid)} wells in {len(shifts)} frames of field {field}")
+    return shifts
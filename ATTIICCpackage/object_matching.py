@@ -51,3 +51,76 @@ def object_matching(data_frames, distance_threshold=50):
                         combined_df.loc[j, 'Group'] = group_name
 
     return combined_df
+
+
+def link_cells(previous_xy, current_xy, max_distance=50):
+    """
+    Links the cells of one frame to the cells of the previous frame by greedy nearest-neighbour matching:
+    the closest pairs are matched first and every cell is used at most once.
+
+    Args:
+    previous_xy (np.ndarray): (n_previous, 2) X, Y positions in the previous frame.
+    current_xy (np.ndarray): (n_current, 2) X, Y positions in the current frame.
+    max_distance (float): The maximum distance between two positions of the same cell.
+
+    Returns:
+    np.ndarray: For every current cell, the index of its match in the previous frame, or -1.
+    """
+    previous_xy = np.asarray(previous_xy, dtype=float).reshape(-1, 2)
+    current_xy = np.asarray(current_xy, dtype=float).reshape(-1, 2)
+    matches = np.full(len(current_xy), -1, dtype=np.int64)
+    if len(previous_xy) == 0 or len(current_xy) == 0:
+        return matches
+
+    # All pairwise distances; wells hold a handful of cells, so the dense matrix stays small
+    distances = np.hypot(current_xy[:, None, 0] - previous_xy[None, :, 0], current_xy[:, None, 1] - previous_xy[None, :, 1])
+    current_idx, previous_idx = np.nonzero(distances <= max_distance)
+    order = np.argsort(distances[current_idx, previous_idx], kind='stable')
+
+    used_previous = np.zeros(len(previous_xy), dtype=bool)
+    for i in order:
+        c, p = current_idx[i], previous_idx[i]
+        if matches[c] < 0 and not used_previous[p]:
+            matches[c] = p
+            used_previous[p] = True
+    return matches
+
+
+def track_cells(df, max_distance=50):
+    """
+    Assigns a 'track_id' to every cell by linking the cells of each well frame to frame with link_cells.
+    A cell without a match in the previous frame of its well starts a new track.
+
+    Args:
+    df (pandas.DataFrame): Cells with 'field', 'well', 'frame', 'X' and 'Y' columns.
+    max_distance (float): The maximum distance a cell moves between two frames.
+
+    Returns:
+    pandas.DataFrame: The data frame sorted by 'field', 'well' and 'frame', with a 'track_id' column
+                      (unique within the data frame).
+    """
+    df = df.sort_values(['field', 'well', 'frame'], kind='stable').reset_index(drop=True)
+    track_ids = np.empty(len(df), dtype=np.int64)
+    xy = df[['X', 'Y']].to_numpy(dtype=float)
+    next_track = 0
+
+    # Row ranges of every (field, well, frame), in order
+    keys = df[['field', 'well', 'frame']]
+    starts = np.flatnonzero(np.r_[True, (keys.iloc[1:].to_numpy() != keys.iloc[:-1].to_numpy()).any(axis=1)])
+    ends = np.r_[starts[1:], len(df)]
+    well_keys = df[['field', 'well']].to_numpy()
+
+    previous = None
+    for start, end in zip(starts, ends):
+        same_well = previous is not None and (well_keys[start] == well_keys[previous[0]]).all()
+        matches = link_cells(xy[previous[0]:previous[1]], xy[start:end], max_distance) if same_well else np.full(end - start, -1)
+        for i, match in enumerate(matches):
+            if match >= 0:
+                track_ids[start + i] = track_ids[previous[0] + match]
+            else:
+                track_ids[start + i] = next_track
+                next_track += 1
+        previous = (start, end)
+
+    df['track_id'] = track_ids
+    return df
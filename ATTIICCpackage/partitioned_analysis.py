@@ -0,0 +1,250 @@
+# partitioned_analysis.py
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from ATTIICCpackage.checkpoint import atomic_write, input_signature
+from ATTIICCpackage.util import index_channel_csv_files, load_indexed_channels, concatenate_csv_files
+from ATTIICCpackage.image_feature_analysis import classify_cell_types, correct_cell_types, process_classified_data
+from ATTIICCpackage.timeseries_store import WellTimeSeriesStore
+from ATTIICCpackage.object_matching import track_cells
+
+# Tables written for every partition and combined at the end, in the order they are produced
+PARTITION_TABLES = ['classified', 'cell_counts', 'trends', 'single_cell_speed', 'mean_speed', 'proximity']
+
+# Tables only written when requested (see analyze_partition); combined when every partition has them
+OPTIONAL_PARTITION_TABLES = ['killing_events']
+
+
+########### Partition markers ############
+def partition_params(thresholds_d0, thresholds_d1, thresholds_d2, area_threshold_d0, area_threshold_d1,
+                     frames_required=None, channels=('d0', 'd1', 'd2'), contact_distance=None):
+    """Return the analysis parameters of a partition as stored in its _done.json marker (JSON types only)."""
+    params = {'thresholds_d0': thresholds_d0, 'thresholds_d1': thresholds_d1, 'thresholds_d2': thresholds_d2,
+              'area_threshold_d0': area_threshold_d0, 'area_threshold_d1': area_threshold_d1,
+              'frames_required': None if frames_required is None else np.asarray(frames_required).tolist(),
+              'channels': list(channels), 'contact_distance': contact_distance}
+    # Round trip so numpy scalars and tuples compare equal to what is read back from the marker
+    return json.loads(json.dumps(params, default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o)))
+
+
+def partition_fingerprint(field_index):
+    """
+    Return a checksum of the inputs of a partition: the name, size and modification time of every CSV file, or
+    the content of an already merged table.
+
+    Parameters:
+    field_index (dict or pd.DataFrame): {channel: [csv paths]} of the field, or the merged table of the field.
+
+    Returns:
+    str: The hex digest.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    if isinstance(field_index, pd.DataFrame):
+        digest.update(','.join(map(str, field_index.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(field_index, index=False).to_numpy().tobytes())
+    else:
+        for channel in sorted(field_index):
+            for path in field_index[channel]:
+                signature = input_signature(path)
+                digest.update(f"{channel}|{path}|{signature['size']}|{signature['mtime_ns']}\n".encode())
+    return digest.hexdigest()
+
+
+def read_partition_marker(partition_dir):
+    """Return the _done.json marker of a partition, or None if the partition was not completed."""
+    try:
+        with open(os.path.join(partition_dir, '_done.json')) as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Markers of older runs hold no parameters and are treated as incomplete
+    return marker if isinstance(marker, dict) and 'summary' in marker else None
+
+
+########### Per-partition stages ############
+def analyze_partition(df, partition_dir, thresholds_d0, thresholds_d1, thresholds_d2,
+                      area_threshold_d0, area_threshold_d1, frames_required=None, contact_distance=None):
+    """
+    Run classification, cell counts, trends, moving speed, proximity and optionally killing events on one
+    partition and spill every result table to partition_dir.
+
+    Parameters:
+    df (pd.DataFrame): The merged per-cell table of the partition, as returned by load_indexed_channels.
+    partition_dir (str): The directory where the partition tables are written.
+    thresholds_d0, thresholds_d1, thresholds_d2 (float): Intensity thresholds passed to classify_cell_types.
+    area_threshold_d0, area_threshold_d1 (float): Area thresholds passed to correct_cell_types.
+    frames_required (list or None): The frames every well should contain. If None, the frames of the partition.
+    contact_distance (float or None): If given, the cells are tracked (unless they have a 'track_id') and the
+                                      killing events of detect_killing_events are written with this contact
+                                      distance.
+
+    Returns:
+    dict: Per-partition aggregates (number of cells, wells, cells of each type, E-T pairs and, with
+          contact_distance, target tracks and killed targets).
+    """
+    os.makedirs(partition_dir, exist_ok=True)
+    paths = {name: os.path.join(partition_dir, f"{name}.csv") for name in PARTITION_TABLES + OPTIONAL_PARTITION_TABLES}
+
+    # Classification; correct_cell_types and process_classified_data both save, the second write wins
+    df = classify_cell_types(df, thresholds_d0, thresholds_d1, thresholds_d2)
+    df = correct_cell_types(df, area_threshold_d0, area_threshold_d1, paths['classified'])
+    df = process_classified_data(df, paths['classified'])
+    if contact_distance is not None and 'track_id' not in df.columns:
+        df = track_cells(df)
+
+    # All remaining analyses run on the array store of the partition; like fill_missing_frames, every frame is
+    # present in every well, with a count of 0 where the well has no cells, so the trends see those frames too
+    store = WellTimeSeriesStore.from_dataframe(df)
+    del df
+    frames = store.frames if frames_required is None else np.asarray(frames_required)
+    store = store.fill_frames(frames)
+
+    counts = store.counts[:, pd.Index(store.frames).get_indexer(frames)]
+    pd.DataFrame({'field': np.repeat(store.fields, len(frames)), 'well': np.repeat(store.wells, len(frames)),
+                  'frame': np.tile(frames, store.n_wells), 'cell_count': counts.ravel()}).to_csv(paths['cell_counts'], index=False)
+
+    store.trends(frames_required).to_csv(paths['trends'], index=False)
+
+    df_single_cells, df_mean_moving = store.moving_speed()
+    df_single_cells.to_csv(paths['single_cell_speed'], index=False)
+    df_mean_moving.to_csv(paths['mean_speed'], index=False)
+
+    df_proximity = store.proximity()
+    df_proximity.to_csv(paths['proximity'], index=False)
+
+    cell_types, type_counts = np.unique(np.asarray(store.columns['cell_type']), return_counts=True)
+    summary = {'n_cells': store.n_cells, 'n_wells': store.n_wells, 'n_E_T_pairs': len(df_proximity)}
+    summary.update({f'n_{cell_type}': int(n) for cell_type, n in zip(cell_types, type_counts)})
+
+    if contact_distance is not None:
+        df_events = store.killing_events(contact_distance)
+        df_events.to_csv(paths['killing_events'], index=False)
+        summary.update({'n_target_tracks': len(df_events), 'n_killed': int(df_events['killed'].sum())})
+    return summary
+
+
+def process_partition(field, field_index, work_dir, thresholds_d0, thresholds_d1, thresholds_d2,
+                      area_threshold_d0, area_threshold_d1, frames_required=None,
+                      channels=('d0', 'd1', 'd2'), max_workers=None, contact_distance=None):
+    """
+    Load one field, analyze it with analyze_partition and mark the partition as completed.
+
+    Parameters:
+    field (str): The field to process (e.g. 'f00').
+    field_index (dict or pd.DataFrame): {channel: [csv paths]} of the field, from index_channel_csv_files, or the
+                                        already merged table of the field (e.g. from measure_field).
+    work_dir (str): The directory holding the 'partitions' folder.
+    The remaining parameters are passed to analyze_partition and load_indexed_channels.
+
+    Returns:
+    dict: The partition summary, saved with the parameters and the input fingerprint of the partition as
+          work_dir/partitions/<field>/_done.json.
+    """
+    partition_dir = os.path.join(work_dir, 'partitions', field)
+    params = partition_params(thresholds_d0, thresholds_d1, thresholds_d2, area_threshold_d0, area_threshold_d1,
+                              frames_required, channels, contact_distance)
+    inputs = partition_fingerprint(field_index)
+    if isinstance(field_index, pd.DataFrame):
+        df = field_index
+    else:
+        df = load_indexed_channels({field: field_index}, channels, max_workers)
+    summary = analyze_partition(df, partition_dir, thresholds_d0, thresholds_d1, thresholds_d2,
+                                area_threshold_d0, area_threshold_d1, frames_required, contact_distance)
+    del df
+    summary = {'field': field, **summary}
+
+    # The marker is written last, so an interrupted partition is redone on the next run
+    with atomic_write(os.path.join(partition_dir, '_done.json')) as temp_path:
+        with open(temp_path, 'w') as f:
+            json.dump({'summary': summary, 'params': params, 'inputs': inputs}, f)
+    print(f"Finished partition: {field}")
+    return summary
+
+
+def combine_partitions(work_dir, fields):
+    """
+    Stream the tables of the given partitions into one CSV per table in work_dir and write the per-field
+    summary (read back from the partition markers) to work_dir/summary.csv.
+
+    Parameters:
+    work_dir (str): The directory holding the 'partitions' folder.
+    fields (list): The fields to combine, in output order.
+
+    Returns:
+    pd.DataFrame: The per-field summary.
+    """
+    partition_dirs = [os.path.join(work_dir, 'partitions', field) for field in fields]
+
+    # Combine the per-field tables without loading them all at once
+    for name in PARTITION_TABLES:
+        output_csv_path = os.path.join(work_dir, f"{name}.csv")
+        concatenate_csv_files([os.path.join(d, f"{name}.csv") for d in partition_dirs], output_csv_path)
+        print(f"Combined {name} tables into {output_csv_path}")
+    for name in OPTIONAL_PARTITION_TABLES:
+        csv_paths = [os.path.join(d, f"{name}.csv") for d in partition_dirs]
+        if csv_paths and all(os.path.exists(path) for path in csv_paths):
+            concatenate_csv_files(csv_paths, os.path.join(work_dir, f"{name}.csv"))
+            print(f"Combined {name} tables into {os.path.join(work_dir, f'{name}.csv')}")
+
+    summaries = []
+    for partition_dir in partition_dirs:
+        marker = read_partition_marker(partition_dir)
+        if marker is None:
+            raise FileNotFoundError(f"Partition {partition_dir} has no valid _done.json marker")
+        summaries.append(marker['summary'])
+    df_summary = pd.DataFrame(summaries).fillna(0)
+    df_summary.to_csv(os.path.join(work_dir, 'summary.csv'), index=False)
+    return df_summary
+
+
+########### Partitioned run ############
+def run_partitioned_analysis(folder_path, work_dir, thresholds_d0, thresholds_d1, thresholds_d2,
+                             area_threshold_d0, area_threshold_d1, frames_required=None,
+                             channels=('d0', 'd1', 'd2'), fields=None, max_workers=None, resume=True,
+                             contact_distance=None):
+    """
+    Run the analysis one field at a time so the whole experiment never has to fit in memory.
+    Every field is loaded, classified and analyzed on its own, its tables are spilled to
+    work_dir/partitions/<field>/, and at the end the partition tables are streamed into one CSV per table
+    in work_dir together with a per-field summary. Peak memory is bounded by the largest field.
+
+    Parameters:
+    folder_path (str): The root folder path containing the 'fNNd0', 'fNNd1', ... measurement subfolders.
+    work_dir (str): The directory for the partition tables and the combined results.
+    thresholds_d0, thresholds_d1, thresholds_d2 (float): Intensity thresholds passed to classify_cell_types.
+    area_threshold_d0, area_threshold_d1 (float): Area thresholds passed to correct_cell_types.
+    frames_required (list or None): The frames every well should contain. Pass it to get the same frames in every
+                                    field; if None, every field uses the frames found in its own data.
+    channels (tuple): The channel suffixes to load.
+    fields (list or None): Only process these fields. If None, all fields found under folder_path.
+    max_workers (int or None): Number of CSV reader threads per partition.
+    resume (bool): Skip fields whose partition was completed by a previous run with the same parameters and
+                   unchanged input files.
+    contact_distance (float or None): If given, also detect the killing events (see analyze_partition).
+
+    Returns:
+    pd.DataFrame: The per-field summary, also saved as work_dir/summary.csv.
+    """
+    # One walk of the tree for the whole run, each partition then only reads its own files
+    index = index_channel_csv_files(folder_path, channels)
+    if fields is not None:
+        index = {field: index[field] for field in fields if field in index}
+
+    params = partition_params(thresholds_d0, thresholds_d1, thresholds_d2, area_threshold_d0, area_threshold_d1,
+                              frames_required, channels, contact_distance)
+    for field in sorted(index):
+        marker = read_partition_marker(os.path.join(work_dir, 'partitions', field)) if resume else None
+        if marker is not None:
+            if marker['params'] == params and marker['inputs'] == partition_fingerprint(index[field]):
+                print(f"Skipping completed partition: {field}")
+                continue
+            print(f"Redoing partition {field}: its parameters or input files changed")
+        process_partition(field, index[field], work_dir, thresholds_d0, thresholds_d1, thresholds_d2,
+                          area_threshold_d0, area_threshold_d1, frames_required, channels, max_workers,
+                          contact_distance)
+
+    return combine_partitions(work_dir, sorted(index))
@@ -0,0 +1,438 @@
+# pipeline.py
+#
+# Stage DAG runner for the ATTIICC workflow with per-field incremental recomputation.
+#
+# Usage: python -m ATTIICCpackage.pipeline config.json [--fields f00 f01] [--workers 4] [--force] [--dry-run]
+#                                          [--report run_report.json] [--profile-dir profiles] [--log-level INFO]
+
+import os
+import re
+import json
+import hashlib
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ATTIICCpackage import instrumentation
+
+# Fields are the 'fNN' prefixes of the channel folders ('f00d0', 'f00d3_png', ...)
+FIELD_FOLDER_PATTERN = re.compile(r'^(f\d+)d\d')
+
+
+########### Fingerprints ############
+def path_fingerprint(path):
+    """
+    Cheap fingerprint of a file or directory tree: relative names, sizes and modification times.
+
+    Parameters:
+    path (str): The file or directory.
+
+    Returns:
+    str: A hex digest, or 'missing' if the path does not exist.
+    """
+    if not os.path.exists(path):
+        return 'missing'
+    digest = hashlib.sha1()
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(files):
+            stat = os.stat(os.path.join(root, file_name))
+            relative_path = os.path.relpath(os.path.join(root, file_name), path)
+            digest.update(f"{relative_path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def discover_fields(folder_path):
+    """
+    List the fields of an experiment from the names of its channel folders.
+
+    Parameters:
+    folder_path (str): A folder containing 'fNNd0', 'fNNd1', ... subfolders.
+
+    Returns:
+    list: The sorted field names (e.g. ['f00', 'f01']).
+    """
+    fields = set()
+    for entry in os.scandir(folder_path):
+        match = FIELD_FOLDER_PATTERN.match(entry.name)
+        if entry.is_dir() and match:
+            fields.add(match.group(1))
+    return sorted(fields)
+
+
+########### Stages and pipeline ############
+class Stage:
+    """
+    One step of the pipeline.
+
+    A per-field stage is called as func(field) and its inputs and outputs are functions of the field; a global
+    stage (per_field=False) runs once after every field, is called as func(fields) and its inputs and outputs
+    are functions of the list of fields. 'params' are the settings that change the result of the stage; they are
+    part of its fingerprint together with the inputs and the fingerprints of the stages it depends on.
+    """
+
+    def __init__(self, name, func, inputs, outputs, params=None, depends_on=(), per_field=True):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params or {}
+        self.depends_on = list(depends_on)
+        self.per_field = per_field
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, depends_on={self.depends_on}, per_field={self.per_field})"
+
+
+class Pipeline:
+    """
+    A DAG of stages. The fingerprint of every (stage, field) that completed is kept in a JSON state file, and a
+    run only executes the stages and fields whose fingerprint changed or whose outputs are missing. The
+    per-field stages of independent fields run concurrently.
+    """
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.stages = {}
+        self._lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+
+    def add_stage(self, stage):
+        if stage.name in self.stages:
+            raise ValueError(f"Duplicate stage name: {stage.name}")
+        self.stages[stage.name] = stage
+        return stage
+
+    def topological_order(self):
+        """Return the stages sorted so that every stage comes after the stages it depends on."""
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle in the pipeline at stage {name}")
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage: {name}")
+            visiting.add(name)
+            for dependency in self.stages[name].depends_on:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+            order.append(self.stages[name])
+
+        for name in self.stages:
+            visit(name)
+
+        for stage in order:
+            if stage.per_field and any(not self.stages[d].per_field for d in stage.depends_on):
+                raise ValueError(f"Per-field stage {stage.name} cannot depend on a global stage")
+        return order
+
+    def fingerprint(self, stage, key, fields):
+        """Fingerprint of a stage for one field (key=field) or for the whole run (key='*')."""
+        inputs = stage.inputs(key) if stage.per_field else stage.inputs(fields)
+        upstream = {}
+        for dependency in stage.depends_on:
+            recorded = self.state.get(dependency, {})
+            upstream[dependency] = recorded.get(key) if stage.per_field else [recorded.get(f) for f in fields]
+        payload = json.dumps({'params': stage.params, 'inputs': {p: path_fingerprint(p) for p in inputs},
+                              'upstream': upstream}, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def is_up_to_date(self, stage, key, fields):
+        outputs = stage.outputs(key) if stage.per_field else stage.outputs(fields)
+        if not all(os.path.exists(p) for p in outputs):
+            return False
+        return self.state.get(stage.name, {}).get(key) == self.fingerprint(stage, key, fields)
+
+    def save(self):
+        """Write the state file atomically."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.state_path)
+
+    def _record(self, stage, key, fingerprint):
+        with self._lock:
+            self.state.setdefault(stage.name, {})[key] = fingerprint
+            # Written after every completed stage, so a crash keeps the progress made so far
+            self.save()
+
+    def _run_stage(self, stage, key, fields, force, dry_run):
+        if not force and self.is_up_to_date(stage, key, fields):
+            print(f"Up to date: {stage.name} [{key}]")
+            return False
+        print(f"{'Would run' if dry_run else 'Running'}: {stage.name} [{key}]")
+        if dry_run:
+            return True
+        # Fingerprint the inputs as they were when the stage started
+        fingerprint = self.fingerprint(stage, key, fields)
+        with instrumentation.stage(stage.name) as timer:
+            stage.func(key if stage.per_field else fields)
+            timer.add(1 if stage.per_field else len(fields))
+        self._record(stage, key, fingerprint)
+        return True
+
+    def _run_field(self, field, per_field_stages, fields, force, dry_run):
+        ran = []
+        for stage in per_field_stages:
+            # Once a stage reruns, the stages that depend on it rerun for this field as well
+            upstream_ran = any(d in ran for d in stage.depends_on)
+            if self._run_stage(stage, field, fields, force or upstream_ran, dry_run):
+                ran.append(stage.name)
+        return ran
+
+    def run(self, fields, max_workers=None, force=False, stages=None, dry_run=False):
+        """
+        Run the pipeline for the given fields.
+
+        Parameters:
+        fields (list): The fields to process.
+        max_workers (int or None): Number of fields processed concurrently.
+        force (bool): Rerun every stage regardless of the recorded fingerprints.
+        stages (list or None): Only consider these stages; the others are left as they are.
+        dry_run (bool): Only print what would run.
+
+        Returns:
+        dict: {stage name: list of fields (or ['*'] for global stages) that ran}.
+        """
+        order = [s for s in self.topological_order() if stages is None or s.name in stages]
+        per_field_stages = [s for s in order if s.per_field]
+        global_stages = [s for s in order if not s.per_field]
+        fields = sorted(fields)
+
+        ran = {stage.name: [] for stage in order}
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {field: executor.submit(self._run_field, field, per_field_stages, fields, force, dry_run)
+                       for field in fields}
+            for field, future in futures.items():
+                try:
+                    for name in future.result():
+                        ran[name].append(field)
+                except Exception as e:
+                    errors[field] = e
+                    print(f"Failed field {field}: {e!r}")
+
+        if errors:
+            raise RuntimeError(f"Pipeline failed for fields {sorted(errors)}; completed stages are kept") from next(iter(errors.values()))
+
+        for stage in global_stages:
+            upstream_ran = any(ran.get(d) for d in stage.depends_on)
+            if self._run_stage(stage, '*', fields, force or upstream_ran, dry_run):
+                ran[stage.name].append('*')
+        return ran
+
+
+########### Default ATTIICC pipeline ############
+def build_default_pipeline(config, state_path=None):
+    """
+    Build the standard pipeline from a configuration dictionary:
+
+    background        (per field) process_images_bg on input_dir/fNNd0..d2 -> work_dir/background/fNNd0..d2
+    segmentation      (per field) seg_subfolder on seg_input_dir/fNNd3_png -> work_dir/segmentation/fNNd3_png
+    wells             (per field) detect the microwell grid on the first d3 frame -> work_dir/wells/fNN.npz
+    measurement       (per field) measure_field on the background and segmentation outputs (wells assigned with
+                                  the grid of the wells stage, if any) -> work_dir/measurements/fNN.csv
+    merge_measurements (global)   concatenate the field measurements -> work_dir/measurements.csv
+    analysis          (per field) classify and analyze the measurements of the field (the CSVs of the ImageJ
+                                  macros in measurement_dir, or the measurement stage output)
+                                  -> work_dir/analysis/partitions/fNN
+    combine           (global)    combine the field tables -> work_dir/analysis/*.csv
+
+    Stages whose settings are missing from the configuration are left out. Additional stages can be added to
+    the returned pipeline with add_stage.
+
+    Parameters:
+    config (dict): 'work_dir' plus, for background: 'input_dir', 'sigma_d0', 'sigma_d1', 'sigma_d2';
+                   for segmentation: 'model_path' and optionally 'seg_input_dir' (defaults to input_dir);
+                   for wells: 'detect_wells': true and optionally 'well_detection' (options of detect_wells);
+                   for measurement: 'measure': true (reads the background and segmentation stage outputs);
+                   for analysis: 'measurement_dir' (unless measured in Python), 'thresholds_d0', 'thresholds_d1',
+                   'thresholds_d2', 'area_threshold_d0', 'area_threshold_d1' and optionally 'frames_required' and
+                   'contact_distance' (to detect killing events).
+    state_path (str or None): The pipeline state file. Defaults to work_dir/pipeline_state.json.
+
+    Returns:
+    Pipeline: The pipeline.
+    """
+    work_dir = config['work_dir']
+    pipeline = Pipeline(state_path or os.path.join(work_dir, 'pipeline_state.json'))
+    channels = tuple(config.get('channels', ('d0', 'd1', 'd2')))
+
+    if 'sigma_d0' in config:
+        def background(field):
+            from ATTIICCpackage.image_preprocessing import process_images_bg
+            for channel in ('d0', 'd1', 'd2'):
+                process_images_bg(os.path.join(config['input_dir'], f'{field}{channel}'),
+                                  os.path.join(work_dir, 'background', f'{field}{channel}'),
+                                  config['sigma_d0'], config['sigma_d1'], config['sigma_d2'])
+
+        pipeline.add_stage(Stage(
+            'background', background,
+            inputs=lambda field: [os.path.join(config['input_dir'], f'{field}{c}') for c in ('d0', 'd1', 'd2')],
+            outputs=lambda field: [os.path.join(work_dir, 'background', f'{field}{c}') for c in ('d0', 'd1', 'd2')],
+            params={k: config[k] for k in ('sigma_d0', 'sigma_d1', 'sigma_d2')}))
+
+    seg_input_dir = config.get('seg_input_dir', config.get('input_dir'))
+    if 'model_path' in config:
+        def segmentation(field):
+            from ATTIICCpackage.cell_segmentation_cp import seg_subfolder
+            seg_subfolder(config['model_path'], os.path.join(seg_input_dir, f'{field}d3_png'),
+                          os.path.join(work_dir, 'segmentation', f'{field}d3_png'))
+
+        pipeline.add_stage(Stage(
+            'segmentation', segmentation,
+            inputs=lambda field: [os.path.join(seg_input_dir, f'{field}d3_png'), config['model_path']],
+            outputs=lambda field: [os.path.join(work_dir, 'segmentation', f'{field}d3_png')],
+            params={'model_path': config['model_path']}))
+
+    wells_dir = os.path.join(work_dir, 'wells')
+    if config.get('detect_wells'):
+        well_options = config.get('well_detection', {})
+
+        def wells(field):
+            from ATTIICCpackage.microwells import detect_field_wells
+            detect_field_wells(field, seg_input_dir, os.path.join(wells_dir, f'{field}.npz'), **well_options)
+
+        pipeline.add_stage(Stage(
+            'wells', wells,
+            inputs=lambda field: [os.path.join(seg_input_dir, f'{field}d3_png')],
+            outputs=lambda field: [os.path.join(wells_dir, f'{field}.npz')],
+            params=well_options))
+
+    measurements_dir = os.path.join(work_dir, 'measurements')
+    if config.get('measure'):
+        from ATTIICCpackage.checkpoint import atomic_write
+        from ATTIICCpackage.util import concatenate_csv_files
+
+        def measurement(field):
+            from ATTIICCpackage.cell_measurement import measure_field
+            grid = None
+            if 'wells' in pipeline.stages:
+                from ATTIICCpackage.microwells import WellGrid
+                grid = WellGrid.load(os.path.join(wells_dir, f'{field}.npz'))
+            df = measure_field(field, os.path.join(work_dir, 'background'), os.path.join(work_dir, 'segmentation'),
+                               channels=channels, grid=grid, d3_dir=seg_input_dir)
+            os.makedirs(measurements_dir, exist_ok=True)
+            output_path = os.path.join(measurements_dir, f'{field}.csv')
+            with atomic_write(output_path) as temp_path:
+                df.to_csv(temp_path, index=False)
+
+        pipeline.add_stage(Stage(
+            'measurement', measurement,
+            inputs=lambda field: [],
+            outputs=lambda field: [os.path.join(measurements_dir, f'{field}.csv')],
+            params={'channels': channels},
+            depends_on=[name for name in ('background', 'segmentation', 'wells') if name in pipeline.stages]))
+
+        pipeline.add_stage(Stage(
+            'merge_measurements',
+            lambda fields: concatenate_csv_files([os.path.join(measurements_dir, f'{f}.csv') for f in fields],
+                                                 os.path.join(work_dir, 'measurements.csv')),
+            inputs=lambda fields: [],
+            outputs=lambda fields: [os.path.join(work_dir, 'measurements.csv')],
+            depends_on=['measurement'], per_field=False))
+
+    if 'measurement_dir' in config or config.get('measure'):
+        import pandas as pd
+        from ATTIICCpackage.partitioned_analysis import process_partition, combine_partitions
+
+        measurement_dir = config.get('measurement_dir')
+        analysis_dir = os.path.join(work_dir, 'analysis')
+        analysis_params = {k: config[k] for k in ('thresholds_d0', 'thresholds_d1', 'thresholds_d2',
+                                                  'area_threshold_d0', 'area_threshold_d1')}
+        analysis_params['frames_required'] = config.get('frames_required')
+        if config.get('contact_distance') is not None:
+            analysis_params['contact_distance'] = config['contact_distance']
+
+        def analysis(field):
+            if measurement_dir is None:
+                field_index = pd.read_csv(os.path.join(measurements_dir, f'{field}.csv'))
+            else:
+                field_index = {c: sorted(os.path.join(measurement_dir, f'{field}{c}', f)
+                                         for f in os.listdir(os.path.join(measurement_dir, f'{field}{c}'))
+                                         if f.endswith('.csv'))
+                               for c in channels}
+            process_partition(field, field_index, analysis_dir, channels=channels, **analysis_params)
+
+        if measurement_dir is None:
+            analysis_inputs = lambda field: [os.path.join(measurements_dir, f'{field}.csv')]
+        else:
+            analysis_inputs = lambda field: [os.path.join(measurement_dir, f'{field}{c}') for c in channels]
+        pipeline.add_stage(Stage(
+            'analysis', analysis,
+            inputs=analysis_inputs,
+            outputs=lambda field: [os.path.join(analysis_dir, 'partitions', field, '_done.json')],
+            params=analysis_params, depends_on=['measurement'] if measurement_dir is None else ()))
+
+        pipeline.add_stage(Stage(
+            'combine', lambda fields: combine_partitions(analysis_dir, fields),
+            inputs=lambda fields: [],
+            outputs=lambda fields: [os.path.join(analysis_dir, 'summary.csv')],
+            depends_on=['analysis'], per_field=False))
+
+    return pipeline
+
+
+def run_pipeline(config, fields=None, max_workers=None, force=False, stages=None, dry_run=False):
+    """
+    Build the default pipeline from config and run it.
+
+    Parameters:
+    config (dict): See build_default_pipeline.
+    fields (list or None): The fields to process. If None, the fields found in input_dir (or measurement_dir).
+    max_workers, force, stages, dry_run: See Pipeline.run.
+
+    Returns:
+    dict: {stage name: list of fields that ran}.
+    """
+    pipeline = build_default_pipeline(config)
+    if fields is None:
+        fields = discover_fields(config.get('input_dir') or config['measurement_dir'])
+    return pipeline.run(fields, max_workers=max_workers, force=force, stages=stages, dry_run=dry_run)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the ATTIICC pipeline, recomputing only what changed.")
+    parser.add_argument('config', help="JSON configuration file (see build_default_pipeline)")
+    parser.add_argument('--fields', nargs='+', help="only process these fields (e.g. f00 f01)")
+    parser.add_argument('--stages', nargs='+', help="only consider these stages")
+    parser.add_argument('--workers', type=int, default=None, help="number of fields processed concurrently")
+    parser.add_argument('--force', action='store_true', help="rerun every stage")
+    parser.add_argument('--dry-run', action='store_true', help="only print what would run")
+    parser.add_argument('--report', help="write a JSON report with the time, items/s and peak memory of every stage")
+    parser.add_argument('--profile-dir', help="also profile the stages with cProfile into this folder")
+    parser.add_argument('--log-level', default='WARNING', help="level of the 'ATTIICCpackage' logger (e.g. INFO, DEBUG)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    instrumentation.logger.setLevel(args.log_level.upper())
+    if args.report or args.profile_dir:
+        instrumentation.enable(profile_dir=args.profile_dir)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    try:
+        ran = run_pipeline(config, fields=args.fields, max_workers=args.workers, force=args.force,
+                           stages=args.stages, dry_run=args.dry_run)
+    finally:
+        if args.report:
+            instrumentation.disable()
+            instrumentation.write_report(args.report)
+    for name, keys in ran.items():
+        print(f"{name}: {len(keys)} run(s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+# qc_montage.py
+#
+# Headless QC montages of segmentation results: images and masks are downsampled, composed into one array and
+# written as PNG/JPEG by a background thread, so QC output never holds up segmentation.
+#
+# Usage:
+#     with MontageWriter() as writer:
+#         segmented_images = seg_subfolder(model_path, input_subfolder, output_subfolder)
+#         writer.submit(segmented_images, 'qc/f00d3_png_montage.png')
+
+import os
+import queue
+import threading
+import numpy as np
+
+from ATTIICCpackage.checkpoint import atomic_write
+from ATTIICCpackage.instrumentation import logger, stage
+
+
+########### Tiles ############
+def downsample(image, factor, method='area'):
+    """
+    Shrink an image by an integer factor.
+
+    Parameters:
+    image (np.ndarray): The image (2D, or 3D with channels last).
+    factor (int): The downsampling factor.
+    method (str): 'area' averages every factor x factor block (smooth, for intensity images); 'stride' keeps every
+                  factor-th pixel (fastest, and keeps label values intact for masks).
+
+    Returns:
+    np.ndarray: The downsampled image.
+    """
+    factor = max(int(factor), 1)
+    if factor == 1:
+        return image
+    if method == 'stride':
+        return image[::factor, ::factor]
+    if method != 'area':
+        raise ValueError(f"Unknown downsampling method: {method}")
+    # Average whole blocks only; the incomplete blocks at the bottom and right edges are dropped
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:height * factor, :width * factor].reshape((height, factor, width, factor) + image.shape[2:])
+    return blocks.mean(axis=(1, 3))
+
+
+def to_uint8(image, percentiles=(1, 99.8)):
+    """Scale an intensity image to 8 bits between two of its percentiles (like an auto contrast)."""
+    image = np.asarray(image, dtype=np.float32)
+    low, high = np.percentile(image, percentiles) if image.size else (0, 0)
+    if high <= low:
+        high = low + 1
+    return (np.clip((image - low) / (high - low), 0, 1) * 255).astype(np.uint8)
+
+
+def label_colors(mask, seed=0):
+    """Color a label image: background black, every label a fixed random color. Returns an (h, w, 3) uint8 array."""
+    mask = np.asarray(mask)
+    if mask.ndim == 3:
+        mask = mask[..., 0]
+    palette = np.random.default_rng(seed).integers(64, 256, size=(256, 3), dtype=np.uint8)
+    palette[0] = 0
+    # Labels above 255 reuse the palette; 0 keeps mapping to black
+    return palette[np.where(mask > 0, (mask.astype(np.int64) - 1) % 255 + 1, 0)]
+
+
+def _tile(image, tile_size, method):
+    factor = int(np.ceil(max(image.shape[:2]) / tile_size))
+    tile = downsample(image, factor, method)
+    # Pad to a square tile so tiles of different shapes line up
+    canvas = np.zeros((tile_size, tile_size) + tile.shape[2:], dtype=tile.dtype)
+    canvas[:tile.shape[0], :tile.shape[1]] = tile[:tile_size, :tile_size]
+    return canvas
+
+
+########### Montage ############
+def compose_montage(segmented_images, n_images=16, tile_size=128, columns=8, method='area', spacing=2):
+    """
+    Compose images and their masks into one RGB montage: the images fill the top rows and their masks the rows
+    below in the same order, like display_images_with_masks.
+
+    Parameters:
+    segmented_images (list): (image, mask, file_name) tuples, as returned by seg_subfolder.
+    n_images (int): The maximum number of images shown.
+    tile_size (int): The size of one square tile in pixels; images are downsampled by an integer factor to fit.
+    columns (int): The number of tiles per row.
+    method (str): The downsampling of the images, 'area' or 'stride' (masks are always strided).
+    spacing (int): The gap between tiles in pixels.
+
+    Returns:
+    np.ndarray: The (height, width, 3) uint8 montage.
+    """
+    items = list(segmented_images)[:n_images]
+    columns = max(min(columns, len(items)), 1)
+    rows = -(-len(items) // columns)
+    step = tile_size + spacing
+    montage = np.zeros((2 * rows * step + spacing, columns * step + spacing, 3), dtype=np.uint8)
+
+    for i, (image, mask, _) in enumerate(items):
+        image = np.asarray(image)
+        if image.ndim == 3 and image.shape[2] > 3:
+            image = image[..., :3]
+        image_tile = to_uint8(_tile(image, tile_size, method))
+        if image_tile.ndim == 2:
+            image_tile = np.repeat(image_tile[..., None], 3, axis=2)
+        mask_tile = label_colors(_tile(np.asarray(mask), tile_size, 'stride'))
+
+        row, column = divmod(i, columns)
+        x = spacing + column * step
+        y = spacing + row * step
+        montage[y:y + tile_size, x:x + tile_size] = image_tile
+        y += rows * step
+        montage[y:y + tile_size, x:x + tile_size] = mask_tile
+    return montage
+
+
+def write_montage(montage, output_path, jpeg_quality=90):
+    """
+    Write a montage atomically; the format follows the extension ('.png', '.jpg' or '.jpeg').
+
+    Parameters:
+    montage (np.ndarray): The RGB montage from compose_montage.
+    output_path (str): The output image path.
+    jpeg_quality (int): The JPEG quality, 0-100.
+    """
+    import cv2
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if output_path.lower().endswith(('.jpg', '.jpeg')) else []
+    with atomic_write(output_path) as temp_path:
+        if not cv2.imwrite(temp_path, montage[..., ::-1], params):
+            raise OSError(f"Could not write {output_path}")
+
+
+class MontageWriter:
+    """
+    Composes and writes QC montages on a background thread. submit() only queues the work, so the caller goes
+    on with the next subfolder; close() (or leaving the with block) waits for the queued montages. A montage that
+    fails is logged and skipped, it never stops the run.
+    """
+
+    def __init__(self, max_pending=4, **montage_options):
+        """
+        Parameters:
+        max_pending (int): The number of montages that can wait in the queue; submit() blocks when it is full, which
+                           bounds the memory held by queued images.
+        montage_options: Passed to compose_montage (n_images, tile_size, columns, method, spacing).
+        """
+        self.montage_options = montage_options
+        self.written = []
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='attiicc-qc-montage', daemon=True)
+        self._thread.start()
+
+    def submit(self, segmented_images, output_path):
+        """
+        Queue a montage of segmented_images to be written to output_path.
+
+        Parameters:
+        segmented_images (list): (image, mask, file_name) tuples, as returned by seg_subfolder.
+        output_path (str): The output image path ('.png', '.jpg' or '.jpeg').
+        """
+        if not self._thread.is_alive():
+            raise RuntimeError("The montage writer is closed")
+        # Only the images shown are kept alive until the montage is written
+        n_images = self.montage_options.get('n_images', 16)
+        self._queue.put((list(segmented_images)[:n_images], output_path))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                segmented_images, output_path = job
+                with stage('qc_montage') as timer:
+                    write_montage(compose_montage(segmented_images, **self.montage_options), output_path)
+                    timer.add()
+                self.written.append(output_path)
+                logger.info("QC montage written to %s", output_path)
+            except Exception:
+                logger.exception("Could not write QC montage %s", job[1])
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """Write the queued montages and stop the thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
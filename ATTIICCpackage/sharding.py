@@ -0,0 +1,211 @@
+# sharding.py
+#
+# Run the per-field stages of the pipeline split over several local processes (or nodes sharing a directory),
+# then merge their results into the same outputs as a single run.
+#
+# Usage: python -m ATTIICCpackage.sharding launch config.json --shards 4
+#        python -m ATTIICCpackage.sharding run config.json --shard 0 --shards 4
+#        python -m ATTIICCpackage.sharding merge config.json --shards 4
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+from ATTIICCpackage.pipeline import build_default_pipeline, discover_fields
+
+
+########### Shard assignment ############
+def assign_shards(fields, n_shards):
+    """
+    Split fields over shards, dealing the sorted fields out in turn. The split only depends on the list of fields,
+    so every shard computes the same one without communicating, and shard sizes differ by at most one field.
+
+    Parameters:
+    fields (list): The fields.
+    n_shards (int): The number of shards.
+
+    Returns:
+    list: For every shard, the sorted list of its fields.
+    """
+    if n_shards < 1:
+        raise ValueError("The number of shards must be at least 1")
+    fields = sorted(fields)
+    return [fields[shard_index::n_shards] for shard_index in range(n_shards)]
+
+
+def _shard_dir(config):
+    return os.path.join(config['work_dir'], 'shards')
+
+
+def _shard_state_path(config, shard_index):
+    return os.path.join(_shard_dir(config), f'shard_{shard_index}_state.json')
+
+
+def _shard_status_path(config, shard_index):
+    return os.path.join(_shard_dir(config), f'shard_{shard_index}.json')
+
+
+def _all_fields(config, fields):
+    if fields is None:
+        fields = discover_fields(config.get('input_dir') or config['measurement_dir'])
+    return sorted(fields)
+
+
+########### Shards ############
+def run_shard(config, shard_index, n_shards, fields=None, max_workers=None, force=False):
+    """
+    Run the per-field stages of the default pipeline for the fields of one shard.
+
+    Every shard keeps its own pipeline state file and only writes the per-field outputs of its fields, so shards
+    can run at the same time on a shared work_dir. The global stages are left to merge_shards.
+
+    Parameters:
+    config (dict): See build_default_pipeline.
+    shard_index (int): The shard to run, in 0..n_shards-1.
+    n_shards (int): The number of shards.
+    fields (list or None): All fields of the run. If None, the fields found in input_dir (or measurement_dir).
+    max_workers (int or None): Number of fields of the shard processed concurrently.
+    force (bool): Rerun every stage.
+
+    Returns:
+    list: The fields of the shard.
+    """
+    if not 0 <= shard_index < n_shards:
+        raise ValueError(f"Shard index {shard_index} out of range for {n_shards} shards")
+    shard_fields = assign_shards(_all_fields(config, fields), n_shards)[shard_index]
+    status_path = _shard_status_path(config, shard_index)
+    os.makedirs(_shard_dir(config), exist_ok=True)
+    if os.path.exists(status_path):
+        os.remove(status_path)
+
+    pipeline = build_default_pipeline(config, state_path=_shard_state_path(config, shard_index))
+    per_field_stages = [stage.name for stage in pipeline.topological_order() if stage.per_field]
+    print(f"Shard {shard_index}/{n_shards}: {len(shard_fields)} field(s) {shard_fields}")
+    pipeline.run(shard_fields, max_workers=max_workers, force=force, stages=per_field_stages)
+
+    # The status file is the marker merge_shards waits for
+    status = {'shard': shard_index, 'n_shards': n_shards, 'fields': shard_fields}
+    temp_path = status_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(temp_path, status_path)
+    return shard_fields
+
+
+def merge_shards(config, n_shards, fields=None, force=False):
+    """
+    Check that every shard completed, merge their pipeline states and run the global stages over all fields.
+
+    The per-field outputs of the shards are disjoint files in the shared work_dir, so after the global stages the
+    outputs are the same as those of run_pipeline on a single node. The merged state is written to the default
+    state file, so a later single-node run_pipeline call finds every field up to date.
+
+    Parameters:
+    config (dict): See build_default_pipeline.
+    n_shards (int): The number of shards.
+    fields (list or None): All fields of the run (as passed to run_shard).
+    force (bool): Rerun the global stages.
+
+    Returns:
+    dict: {stage name: list of keys that ran}, as returned by Pipeline.run.
+    """
+    fields = _all_fields(config, fields)
+    expected = assign_shards(fields, n_shards)
+    merged_state = {}
+    for shard_index in range(n_shards):
+        status_path = _shard_status_path(config, shard_index)
+        if not os.path.exists(status_path):
+            raise RuntimeError(f"Shard {shard_index} has not completed ({status_path} is missing)")
+        with open(status_path) as f:
+            status = json.load(f)
+        if status['n_shards'] != n_shards or status['fields'] != expected[shard_index]:
+            raise RuntimeError(f"Shard {shard_index} ran a different split: {status['fields']} "
+                               f"instead of {expected[shard_index]}")
+
+        # A shard without fields never writes a state file
+        shard_state = {}
+        if os.path.exists(_shard_state_path(config, shard_index)):
+            with open(_shard_state_path(config, shard_index)) as f:
+                shard_state = json.load(f)
+        for stage_name, keys in shard_state.items():
+            merged_state.setdefault(stage_name, {}).update(
+                {key: value for key, value in keys.items() if key in expected[shard_index]})
+
+    pipeline = build_default_pipeline(config)
+    for stage_name, keys in merged_state.items():
+        pipeline.state.setdefault(stage_name, {}).update(keys)
+    pipeline.save()
+
+    # The global stages fingerprint the per-field states just merged, so they rerun when any field changed
+    global_stages = [stage.name for stage in pipeline.topological_order() if not stage.per_field]
+    return pipeline.run(fields, force=force, stages=global_stages)
+
+
+def launch_local_shards(config_path, n_shards, fields=None, max_workers=None, force=False):
+    """
+    Run every shard as a separate local process on the shared work_dir, wait for them and merge the results.
+
+    Parameters:
+    config_path (str): The JSON configuration file (see build_default_pipeline).
+    n_shards (int): The number of shard processes.
+    fields (list or None): All fields of the run.
+    max_workers (int or None): Number of fields processed concurrently within each shard.
+    force (bool): Rerun every stage.
+
+    Returns:
+    dict: The result of merge_shards.
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+
+    processes = []
+    for shard_index in range(n_shards):
+        command = [sys.executable, '-m', 'ATTIICCpackage.sharding', 'run', config_path,
+                   '--shard', str(shard_index), '--shards', str(n_shards)]
+        if fields:
+            command += ['--fields'] + list(fields)
+        if max_workers:
+            command += ['--workers', str(max_workers)]
+        if force:
+            command.append('--force')
+        processes.append(subprocess.Popen(command))
+
+    failed = [i for i, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed; completed fields are kept, rerun to resume")
+    return merge_shards(config, n_shards, fields=fields, force=force)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the ATTIICC pipeline split over several processes.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name in ('run', 'merge', 'launch'):
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument('config', help="JSON configuration file (see build_default_pipeline)")
+        subparser.add_argument('--shards', type=int, required=True, help="number of shards")
+        subparser.add_argument('--fields', nargs='+', help="all fields of the run (e.g. f00 f01)")
+        subparser.add_argument('--force', action='store_true', help="rerun every stage")
+        if name == 'run':
+            subparser.add_argument('--shard', type=int, required=True, help="index of the shard to run")
+        if name != 'merge':
+            subparser.add_argument('--workers', type=int, default=None, help="fields processed concurrently per shard")
+    args = parser.parse_args(argv)
+
+    if args.command == 'launch':
+        ran = launch_local_shards(args.config, args.shards, fields=args.fields, max_workers=args.workers,
+                                  force=args.force)
+    else:
+        with open(args.config) as f:
+            config = json.load(f)
+        if args.command == 'run':
+            run_shard(config, args.shard, args.shards, fields=args.fields, max_workers=args.workers, force=args.force)
+            return
+        ran = merge_shards(config, args.shards, fields=args.fields, force=args.force)
+    for name, keys in ran.items():
+        print(f"{name}: {len(keys)} run(s)")
+
+
+if __name__ == '__main__':
+    main()
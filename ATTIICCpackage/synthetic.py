@@ -0,0 +1,289 @@
+# synthetic.py
+#
+# Synthetic microwell plates with known cells, for benchmarks and for checking the pipeline end to end.
+#
+# Usage: python -m ATTIICCpackage.synthetic output_dir [--fields 2] [--frames 5] [--wells 16] [--cells-per-well 4]
+#                                                     [--overwrite]
+
+import os
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+
+from ATTIICCpackage.microwells import WELL_BOX_COLUMNS, well_map_from_boxes
+
+# Header of the CSV files the ImageJ measure macro writes ("area shape mean centroid display")
+IMAGEJ_MEASUREMENT_HEADER = [' ', 'Label', 'Area', 'Mean', 'X', 'Y', 'Circ.', 'AR', 'Round', 'Solidity']
+
+CHANNELS = ('d0', 'd1', 'd2', 'd3')
+
+
+########### Plate layout ############
+def microwell_grid(n_wells, well_size=64, spacing=16, margin=16):
+    """
+    Lay out n_wells square microwells on a regular grid, as close to square as possible.
+
+    Parameters:
+    n_wells (int): The number of wells.
+    well_size (int): The side of a well in pixels.
+    spacing (int): The wall between two wells in pixels.
+    margin (int): The border around the grid in pixels.
+
+    Returns:
+    np.ndarray: The (n_wells, 5) int32 array of well boxes with the columns of WELL_BOX_COLUMNS, in row-major order.
+    tuple: The (height, width) of the image holding the grid.
+    """
+    n_cols = int(np.ceil(np.sqrt(n_wells)))
+    n_rows = int(np.ceil(n_wells / n_cols))
+    index = np.arange(n_wells)
+    pitch = well_size + spacing
+    boxes = np.column_stack([index + 1, margin + (index % n_cols) * pitch, margin + (index // n_cols) * pitch,
+                             np.full(n_wells, well_size), np.full(n_wells, well_size)]).astype(np.int32)
+    shape = (2 * margin + n_rows * pitch - spacing, 2 * margin + n_cols * pitch - spacing)
+    return boxes, shape
+
+
+########### Cells ############
+def simulate_cells(boxes, n_frames, cells_per_well=4, radius_range=(4, 7), effector_fraction=0.4,
+                   death_rate=0.05, step=2.0, rng=None):
+    """
+    Simulate cells moving by random walk inside their well. Effectors ('E') and targets ('T') are drawn with
+    effector_fraction; every target dies with probability death_rate per frame and stops moving once dead.
+
+    Parameters:
+    boxes (np.ndarray): The well boxes (see WELL_BOX_COLUMNS).
+    n_frames (int): The number of frames.
+    cells_per_well (int or tuple): The number of cells of every well, or a (min, max) range to draw it from.
+    radius_range (tuple): The (min, max) cell radius in pixels.
+    effector_fraction (float): The probability that a cell is an effector.
+    death_rate (float): The probability per frame that a live target dies.
+    step (float): The standard deviation of the displacement between two frames in pixels.
+    rng (np.random.Generator or None): The random generator.
+
+    Returns:
+    pd.DataFrame: The ground truth, one row per cell and frame with 'frame', 'well', 'cell_ID' (1..n within the
+                  well, constant over frames), 'type', 'dead' (0/1), 'X', 'Y' (pixels of the full image) and 'radius'.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    if np.ndim(cells_per_well) == 0:
+        counts = np.full(len(boxes), int(cells_per_well))
+    else:
+        counts = rng.integers(cells_per_well[0], cells_per_well[1] + 1, len(boxes))
+    n_cells = int(counts.sum())
+
+    wells = np.repeat(boxes[:, 0], counts)
+    box = np.repeat(boxes[:, 1:], counts, axis=0).astype(float)
+    cell_ids = np.arange(n_cells) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    radius = rng.integers(radius_range[0], radius_range[1] + 1, n_cells)
+    is_effector = rng.random(n_cells) < effector_fraction
+    # Frame of death of every target (never for effectors)
+    death_frame = np.where(is_effector, n_frames, rng.geometric(death_rate, n_cells) if death_rate > 0 else n_frames)
+
+    # Keep the whole cell inside its well
+    low = box[:, :2] + radius[:, None]
+    high = box[:, :2] + box[:, 2:] - 1 - radius[:, None]
+    position = low + rng.random((n_cells, 2)) * (high - low)
+
+    tables = []
+    for frame in range(n_frames):
+        if frame:
+            moving = (frame < death_frame)[:, None]
+            position = np.clip(position + moving * rng.normal(0, step, (n_cells, 2)), low, high)
+        tables.append(pd.DataFrame({'frame': frame, 'well': wells, 'cell_ID': cell_ids,
+                                    'type': np.where(is_effector, 'E', 'T'), 'dead': (frame >= death_frame).astype(int),
+                                    'X': position[:, 0], 'Y': position[:, 1], 'radius': radius}))
+    return pd.concat(tables, ignore_index=True)
+
+
+def render_frame(cells, boxes, shape, rng=None):
+    """
+    Render one frame of a field: the label image of the cells and the 16-bit image of every channel.
+
+    d0 shows the effectors, d1 the targets, d2 the dead cells and d3 is the brightfield image with the well walls
+    and dark cells. Every channel has an illumination gradient and noise, so background subtraction has work to do.
+
+    Parameters:
+    cells (pd.DataFrame): The cells of the frame (see simulate_cells).
+    boxes (np.ndarray): The well boxes (see WELL_BOX_COLUMNS).
+    shape (tuple): The (height, width) of the image.
+    rng (np.random.Generator or None): The random generator for the noise.
+
+    Returns:
+    np.ndarray: The uint16 label image, cell i of the table (in order) having label i + 1.
+    dict: {channel: uint16 image} for d0..d3.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    labels = np.zeros(shape, dtype=np.uint16)
+    for i, (x, y, r) in enumerate(cells[['X', 'Y', 'radius']].to_numpy()):
+        y0, y1 = int(max(y - r, 0)), int(min(y + r + 1, shape[0]))
+        x0, x1 = int(max(x - r, 0)), int(min(x + r + 1, shape[1]))
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        disk = (yy - y) ** 2 + (xx - x) ** 2 <= r ** 2
+        labels[y0:y1, x0:x1][disk] = i + 1
+
+    # Signal of every label (index 0 is the background) in the fluorescence channels
+    signal = {'d0': cells['type'].eq('E').to_numpy() * 20000.0,
+              'd1': cells['type'].eq('T').to_numpy() * 15000.0,
+              'd2': cells['dead'].to_numpy() * 25000.0}
+    gradient = np.linspace(0, 3000, shape[1])[None, :] + np.linspace(0, 1500, shape[0])[:, None]
+
+    images = {}
+    for channel, values in signal.items():
+        image = 1000 + gradient + np.concatenate([[0.0], values])[labels]
+        images[channel] = image + rng.normal(0, 300, shape)
+
+    wells = well_map_from_boxes(boxes, shape) > 0
+    brightfield = np.where(wells, 25000.0, 40000.0) + gradient
+    brightfield[labels > 0] = 12000
+    images['d3'] = brightfield + rng.normal(0, 500, shape)
+
+    return labels, {c: np.clip(image, 0, 65535).astype(np.uint16) for c, image in images.items()}
+
+
+########### Plate ############
+def _image_name(frame, field, channel):
+    # Same naming as the exported microscope images: pNN_0_fNNdK
+    return f'p{frame:02d}_0_{field}{channel}'
+
+
+def _channel_folder(field, channel):
+    return f'{field}d3_png' if channel == 'd3' else f'{field}{channel}'
+
+
+def generate_plate(output_dir, n_fields=2, n_frames=5, n_wells=16, cells_per_well=4, well_size=64, drift=0, seed=0,
+                   write_crops=True, write_measurements=True, overwrite=False, **cell_options):
+    """
+    Generate a synthetic plate with known cells, laid out like a real experiment:
+
+    images/fNNd0..d2, images/fNNd3_png   full 16-bit images of every frame (pNN_0_fNNdK.png)
+    labels/fNNd3_png                     ground-truth label images (pNN_0_fNNd3_label.png, like seg_subfolder)
+    cropped/fNNd0..d2, cropped/fNNd3_png one image per well (pNN_0_fNNdK_well_WWWW.png, like the crop macros)
+    measurements/fNNd0..d2               one ImageJ measurement CSV per well image, as load_csv_files_from_subfolders
+                                         and load_all_channels_from_subfolders expect
+    well_boxes.csv                       the well grid of the first frame (same for every field)
+    ground_truth.csv                     every cell of every frame with its type and death state
+
+    Parameters:
+    output_dir (str): The folder to write the plate to.
+    n_fields (int): The number of fields.
+    n_frames (int): The number of frames per field.
+    n_wells (int): The number of wells per field.
+    cells_per_well (int or tuple): The number of cells per well, or a (min, max) range.
+    well_size (int): The side of a well in pixels.
+    drift (int): The maximum stage drift in pixels: every frame after the first is translated by a random
+                 (dy, dx) in [-drift, drift], recorded in the 'drift_y' and 'drift_x' ground-truth columns.
+    seed (int): The random seed; the same arguments always give the same plate.
+    write_crops (bool): Write the per-well images.
+    write_measurements (bool): Write the per-well measurement CSVs.
+    overwrite (bool): If output_dir is not empty, delete it first. Otherwise a non-empty output_dir is refused,
+                      since files of an earlier plate would be mixed into this one.
+    cell_options: Passed to simulate_cells (radius_range, effector_fraction, death_rate, step).
+
+    Returns:
+    pd.DataFrame: The ground truth, with a 'field' column and the 'cell' index of the cell in its measurement CSV.
+    """
+    import cv2
+    from ATTIICCpackage.cell_measurement import measure_cells
+
+    if os.path.isdir(output_dir) and os.listdir(output_dir):
+        if not overwrite:
+            raise FileExistsError(f"{output_dir} is not empty; pass overwrite=True to replace its contents")
+        shutil.rmtree(output_dir)
+
+    rng = np.random.default_rng(seed)
+    boxes, shape = microwell_grid(n_wells, well_size=well_size, margin=16 + drift)
+    os.makedirs(output_dir, exist_ok=True)
+    pd.DataFrame(boxes, columns=WELL_BOX_COLUMNS).to_csv(os.path.join(output_dir, 'well_boxes.csv'), index=False)
+
+    truths = []
+    for field_index in range(n_fields):
+        field = f'f{field_index:02d}'
+        for channel in CHANNELS:
+            os.makedirs(os.path.join(output_dir, 'images', _channel_folder(field, channel)), exist_ok=True)
+            if write_crops:
+                os.makedirs(os.path.join(output_dir, 'cropped', _channel_folder(field, channel)), exist_ok=True)
+            if write_measurements and channel != 'd3':
+                os.makedirs(os.path.join(output_dir, 'measurements', f'{field}{channel}'), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, 'labels', f'{field}d3_png'), exist_ok=True)
+
+        truth = simulate_cells(boxes, n_frames, cells_per_well, rng=rng, **cell_options)
+        truth.insert(0, 'field', field)
+        truth['cell'] = 0
+        offsets = rng.integers(-drift, drift + 1, (n_frames, 2))
+        offsets[0] = 0
+        truth['drift_y'] = offsets[truth['frame'], 0]
+        truth['drift_x'] = offsets[truth['frame'], 1]
+        truth['X'] += truth['drift_x']
+        truth['Y'] += truth['drift_y']
+        for frame, cells in truth.groupby('frame', sort=True):
+            frame_boxes = boxes + np.array([0, offsets[frame, 1], offsets[frame, 0], 0, 0], dtype=np.int32)
+            labels, images = render_frame(cells, frame_boxes, shape, rng)
+            for channel, image in images.items():
+                cv2.imwrite(os.path.join(output_dir, 'images', _channel_folder(field, channel),
+                                         _image_name(frame, field, channel) + '.png'), image)
+            cv2.imwrite(os.path.join(output_dir, 'labels', f'{field}d3_png',
+                                     _image_name(frame, field, 'd3') + '_label.png'), labels)
+            if not (write_crops or write_measurements):
+                continue
+
+            cell_ids = cells['cell_ID'].to_numpy()
+            for well, x, y, width, height in frame_boxes:
+                window = (slice(y, y + height), slice(x, x + width))
+                well_labels = labels[window]
+                crop_names = {c: f'{_image_name(frame, field, c)}_well_{well:04d}' for c in CHANNELS}
+                if write_crops:
+                    for channel, image in images.items():
+                        cv2.imwrite(os.path.join(output_dir, 'cropped', _channel_folder(field, channel),
+                                                 crop_names[channel] + '.png'), image[window])
+                if not write_measurements:
+                    continue
+
+                # ImageJ measures the ROIs of the d3 segmentation in every channel, numbering the rows 1..n
+                present = np.unique(well_labels)
+                present = present[present > 0]
+                if not len(present):
+                    continue
+                measured = measure_cells(well_labels, {c: images[c][window] for c in ('d0', 'd1', 'd2')})
+                roi_ids = cell_ids[present - 1]
+                truth.loc[cells.index[present - 1], 'cell'] = measured['cell'].to_numpy()
+                for channel in ('d0', 'd1', 'd2'):
+                    csv = pd.DataFrame({
+                        ' ': measured['cell'], 'Label': [f'{crop_names[channel]}:{roi:04d}' for roi in roi_ids],
+                        'Area': measured['area'], 'Mean': measured[f'mean_intensity_{channel}'],
+                        'X': measured['X'], 'Y': measured['Y'], 'Circ.': measured['circ.'], 'AR': measured['ar'],
+                        'Round': measured['round'], 'Solidity': measured['solidity']}, columns=IMAGEJ_MEASUREMENT_HEADER)
+                    csv.to_csv(os.path.join(output_dir, 'measurements', f'{field}{channel}',
+                                            crop_names[channel] + '_measurements.csv'), index=False)
+        truths.append(truth)
+        print(f"Generated field {field}: {n_frames} frames, {n_wells} wells, {len(truth) // n_frames} cells")
+
+    ground_truth = pd.concat(truths, ignore_index=True)
+    ground_truth.to_csv(os.path.join(output_dir, 'ground_truth.csv'), index=False)
+    return ground_truth
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic microwell plate with known cells.")
+    parser.add_argument('output_dir', help="folder to write the plate to")
+    parser.add_argument('--fields', type=int, default=2, help="number of fields")
+    parser.add_argument('--frames', type=int, default=5, help="number of frames per field")
+    parser.add_argument('--wells', type=int, default=16, help="number of wells per field")
+    parser.add_argument('--cells-per-well', type=int, nargs='+', default=[4], help="cells per well, or a min and max")
+    parser.add_argument('--well-size', type=int, default=64, help="side of a well in pixels")
+    parser.add_argument('--drift', type=int, default=0, help="maximum stage drift between frames in pixels")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    parser.add_argument('--no-crops', action='store_true', help="do not write the per-well images")
+    parser.add_argument('--no-measurements', action='store_true', help="do not write the measurement CSVs")
+    parser.add_argument('--overwrite', action='store_true', help="delete the contents of a non-empty output_dir")
+    args = parser.parse_args(argv)
+
+    cells_per_well = args.cells_per_well[0] if len(args.cells_per_well) == 1 else tuple(args.cells_per_well[:2])
+    generate_plate(args.output_dir, n_fields=args.fields, n_frames=args.frames, n_wells=args.wells,
+                   cells_per_well=cells_per_well, well_size=args.well_size, drift=args.drift, seed=args.seed,
+                   write_crops=not args.no_crops, write_measurements=not args.no_measurements,
+                   overwrite=args.overwrite)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,561 @@
+# timeseries_store.py
+#
+# The examples in the docstrings are small hand-built cases of the kernels; check them with
+#     python -m doctest ATTIICCpackage/timeseries_store.py
+
+import numpy as np
+import pandas as pd
+
+
+########### Kernels ############
+def step_distances(groups, x, y):
+    """
+    Euclidean distance of every position to the previous position of the same group, rounded to 2 decimals.
+
+    Parameters:
+    groups (np.ndarray): The group of every row; the rows of a group are contiguous and in order.
+    x, y (np.ndarray): The positions.
+
+    Returns:
+    np.ndarray: The distances, NaN for the first row of every group.
+
+    Example:
+    >>> step_distances([0, 0, 0, 1, 1], [0, 3, 3, 5, 6], [0, 4, 5, 5, 5])
+    array([nan,  5.,  1., nan,  1.])
+    """
+    groups = np.asarray(groups)
+    distance = np.full(len(groups), np.nan)
+    if len(groups) > 1:
+        same_group = groups[1:] == groups[:-1]
+        distance[1:] = np.where(same_group, np.round(np.hypot(np.diff(x), np.diff(y)), 2), np.nan)
+    return distance
+
+
+########### WellTimeSeriesStore ############
+class WellTimeSeriesStore:
+    """
+    Array-backed per-well time series of the cells of an experiment.
+
+    Wells are identified by their ('field', 'well') pair and indexed 0..n_wells-1 in sorted order; frames are
+    indexed 0..n_frames-1 in sorted order. A (well, frame) pair is a slot, numbered well * n_frames + frame.
+    The cell arrays are stored CSR style in slot order, so the cells of slot s are the rows
+    offsets[s]:offsets[s + 1] of every array in 'columns', and the rows of one well are contiguous and
+    sorted by frame.
+
+    Attributes:
+    fields (np.ndarray): The field of each well, shape (n_wells,).
+    wells (np.ndarray): The well number of each well, shape (n_wells,).
+    frames (np.ndarray): The sorted frames, shape (n_frames,).
+    counts (np.ndarray): Dense cell count matrix, shape (n_wells, n_frames).
+    present (np.ndarray): Boolean matrix telling whether a frame was recorded for a well at all (a frame
+                          added by fill_missing_frames is present with a count of 0), shape (n_wells, n_frames).
+    offsets (np.ndarray): Start row of every slot plus the total number of rows, shape (n_wells * n_frames + 1,).
+    well_offsets (np.ndarray): Start row of every well plus the total number of rows, shape (n_wells + 1,).
+    columns (dict): The per-cell arrays ('cell', 'X', 'Y', 'mean_intensity_d0', 'cell_type', ...).
+
+    Example (well 1 has no frame 1; frame 2 of well 2 is a placeholder added by fill_missing_frames):
+    >>> df = pd.DataFrame({'field': 'f00', 'well': [1, 1, 1, 2, 2, 2], 'frame': [0, 0, 2, 0, 1, 2],
+    ...                    'cell': [1, 2, 1, 1, 1, 'na'], 'X': [0, 5, 3, 0, 6, 0], 'Y': [0, 0, 4, 0, 8, 0]})
+    >>> store = WellTimeSeriesStore.from_dataframe(df)
+    >>> store.counts
+    array([[2, 0, 1],
+           [1, 1, 0]])
+    >>> store.present
+    array([[ True, False,  True],
+           [ True,  True,  True]])
+    >>> store.missing_frames()
+      field  well  frame
+    0   f00     1      1
+    >>> store.trends()
+      field  well             trend_1                trend_2
+    0   f00     1  f00_well_1_0_2_2_1  f00_well_1_2_decrease
+    1   f00     2  f00_well_2_0_1_2_0  f00_well_2_2_decrease
+    >>> single_cells, mean_speed = store.moving_speed()
+    >>> single_cells[['well', 'frame', 'moving_speed']]
+       well  frame  moving_speed
+    0     1      2           NaN
+    1     2      0           NaN
+    2     2      1          10.0
+    >>> store.slot_matrix(df.assign(cell_count=[2, 2, 1, 1, 1, 0]), 'cell_count')
+    array([[2., 0., 1.],
+           [1., 1., 0.]])
+    """
+
+    def __init__(self, fields, wells, frames, counts, present, columns):
+        self.fields = np.asarray(fields)
+        self.wells = np.asarray(wells)
+        self.frames = np.asarray(frames)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.present = np.asarray(present, dtype=bool)
+        self.columns = dict(columns)
+
+        self.offsets = np.zeros(self.counts.size + 1, dtype=np.int64)
+        np.cumsum(self.counts.ravel(), out=self.offsets[1:])
+        self.well_offsets = self.offsets[::self.n_frames] if self.n_frames else np.zeros(1, dtype=np.int64)
+
+        # Slot of every cell row, used to broadcast per-slot values to the cells
+        self.row_slot = np.repeat(np.arange(self.counts.size), self.counts.ravel())
+
+    @property
+    def n_wells(self):
+        return len(self.wells)
+
+    @property
+    def n_frames(self):
+        return len(self.frames)
+
+    @property
+    def n_cells(self):
+        return int(self.offsets[-1])
+
+    def __len__(self):
+        return self.n_cells
+
+    def __repr__(self):
+        return f"WellTimeSeriesStore(n_wells={self.n_wells}, n_frames={self.n_frames}, n_cells={self.n_cells})"
+
+    ########### Conversion from and to the DataFrame schema ############
+    @classmethod
+    def from_dataframe(cls, df):
+        """
+        Build the store from a long-form dataframe with one row per cell, as produced by
+        merge_and_clean_dataframes, process_and_save_cell_count, process_classified_data or fill_missing_frames.
+        Placeholder rows (rows whose 'cell' is 'na' or missing, as added by fill_missing_frames) mark the frame as
+        present with zero cells. A 'cell_count' column is not stored, it is derived from the counts.
+
+        Parameters:
+        df (pd.DataFrame): The input dataframe that contains 'field', 'well', 'frame' and 'cell' columns.
+
+        Returns:
+        WellTimeSeriesStore: The store.
+
+        Example (the 'na' placeholder of frame 1 is dropped, 'area' becomes numeric again and the string IDs are
+        kept as they are):
+        >>> df = pd.DataFrame({'field': 'f00', 'well': 3, 'frame': [0, 0, 1], 'cell': [1, 2, 'na'],
+        ...                    'area': [10, 12, 'na'], 'cell_ID': ['0001', '0002', 'na']})
+        >>> store = WellTimeSeriesStore.from_dataframe(df)
+        >>> store.to_dataframe()
+          field  well  frame  cell  area cell_ID  cell_count
+        0   f00     3      0     1    10    0001           2
+        1   f00     3      0     2    12    0002           2
+        >>> store.columns['cell_ID'].tolist(), store.columns['area'].dtype
+        (['0001', '0002'], dtype('int64'))
+        """
+        # One factorization per key instead of a groupby per analysis
+        well_codes, well_keys = pd.MultiIndex.from_frame(df[['field', 'well']]).factorize(sort=True)
+        frame_codes, frames = pd.factorize(df['frame'], sort=True)
+        fields = well_keys.get_level_values(0).to_numpy()
+        wells = well_keys.get_level_values(1).to_numpy()
+        n_wells, n_frames = len(well_keys), len(frames)
+
+        slot = well_codes.astype(np.int64) * n_frames + frame_codes
+        present = np.zeros(n_wells * n_frames, dtype=bool)
+        present[slot] = True
+
+        # Keep the real cells only, ordered by slot (stable, so the original order within a slot is kept)
+        real = pd.to_numeric(df['cell'], errors='coerce').notna().to_numpy()
+        real_slot = slot[real]
+        order = np.argsort(real_slot, kind='stable')
+        counts = np.bincount(real_slot, minlength=n_wells * n_frames)
+
+        columns = {}
+        for col in df.columns:
+            if col in ('field', 'well', 'frame', 'cell_count'):
+                continue
+            all_values = df[col].to_numpy()
+            values = all_values[real][order]
+            # Numeric columns that held 'na' placeholders are numeric again once the placeholders are gone; string
+            # columns (labels, zero-padded IDs) are kept as they are, even though the placeholders filled them too
+            if values.dtype == object and (all_values[~real] == 'na').any() and \
+                    pd.api.types.infer_dtype(values, skipna=True) in ('integer', 'floating', 'mixed-integer-float'):
+                values = pd.to_numeric(values)
+            columns[col] = values
+
+        return cls(fields, wells, np.asarray(frames), counts.reshape(n_wells, n_frames),
+                   present.reshape(n_wells, n_frames), columns)
+
+    def to_dataframe(self, include_empty=False):
+        """
+        Convert the store back to the long-form dataframe schema, with the 'cell_count' column added.
+
+        Parameters:
+        include_empty (bool): If True, add one row with 'cell_count' 0 and missing values for every (well, frame)
+                              without cells, like fill_missing_frames does.
+
+        Returns:
+        pd.DataFrame: One row per cell, sorted by 'field', 'well' and 'frame'.
+        """
+        well_idx, frame_idx = np.divmod(self.row_slot, self.n_frames)
+        df = pd.DataFrame({'field': self.fields[well_idx], 'well': self.wells[well_idx],
+                           'frame': self.frames[frame_idx]})
+        for col, values in self.columns.items():
+            df[col] = values
+        df['cell_count'] = self.counts.ravel()[self.row_slot]
+
+        if include_empty:
+            empty_well, empty_frame = np.nonzero(self.counts == 0)
+            df_empty = pd.DataFrame({'field': self.fields[empty_well], 'well': self.wells[empty_well],
+                                     'frame': self.frames[empty_frame], 'cell_count': 0})
+            df = pd.concat([df, df_empty], ignore_index=True)
+            df = df.sort_values(by=['field', 'well', 'frame'], kind='stable').reset_index(drop=True)
+
+        return df
+
+    def fill_frames(self, frames_required):
+        """
+        Return a store in which every frame of frames_required is present for every well, the frames without cells
+        with a count of 0, as after fill_missing_frames. The cell arrays are shared, not copied.
+
+        Parameters:
+        frames_required (list): The frames every well should contain.
+
+        Returns:
+        WellTimeSeriesStore: The filled store, whose frames are the sorted union of its frames and frames_required.
+
+        Example (well 1 has no row at all in frame 1; the trends then match the fill_missing_frames and
+        add_trends_to_dataframe workflow, which records the frame as a count of 0):
+        >>> df = pd.DataFrame({'field': 'f00', 'well': [1, 1, 1, 2, 2, 2], 'frame': [0, 0, 2, 0, 1, 2],
+        ...                    'cell': [1, 2, 1, 1, 1, 1], 'X': 0, 'Y': 0})
+        >>> store = WellTimeSeriesStore.from_dataframe(df)
+        >>> store.trends([0, 1, 2, 3])['trend_2'].tolist()
+        ['f00_well_1_2_decrease', 'f00_well_2_']
+        >>> filled = store.fill_frames([0, 1, 2, 3])
+        >>> filled.counts
+        array([[2, 0, 1, 0],
+               [1, 1, 1, 0]])
+        >>> filled.trends([0, 1, 2, 3])['trend_2'].tolist()
+        ['f00_well_1_1_decrease_2_increase_3_decrease', 'f00_well_2_3_decrease']
+        >>> from ATTIICCpackage.image_feature_analysis import fill_missing_frames, add_trends_to_dataframe
+        >>> cell_count = df.groupby(['well', 'frame'])['cell'].transform('max')
+        >>> df_filled = fill_missing_frames(df.assign(cell_count=cell_count), [0, 1, 2, 3])
+        >>> add_trends_to_dataframe(df_filled, [0, 1, 2, 3])['trend_2'].tolist()
+        ['f00_well_1_1_decrease_2_increase_3_decrease', 'f00_well_2_3_decrease']
+        """
+        frames = np.union1d(self.frames, np.asarray(frames_required))
+        frame_pos = np.searchsorted(frames, self.frames)
+        counts = np.zeros((self.n_wells, len(frames)), dtype=np.int64)
+        counts[:, frame_pos] = self.counts
+        present = np.zeros((self.n_wells, len(frames)), dtype=bool)
+        present[:, frame_pos] = self.present
+        present[:, np.searchsorted(frames, np.asarray(frames_required))] = True
+        # The added frames hold no cells, so the cell rows keep their (well, frame) order
+        return WellTimeSeriesStore(self.fields, self.wells, frames, counts, present, self.columns)
+
+    ########### Array kernels ############
+    def cell_count_column(self):
+        """
+        Return the number of cells in the well and frame of every cell row (the 'cell_count' column of
+        process_and_save_cell_count, assuming the cells of an image are numbered 1..n).
+        """
+        return self.counts.ravel()[self.row_slot]
+
+    def missing_frames(self, frames_required=None):
+        """
+        Return the (field, well, frame) triples that fill_missing_frames would add.
+
+        Parameters:
+        frames_required (list or None): The frames each well should contain. If None, all frames of the store.
+
+        Returns:
+        pd.DataFrame: The 'field', 'well' and 'frame' of every missing frame.
+        """
+        present = self.present
+        frames = self.frames
+        if frames_required is not None:
+            frame_pos = pd.Index(self.frames).get_indexer(frames_required)
+            present = np.where(frame_pos >= 0, present[:, frame_pos.clip(0)], False)
+            frames = np.asarray(frames_required)
+        missing_well, missing_frame = np.nonzero(~present)
+        return pd.DataFrame({'field': self.fields[missing_well], 'well': self.wells[missing_well],
+                             'frame': frames[missing_frame]})
+
+    def slot_matrix(self, df, column, fill_value=0):
+        """
+        Scatter a per-row column of a long-form dataframe into a (n_wells, n_frames) matrix, e.g. its 'cell_count'
+        column. A slot with several rows gets the value of its first row; rows of wells or frames the store does not
+        hold are ignored.
+
+        Parameters:
+        df (pd.DataFrame): The dataframe, with 'field', 'well' and 'frame' columns.
+        column (str): The numeric column to scatter.
+        fill_value (float): The value of slots without rows.
+
+        Returns:
+        np.ndarray: The (n_wells, n_frames) float matrix.
+        """
+        well_keys = pd.MultiIndex.from_arrays([self.fields, self.wells])
+        well_pos = well_keys.get_indexer(pd.MultiIndex.from_frame(df[['field', 'well']]))
+        frame_pos = pd.Index(self.frames).get_indexer(df['frame'])
+        values = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float)
+        known = np.nonzero((well_pos >= 0) & (frame_pos >= 0))[0][::-1]
+
+        # Assigned in reverse, so the first row of a slot is written last and wins
+        matrix = np.full((self.n_wells, self.n_frames), fill_value, dtype=float)
+        matrix[well_pos[known], frame_pos[known]] = values[known]
+        return matrix
+
+    def trends(self, frames_required=None, counts=None):
+        """
+        Compute the 'trend_1' and 'trend_2' strings of add_trends_to_dataframe for every well: the counts at the
+        frames where the count changes, and whether it increased or decreased. Frames that are not present for a
+        well are skipped, as in add_trends_to_dataframe.
+
+        Parameters:
+        frames_required (list or None): The frames to consider, in order. If None, all frames of the store.
+        counts (np.ndarray or None): The (n_wells, n_frames) counts to use instead of the store counts, e.g. the
+                                     'cell_count' column of the cells from slot_matrix.
+
+        Returns:
+        pd.DataFrame: One row per well with 'field', 'well', 'trend_1' and 'trend_2' columns.
+        """
+        counts = self.counts if counts is None else np.asarray(counts)
+        present, frames = self.present, self.frames
+        if frames_required is not None:
+            frame_pos = pd.Index(self.frames).get_indexer(frames_required)
+            counts = counts[:, frame_pos.clip(0)]
+            present = np.where(frame_pos >= 0, present[:, frame_pos.clip(0)], False)
+            frames = np.asarray(frames_required)
+        n_frames = counts.shape[1]
+
+        # Index of the previous present frame of every (well, frame), -1 if there is none
+        last_present = np.maximum.accumulate(np.where(present, np.arange(n_frames), -1), axis=1)
+        previous = np.full_like(last_present, -1)
+        previous[:, 1:] = last_present[:, :-1]
+        previous_count = np.take_along_axis(counts, previous.clip(0), axis=1)
+
+        has_previous = previous >= 0
+        changed = present & (~has_previous | (counts != previous_count))
+        step = np.where(changed & has_previous, np.sign(counts - previous_count), 0)
+
+        trend_1, trend_2 = [], []
+        changed_rows = np.split(np.nonzero(changed)[1], np.cumsum(changed.sum(axis=1))[:-1])
+        for i, frame_idx in enumerate(changed_rows):
+            prefix = f"{self.fields[i]}_well_{self.wells[i]}_"
+            trend_1.append(prefix + "_".join(f"{frames[t]}_{int(counts[i, t])}" for t in frame_idx))
+            trend_2.append(prefix + "_".join(f"{frames[t]}_{'increase' if step[i, t] > 0 else 'decrease'}"
+                                             for t in frame_idx if step[i, t] != 0))
+
+        return pd.DataFrame({'field': self.fields, 'well': self.wells, 'trend_1': trend_1, 'trend_2': trend_2})
+
+    def moving_speed(self):
+        """
+        Compute the moving speed of single cells, as in calculate_moving_speed_and_mean: for the frames where a
+        well holds exactly one cell, the Euclidean distance (rounded to 2 decimals) to the cell position at the
+        previous such frame of the same well.
+
+        Returns:
+        df_single_cells (pd.DataFrame): 'field', 'well', 'frame', 'cell', 'X', 'Y' and 'moving_speed' of the single cells.
+        df_mean_moving (pd.DataFrame): The mean moving speed of every well with single cells.
+        """
+        rows = np.nonzero(self.cell_count_column() == 1)[0]
+        well_idx, frame_idx = np.divmod(self.row_slot[rows], self.n_frames)
+        x = np.asarray(self.columns['X'], dtype=float)[rows]
+        y = np.asarray(self.columns['Y'], dtype=float)[rows]
+
+        speed = step_distances(well_idx, x, y)
+
+        df_single_cells = pd.DataFrame({'field': self.fields[well_idx], 'well': self.wells[well_idx],
+                                        'frame': self.frames[frame_idx], 'cell': self.columns['cell'][rows],
+                                        'X': x, 'Y': y, 'moving_speed': speed})
+
+        # Mean over the non-missing speeds of every well, NaN for wells with a single frame
+        valid = ~np.isnan(speed)
+        totals = np.bincount(well_idx[valid], weights=speed[valid], minlength=self.n_wells)
+        n_valid = np.bincount(well_idx[valid], minlength=self.n_wells)
+        has_single = np.bincount(well_idx, minlength=self.n_wells) > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_speed = np.round(totals / n_valid, 2)
+        df_mean_moving = pd.DataFrame({'field': self.fields[has_single], 'well': self.wells[has_single],
+                                       'moving_speed': mean_speed[has_single]})
+
+        return df_single_cells, df_mean_moving
+
+    def proximity(self, effector_type='E', target_type='T'):
+        """
+        Compute the distance between every effector and every target cell of the same well and frame, as
+        calculate_proximity does. Requires the 'cell_type' column of process_classified_data.
+
+        Parameters:
+        effector_type (str): The 'cell_type' value of effector cells.
+        target_type (str): The 'cell_type' value of target cells.
+
+        Returns:
+        pd.DataFrame: 'field', 'frame', 'well', 'E_cell_ID', 'T_cell_ID' and 'E-T_distance' of every E-T pair,
+                      ordered by 'field', 'frame' and 'well'.
+        """
+        e_rows, t_rows, e_idx, t_idx = self.effector_target_pairs(effector_type, target_type)
+        slot = self.row_slot[e_rows][e_idx]
+        well_idx, frame_idx = np.divmod(slot, self.n_frames)
+
+        x = np.asarray(self.columns['X'], dtype=float)
+        y = np.asarray(self.columns['Y'], dtype=float)
+        distance = np.hypot(x[e_rows][e_idx] - x[t_rows][t_idx], y[e_rows][e_idx] - y[t_rows][t_idx])
+
+        # Pairs are generated in (field, well, frame) order; calculate_proximity groups by (field, frame, well)
+        field_codes = pd.factorize(self.fields, sort=True)[0]
+        order = np.lexsort((well_idx, frame_idx, field_codes[well_idx]))
+
+        cell = self.columns['cell']
+        return pd.DataFrame({'field': self.fields[well_idx][order], 'frame': self.frames[frame_idx][order],
+                             'well': self.wells[well_idx][order], 'E_cell_ID': cell[e_rows][e_idx][order],
+                             'T_cell_ID': cell[t_rows][t_idx][order], 'E-T_distance': distance[order]})
+
+    def effector_target_pairs(self, effector_type='E', target_type='T'):
+        """
+        Enumerate every (effector, target) pair of cells that share a well and frame.
+
+        Parameters:
+        effector_type (str): The 'cell_type' value of effector cells.
+        target_type (str): The 'cell_type' value of target cells.
+
+        Returns:
+        e_rows (np.ndarray): Rows of the effector cells.
+        t_rows (np.ndarray): Rows of the target cells.
+        e_idx (np.ndarray): For every pair, the position of its effector in e_rows.
+        t_idx (np.ndarray): For every pair, the position of its target in t_rows.
+        """
+        cell_type = np.asarray(self.columns['cell_type'])
+        e_rows = np.nonzero(cell_type == effector_type)[0]
+        t_rows = np.nonzero(cell_type == target_type)[0]
+        e_idx, t_idx = self._slot_pairs(e_rows, t_rows)
+        return e_rows, t_rows, e_idx, t_idx
+
+    def _slot_pairs(self, e_rows, t_rows):
+        # Rows are sorted by slot, so the targets of a slot are a contiguous run starting at t_start
+        n_slots = self.counts.size
+        t_per_slot = np.bincount(self.row_slot[t_rows], minlength=n_slots)
+        t_start = np.concatenate(([0], np.cumsum(t_per_slot)[:-1]))
+
+        e_slot = self.row_slot[e_rows]
+        pairs_per_e = t_per_slot[e_slot]
+        e_idx = np.repeat(np.arange(len(e_rows)), pairs_per_e)
+        pair_start = np.cumsum(pairs_per_e) - pairs_per_e
+        within = np.arange(len(e_idx)) - np.repeat(pair_start, pairs_per_e)
+        t_idx = np.repeat(t_start[e_slot], pairs_per_e) + within
+        return e_idx, t_idx
+
+    def killing_events(self, contact_distance, effector_type='E', target_type='T', track_column='track_id',
+                       death_column='death', min_death_frames=1, frame_interval=1):
+        """
+        Link the contacts of every target cell with effector cells to its death, over its whole track.
+
+        A track (the cells of a well sharing a 'track_id', see track_cells) is a target if most of its cells are
+        of target_type. A target is in contact in a frame if an effector of the same well and frame is within
+        contact_distance; the distance is read from an 'E-T_distance' column if the cells carry one (the nearest
+        effector, see detect_killing_events), otherwise computed as in proximity. A target dies at the first frame
+        of min_death_frames consecutive observations with death_column set, and is killed if it was in contact
+        at or before that frame.
+
+        Parameters:
+        contact_distance (float): The maximum effector-target distance of a contact (in pixels).
+        effector_type (str): The 'cell_type' value of effector cells.
+        target_type (str): The 'cell_type' value of target cells.
+        track_column (str): The column with the track of every cell.
+        death_column (str): The column flagging dead cells (classify_cell_types 'death').
+        min_death_frames (int): The number of consecutive dead observations that make a death.
+        frame_interval (float): The time between two frames, the unit of 'contact_duration' and 'time_to_kill'.
+
+        Returns:
+        pd.DataFrame: One row per target track with 'field', 'well', 'track_id', 'first_frame', 'last_frame',
+                      'n_frames', 'first_contact_frame', 'E_cell_ID' (the nearest effector at the first contact),
+                      'contact_duration' (time in contact up to the death), 'death_frame', 'killed' and
+                      'time_to_kill' (from the first contact to the death). Frames without a contact or death are
+                      missing values.
+
+        Example (well 1: effector 9 at the origin, target 1 comes into contact at frame 1 and is dead from frame 2
+        on, target 2 stays away and dies at frame 2, target 3 touches the effector and is dead in frame 1 only;
+        well 2: target 1 dies at frame 3 without any effector in the well):
+        >>> rows = [(1, 9, 'E', f, 0, 0, 0) for f in range(4)]
+        >>> rows += [(1, 1, 'T', f, x, 0, d) for f, x, d in zip(range(4), [50, 5, 5, 5], [0, 0, 1, 1])]
+        >>> rows += [(1, 2, 'T', f, 0, 80, d) for f, d in zip(range(4), [0, 0, 1, 1])]
+        >>> rows += [(1, 3, 'T', f, -5, 0, d) for f, d in zip(range(4), [0, 1, 0, 0])]
+        >>> rows += [(2, 1, 'T', f, 0, 0, d) for f, d in zip(range(4), [0, 0, 0, 1])]
+        >>> df = pd.DataFrame(rows, columns=['well', 'track_id', 'cell_type', 'frame', 'X', 'Y', 'death'])
+        >>> store = WellTimeSeriesStore.from_dataframe(df.assign(field='f00', cell=df['track_id']))
+        >>> columns = ['well', 'track_id', 'first_contact_frame', 'E_cell_ID', 'contact_duration', 'death_frame',
+        ...            'killed', 'time_to_kill']
+        >>> print(store.killing_events(10, min_death_frames=2)[columns].to_string(index=False))
+         well  track_id  first_contact_frame E_cell_ID  contact_duration  death_frame  killed  time_to_kill
+            1         1                  1.0         9                 2          2.0    True           1.0
+            1         2                  NaN       NaN                 0          2.0   False           NaN
+            1         3                  0.0         9                 4          NaN   False           NaN
+            2         1                  NaN       NaN                 0          NaN   False           NaN
+
+        A single dead frame is a death when min_death_frames is 1, so target 3 is then killed at frame 1:
+        >>> print(store.killing_events(10)[columns].to_string(index=False))
+         well  track_id  first_contact_frame E_cell_ID  contact_duration  death_frame  killed  time_to_kill
+            1         1                  1.0         9                 2          2.0    True           1.0
+            1         2                  NaN       NaN                 0          2.0   False           NaN
+            1         3                  0.0         9                 2          1.0    True           1.0
+            2         1                  NaN       NaN                 0          3.0   False           NaN
+        """
+        cell_type = np.asarray(self.columns['cell_type'])
+        well_idx, frame_idx = np.divmod(self.row_slot, self.n_frames)
+        track_codes, track_keys = pd.MultiIndex.from_arrays(
+            [well_idx, np.asarray(self.columns[track_column])]).factorize(sort=True)
+        is_target = np.bincount(track_codes, weights=cell_type == target_type, minlength=len(track_keys)) * 2 > \
+            np.bincount(track_codes, minlength=len(track_keys))
+        rows = np.nonzero(is_target[track_codes])[0]
+
+        # Nearest effector of every target cell in its frame
+        nearest = np.full(len(rows), np.inf)
+        nearest_cell = np.full(len(rows), np.nan, dtype=object)
+        if 'E-T_distance' in self.columns:
+            distance = np.asarray(self.columns['E-T_distance'], dtype=float)[rows]
+            nearest = np.where(np.isnan(distance), np.inf, distance)
+            if 'E_cell_ID' in self.columns:
+                nearest_cell = np.asarray(self.columns['E_cell_ID'], dtype=object)[rows]
+        else:
+            e_rows = np.nonzero(cell_type == effector_type)[0]
+            e_idx, t_idx = self._slot_pairs(e_rows, rows)
+            x = np.asarray(self.columns['X'], dtype=float)
+            y = np.asarray(self.columns['Y'], dtype=float)
+            distance = np.hypot(x[e_rows][e_idx] - x[rows][t_idx], y[e_rows][e_idx] - y[rows][t_idx])
+            # The closest pair of every target comes first once sorted by target, then distance
+            order = np.lexsort((distance, t_idx))
+            first = order[np.r_[True, t_idx[order][1:] != t_idx[order][:-1]]] if len(order) else order
+            nearest[t_idx[first]] = distance[first]
+            nearest_cell[t_idx[first]] = np.asarray(self.columns['cell'], dtype=object)[e_rows][e_idx[first]]
+
+        # Every target track as a contiguous run of rows sorted by frame
+        order = np.lexsort((frame_idx[rows], track_codes[rows]))
+        rows, nearest, nearest_cell = rows[order], nearest[order], nearest_cell[order]
+        codes = track_codes[rows]
+        frames = self.frames[frame_idx[rows]].astype(float)
+        contact = nearest <= contact_distance
+        dead = np.asarray(self.columns[death_column], dtype=float)[rows] > 0
+        n_rows = len(rows)
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if n_rows else np.zeros(0, dtype=np.int64)
+        lengths = np.diff(np.r_[starts, n_rows])
+        run_of = np.repeat(np.arange(len(starts)), lengths)
+
+        # A death starts at a row followed by min_death_frames - 1 dead rows of the same track
+        dead_sum = np.r_[0, np.cumsum(dead)]
+        end = np.arange(n_rows) + min_death_frames
+        in_track = end <= np.repeat(starts + lengths, lengths)
+        death_start = in_track & (dead_sum[np.minimum(end, n_rows)] - dead_sum[:n_rows] == min_death_frames)
+
+        def first_frame_where(mask):
+            if not n_rows:
+                return np.zeros(0)
+            return np.minimum.reduceat(np.where(mask, frames, np.inf), starts)
+
+        first_contact = first_frame_where(contact)
+        death_frame = first_frame_where(death_start)
+        before_death = contact & (frames <= death_frame[run_of])
+        contact_frames = np.add.reduceat(before_death, starts) if n_rows else np.zeros(0)
+        first_contact_row = np.flatnonzero(contact & (frames == first_contact[run_of]))
+        contact_cell = np.full(len(starts), np.nan, dtype=object)
+        contact_cell[run_of[first_contact_row]] = nearest_cell[first_contact_row]
+
+        killed = np.isfinite(death_frame) & (first_contact <= death_frame)
+        time_to_kill = np.full(len(starts), np.nan)
+        time_to_kill[killed] = (death_frame[killed] - first_contact[killed]) * frame_interval
+        well = well_idx[rows[starts]]
+        return pd.DataFrame({
+            'field': self.fields[well], 'well': self.wells[well], 'track_id': track_keys.get_level_values(1)[codes[starts]],
+            'first_frame': frames[starts], 'last_frame': frames[starts + lengths - 1] if n_rows else np.zeros(0),
+            'n_frames': lengths, 'first_contact_frame': np.where(np.isfinite(first_contact), first_contact, np.nan),
+            'E_cell_ID': contact_cell, 'contact_duration': contact_frames * frame_interval,
+            'death_frame': np.where(np.isfinite(death_frame), death_frame, np.nan), 'killed': killed,
+            'time_to_kill': time_to_kill})
@@ -1,9 +1,12 @@
 # util.py
 
 import os
+import shutil
 #import imagej
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
+from ATTIICCpackage.instrumentation import logger, timed, count
 
 ###########
 def create_directories(root_dir, sub_dirs):
@@ -73,6 +76,7 @@ def run_imagej_macro(macro_path, input_dir, output_dir, roi_dir):
 
 ############# Load CSV Files and data transformation ##############
 
+@timed('load_csv_files_from_subfolders')
 def load_csv_files_from_subfolders(folder_path, subfolder_suffix, output_csv_path=None):
     """
     This function loads CSV files from subfolders ending in the specified suffix ('d0', 'd1', 'd2'), 
@@ -122,7 +126,8 @@ def load_csv_files_from_subfolders(folder_path, subfolder_suffix, output_csv_pat
                     
                     # Append the dataframe to the list
                     dataframes.append(df)
-                    print(f'Loaded: {file_path} with field: {field_name}')
+                    logger.debug("Loaded: %s with field: %s", file_path, field_name)
+                    count()
     
     # Concatenate all dataframes into a single dataframe
     df_combined = pd.concat(dataframes, ignore_index=True)
@@ -139,33 +144,286 @@ def load_csv_files_from_subfolders(folder_path, subfolder_suffix, output_csv_pat
     return df_combined
 
 
+############# Single-pass parallel loader for all channels ##############
+
+# Column names of the ImageJ measurement CSVs, in the order the measure macro writes them
+MEASUREMENT_COLUMNS = ['cell', 'label', 'area', 'mean_intensity', 'X', 'Y', 'circ.', 'ar', 'round', 'solidity']
+
+# The label is '<frame>_<..>_<..>_<..>_<well>..:<..>_<cell_ID>', split on '_' and ':': frame is the first token
+# without its one-letter prefix (e.g. 'p12'), well the fifth token and cell_ID the last one, which is the well
+# token itself in a 5-token label (same positions as the str.split version above)
+LABEL_PATTERN = r'^[^_:](?P<frame>\d+)[_:](?:[^_:]*[_:]){3}(?P<well>\d+)(?:[_:](?:.*[_:])?(?P<cell_ID>[^_:]*))?$'
+
+def index_channel_csv_files(folder_path, channels=('d0', 'd1', 'd2')):
+    """
+    Walk the folder tree once and group the measurement CSV files by field and channel.
+
+    Parameters:
+    folder_path (str): The root folder path containing subfolders that end with a channel suffix (e.g. 'f00d0').
+    channels (tuple): The channel suffixes to collect.
+
+    Returns:
+    dict: {field: {channel: [csv paths]}}, with the paths of each channel sorted.
+    """
+    index = {}
+    for root, dirs, files in os.walk(folder_path):
+        folder_name = os.path.basename(root)
+        for channel in channels:
+            if folder_name.endswith(channel):
+                field_name = folder_name[:-len(channel)]
+                csv_paths = [os.path.join(root, f) for f in files if f.endswith('.csv')]
+                index.setdefault(field_name, {}).setdefault(channel, []).extend(sorted(csv_paths))
+                break
+    return index
+
+
+def _read_csv(file_path):
+    # Nothing but the parsing runs in the reader threads: the C parser releases the GIL, pandas post-processing
+    # does not. The measure macro always writes the same columns, so the header is replaced while parsing.
+    return pd.read_csv(file_path, engine='c', header=0, names=MEASUREMENT_COLUMNS)
+
+
+def _measurement_table(df, field_names, channel, file_paths):
+    """
+    Rename the intensity column and extract frame, well and cell_ID from 'label' for a whole channel at once.
+    field_names and file_paths are either one value or one value per row; file_paths is only used to report
+    labels that do not follow LABEL_PATTERN.
+    """
+    intensity_column = f'mean_intensity_{channel}'
+    df = df.rename(columns={'mean_intensity': intensity_column})
+
+    # One vectorized regex pass instead of split(expand=True) plus a per-row lambda for the frame
+    labels = df['label'].astype(str)
+    label_parts = labels.str.extract(LABEL_PATTERN)
+    bad = label_parts['well'].isna().to_numpy()
+    if bad.any():
+        row = int(np.flatnonzero(bad)[0])
+        file_path = file_paths if isinstance(file_paths, str) else file_paths[row]
+        raise ValueError(f"{int(bad.sum())} labels of channel {channel} do not match the expected "
+                         f"'<frame>_.._.._.._<well>.._<cell_ID>' format, e.g. {labels.iloc[row]!r} in {file_path}")
+    df['frame'] = label_parts['frame'].astype(int)
+    df['well'] = label_parts['well'].astype(int)
+    df['cell_ID'] = label_parts['cell_ID'].fillna(label_parts['well'])
+    df['field'] = field_names
+
+    return df[['field', 'frame', 'well', 'cell', 'X', 'Y', 'area', intensity_column, 'circ.', 'ar', 'round', 'solidity', 'cell_ID', 'label']]
+
+
+def read_measurement_csv(file_path, field_name, channel):
+    """
+    Read one ImageJ measurement CSV and extract frame, well and cell_ID from its 'label' column.
+
+    Parameters:
+    file_path (str): Path of the CSV file.
+    field_name (str): The field the file belongs to (e.g. 'f00').
+    channel (str): The channel suffix of the file (e.g. 'd0').
+
+    Returns:
+    pd.DataFrame: The measurements with 'field', 'frame' (int), 'well' (int) and 'cell_ID' columns added.
+    """
+    return _measurement_table(_read_csv(file_path), field_name, channel, file_path)
+
+
+@timed('load_indexed_channels')
+def load_indexed_channels(index, channels=('d0', 'd1', 'd2'), max_workers=None):
+    """
+    Read the measurement CSVs listed in an index built by index_channel_csv_files in a thread pool and join
+    the channels into one wide per-cell table.
+
+    Parameters:
+    index (dict): {field: {channel: [csv paths]}}, possibly restricted to some fields.
+    channels (tuple): The channel suffixes to load; the last one provides 'label' and the geometry columns.
+    max_workers (int or None): Number of reader threads. If None, ThreadPoolExecutor picks the default.
+
+    Returns:
+    pd.DataFrame: One row per cell, sorted by 'field', 'well', 'frame' and 'cell'.
+    """
+    jobs = {channel: [(field, path) for field, by_channel in sorted(index.items()) for path in by_channel.get(channel, [])]
+            for channel in channels}
+    n_files = sum(len(channel_jobs) for channel_jobs in jobs.values())
+    if not n_files:
+        raise FileNotFoundError(f"No measurement CSV files for channels {channels} in fields {sorted(index)}")
+
+    channel_frames = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for channel in channels:
+            if not jobs[channel]:
+                raise FileNotFoundError(f"No measurement CSV files for channel {channel} in fields {sorted(index)}")
+            fields, paths = zip(*jobs[channel])
+            parts = list(executor.map(_read_csv, paths))
+
+            # Per-file work is done once per channel on the concatenated table
+            lengths = [len(df) for df in parts]
+            field_names = np.repeat(np.array(fields, dtype=object), lengths)
+            file_paths = np.repeat(np.array(paths, dtype=object), lengths)
+            channel_frames[channel] = _measurement_table(pd.concat(parts, ignore_index=True), field_names, channel,
+                                                         file_paths)
+    print(f"Loaded {n_files} CSV files from {len(index)} fields")
+    count(n_files)
+
+    return join_channel_dataframes(channel_frames, channels)
+
+
+def load_all_channels_from_subfolders(folder_path, channels=('d0', 'd1', 'd2'), fields=None, max_workers=None, output_csv_path=None):
+    """
+    Load the measurement CSVs of all channels in a single walk of the folder tree and return one wide
+    per-cell table, equivalent to calling load_csv_files_from_subfolders once per channel followed by
+    merge_and_clean_dataframes. Files are read concurrently in a thread pool.
+
+    Parameters:
+    folder_path (str): The root folder path containing the 'fNNd0', 'fNNd1', ... subfolders.
+    channels (tuple): The channel suffixes to load; the last one provides 'label' and the geometry columns.
+    fields (list or None): Only load these fields (e.g. ['f00', 'f01']). If None, all fields are loaded.
+    max_workers (int or None): Number of reader threads. If None, ThreadPoolExecutor picks the default.
+    output_csv_path (str or None): The path to save the resulting dataframe as a CSV file. If None, no file is saved.
+
+    Returns:
+    pd.DataFrame: One row per cell, sorted by 'field', 'well', 'frame' and 'cell', with one
+                  'mean_intensity_<channel>' column per channel.
+    """
+    index = index_channel_csv_files(folder_path, channels)
+    if fields is not None:
+        index = {field: index[field] for field in fields if field in index}
+
+    df_wide = load_indexed_channels(index, channels, max_workers)
+
+    # Save the resulting dataframe as a CSV file if a path is provided
+    if output_csv_path:
+        df_wide.to_csv(output_csv_path, index=False)
+        print(f"Saved dataframe to {output_csv_path}")
+
+    return df_wide
+
+
+
+def concatenate_csv_files(csv_paths, output_csv_path):
+    """
+    Concatenate CSV files with the same columns into one file, streaming them so they are never all in memory.
+
+    Parameters:
+    csv_paths (list): The CSV files, in output order. Only the header of the first one is kept.
+    output_csv_path (str): The path of the combined CSV file.
+    """
+    with open(output_csv_path, 'w') as output_file:
+        for i, csv_path in enumerate(csv_paths):
+            with open(csv_path) as input_file:
+                header = input_file.readline()
+                if i == 0:
+                    output_file.write(header)
+                shutil.copyfileobj(input_file, output_file)
+
 
 ################### Merge Dataframes ############################
+
+# Key that identifies one cell in one frame of one well; it is shared by all channel tables
+CHANNEL_KEY = ['field', 'well', 'frame', 'cell']
+
+# Geometry columns come from the shared d3 ROIs, so they are identical in every channel
+GEOMETRY_COLUMNS = ['X', 'Y', 'area', 'circ.', 'ar', 'round', 'solidity']
+
+
+def _sorted_channel(df, columns):
+    # Sort only the columns we need, so each channel is copied at most once
+    return df[CHANNEL_KEY + columns].sort_values(by=CHANNEL_KEY, kind='stable', ignore_index=True)
+
+
+def _keys_equal(df_a, df_b):
+    if len(df_a) != len(df_b):
+        return False
+    return all(np.array_equal(df_a[col].to_numpy(), df_b[col].to_numpy()) for col in CHANNEL_KEY)
+
+
+def join_channel_dataframes(channel_frames, channels=('d0', 'd1', 'd2')):
+    """
+    Joins the per-channel measurement tables on 'field', 'well', 'frame' and 'cell'.
+    Every table is sorted once on that key and the intensity columns are aligned by position; the geometry
+    columns, 'label' and 'cell_ID' are carried only once, from the last channel. Keys that are not present in
+    every channel are dropped (as an inner merge would) and reported.
+
+    Parameters:
+    channel_frames (dict): {channel: pd.DataFrame} as returned by load_csv_files_from_subfolders for each channel.
+    channels (tuple): The channel suffixes to join, in output order.
+
+    Returns:
+    pd.DataFrame: The joined dataframe, sorted by 'field', 'well', 'frame' and 'cell'.
+
+    Examples (check with python -m doctest ATTIICCpackage/util.py):
+    >>> def channel(c, cells, intensity):
+    ...     return pd.DataFrame({'field': 'f00', 'well': 1, 'frame': 0, 'cell': cells, 'X': [10.0 * k for k in cells],
+    ...                          'Y': 0.0, f'mean_intensity_{c}': intensity, 'area': 5, 'circ.': 1.0, 'ar': 1.0,
+    ...                          'round': 1.0, 'solidity': 1.0, 'label': [f'{c}:{k}' for k in cells], 'cell_ID': cells})
+
+    Channels in a different row order are aligned on the key, geometry and 'label' come from the last channel:
+    >>> frames = {'d0': channel('d0', [2, 1], [20, 10]), 'd1': channel('d1', [1, 2], [11, 21]),
+    ...           'd2': channel('d2', [1, 2], [12, 22])}
+    >>> joined = join_channel_dataframes(frames)
+    >>> joined[['cell', 'X', 'mean_intensity_d0', 'mean_intensity_d1', 'mean_intensity_d2']].values.tolist()
+    [[1.0, 10.0, 10.0, 11.0, 12.0], [2.0, 20.0, 20.0, 21.0, 22.0]]
+    >>> joined[['label_d0', 'label_d1', 'label']].values.tolist()
+    [['d0:1', 'd1:1', 'd2:1'], ['d0:2', 'd1:2', 'd2:2']]
+
+    A cell missing from one channel is dropped from all of them and reported:
+    >>> frames['d1'] = channel('d1', [1], [11])
+    >>> join_channel_dataframes(frames)[['cell', 'mean_intensity_d0', 'mean_intensity_d1']].values.tolist()
+    Dropped 1 rows of channel d2 without a match in every channel, e.g. [{'field': 'f00', 'well': 1, 'frame': 0, 'cell': 2}]
+    Dropped 1 rows of channel d0 without a match in every channel, e.g. [{'field': 'f00', 'well': 1, 'frame': 0, 'cell': 2}]
+    [[1, 10, 11]]
+
+    Duplicated keys cannot be aligned by position:
+    >>> frames['d1'] = channel('d1', [1, 1], [11, 11])
+    >>> join_channel_dataframes(frames)
+    Traceback (most recent call last):
+    ...
+    ValueError: Channel tables contain duplicated (field, well, frame, cell) keys and cannot be aligned
+    """
+    channels = list(channels)
+    last = channels[-1]
+
+    # The last channel is the base table; the others only contribute their intensity and label
+    base = _sorted_channel(channel_frames[last], [f'mean_intensity_{last}'] + GEOMETRY_COLUMNS + ['label', 'cell_ID'])
+    others = {c: _sorted_channel(channel_frames[c], [f'mean_intensity_{c}', 'label']) for c in channels[:-1]}
+
+    if not all(_keys_equal(base, df) for df in others.values()):
+        # Restrict every table to the keys present in all channels and report what was dropped
+        key_indexes = {c: pd.MultiIndex.from_frame(df[CHANNEL_KEY]) for c, df in [(last, base)] + list(others.items())}
+        common = None
+        for index in key_indexes.values():
+            common = index if common is None else common.intersection(index)
+        for channel, index in key_indexes.items():
+            keep = index.isin(common)
+            n_dropped = int((~keep).sum())
+            if n_dropped:
+                dropped = index[~keep].to_frame(index=False)
+                print(f"Dropped {n_dropped} rows of channel {channel} without a match in every channel, "
+                      f"e.g. {dropped.head(3).to_dict('records')}")
+            if channel == last:
+                base = base[keep].reset_index(drop=True)
+            else:
+                others[channel] = others[channel][keep].reset_index(drop=True)
+        if not all(_keys_equal(base, df) for df in others.values()):
+            raise ValueError("Channel tables contain duplicated (field, well, frame, cell) keys and cannot be aligned")
+
+    for channel, df in others.items():
+        base[f'mean_intensity_{channel}'] = df[f'mean_intensity_{channel}'].to_numpy()
+        base[f'label_{channel}'] = df['label'].to_numpy()
+
+    return base[CHANNEL_KEY + ['X', 'Y'] + [f'mean_intensity_{c}' for c in channels] +
+                ['area', 'circ.', 'ar', 'round', 'solidity'] +
+                [f'label_{c}' for c in channels[:-1]] + ['label', 'cell_ID']]
+
+
 def merge_dataframes(df0_path, df1_path, df2_path, output_csv):
     # Load the dataframes
     df0 = pd.read_csv(df0_path)
     df1 = pd.read_csv(df1_path)
     df2 = pd.read_csv(df2_path)
-    
-    # Merge the dataframes by 'field', 'well', 'frame', and 'cell', adding suffixes for overlapping columns
-    df_merged = pd.merge(df0, df1, on=['field', 'well', 'frame', 'cell'], suffixes=('_d0', '_d1'))
-    df_merged = pd.merge(df_merged, df2, on=['field', 'well', 'frame', 'cell'], suffixes=('', '_d2'))
-    
-    # Remove duplicate columns (columns that have the same values across the dataframes)
-    for col in df0.columns:
-        if col in df1.columns and col in df2.columns and df0[col].equals(df1[col]) and df0[col].equals(df2[col]):
-            # Drop the redundant columns from the merged dataframe
-            df_merged.drop([f'{col}_d0', f'{col}_d1'], axis=1, inplace=True, errors='ignore')
-    
-    # Select the desired columns for the final merged dataframe
-    df_merged = df_merged[['field', 'well', 'frame', 'cell', 'X', 'Y', 'mean_intensity_d0', 
-                           'mean_intensity_d1', 'mean_intensity_d2', 'area', 'circ.', 
-                           'ar', 'round', 'solidity', 'label_d0', 'label_d1', 'label', 
-                           'cell_ID']]
-    
+
+    # Join the dataframes by 'field', 'well', 'frame', and 'cell'
+    df_merged = join_channel_dataframes({'d0': df0, 'd1': df1, 'd2': df2})
+
     # Save the final merged dataframe to a CSV file
     df_merged.to_csv(output_csv, index=False)
-    
+
     # Return the merged dataframe if needed
     return df_merged
 
@@ -173,7 +431,7 @@ def merge_dataframes(df0_path, df1_path, df2_path, output_csv):
 def merge_and_clean_dataframes(df0, df1, df2, output_csv_path):
     """
     Merges three dataframes on the columns 'field', 'well', 'frame', and 'cell', 
-    removes duplicate columns, and saves the final merged dataframe to a CSV file.
+    keeps the shared columns once, and saves the final merged dataframe to a CSV file.
     
     Parameters:
     df0 (pd.DataFrame): The first dataframe.
@@ -182,22 +440,11 @@ def merge_and_clean_dataframes(df0, df1, df2, output_csv_path):
     output_csv_path (str): The path where the merged dataframe will be saved.
     
     Returns:
-    pd.DataFrame: The final merged dataframe.
+    pd.DataFrame: The final merged dataframe, sorted by 'field', 'well', 'frame', and 'cell'.
     """
     
-    # Merge the dataframes by 'field', 'well', 'frame', and 'cell', adding suffixes for overlapping columns
-    df_merged = pd.merge(df0, df1, on=['field', 'well', 'frame', 'cell'], suffixes=('_d0', '_d1'))
-    df_merged = pd.merge(df_merged, df2, on=['field', 'well', 'frame', 'cell'], suffixes=('', '_d2'))
-
-    # Remove duplicate columns (columns that have the same values across the dataframes)
-    for col in df0.columns:
-        if col in df1.columns and col in df2.columns and df0[col].equals(df1[col]) and df0[col].equals(df2[col]):
-            # Drop the redundant columns from the merged dataframe
-            df_merged.drop([f'{col}_d0', f'{col}_d1'], axis=1, inplace=True, errors='ignore')
-    
-    # Select the desired columns
-    df_merged = df_merged[['field', 'well', 'frame', 'cell', 'X', 'Y', 'mean_intensity_d0', 'mean_intensity_d1', 'mean_intensity_d2',
-                           'area', 'circ.', 'ar', 'round', 'solidity', 'label_d0', 'label_d1', 'label', 'cell_ID']]
+    # Join the dataframes by 'field', 'well', 'frame', and 'cell'
+    df_merged = join_channel_dataframes({'d0': df0, 'd1': df1, 'd2': df2})
     
     # Save the final merged dataframe to a CSV file
     df_merged.to_csv(output_csv_path, index=False)
@@ -0,0 +1,76 @@
+# bench_import_time.py
+#
+# Import-time benchmark for the package. Every run imports ATTIICCpackage in a fresh interpreter,
+# reports the median import time and fails if the import got slower than the budget or pulled in
+# one of the heavy dependencies that should only load on first use.
+#
+# Usage: python benchmarks/bench_import_time.py [--runs 5] [--max-seconds 2.0]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules an analysis-only import must not load
+HEAVY_MODULES = ['cellpose', 'torch', 'matplotlib', 'cv2', 'skimage', 'scipy']
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import ATTIICCpackage
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'modules': sorted(sys.modules)}))
+"""
+
+
+def measure_import(runs):
+    """
+    Import the package in `runs` fresh interpreters.
+
+    Parameters:
+    runs (int): Number of interpreters to start.
+
+    Returns:
+    list: The import time of every run in seconds.
+    set: The modules loaded by the last run.
+    """
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    times = []
+    modules = set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE], env=env, check=True,
+                                capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        modules = set(result['modules'])
+    return times, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import time of ATTIICCpackage.")
+    parser.add_argument('--runs', type=int, default=5, help="number of fresh interpreters to time")
+    parser.add_argument('--max-seconds', type=float, default=2.0, help="fail if the median import time is above this")
+    args = parser.parse_args()
+
+    times, modules = measure_import(args.runs)
+    median = statistics.median(times)
+    print(f"import ATTIICCpackage: median {median:.3f}s, min {min(times):.3f}s, max {max(times):.3f}s over {args.runs} runs")
+
+    failed = False
+    loaded_heavy = [m for m in HEAVY_MODULES if m in modules]
+    if loaded_heavy:
+        print(f"FAIL: importing the package loaded heavy modules: {', '.join(loaded_heavy)}")
+        failed = True
+    if median > args.max_seconds:
+        print(f"FAIL: median import time {median:.3f}s is above the budget of {args.max_seconds:.3f}s")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
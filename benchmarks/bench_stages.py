@@ -0,0 +1,330 @@
+# bench_stages.py
+#
+# Time and memory benchmark of the public data-processing functions of the package on synthetic plates of
+# increasing size: loading and joining, classification and analysis, tracking and killing events, the
+# partitioned analysis, measurement, background subtraction, microwell detection and cropping, and QC montages.
+# Not benchmarked: the Cellpose segmentation (it needs a trained model, and usually a GPU), the orchestration
+# layers that only call the functions above (pipeline, sharding, live), the checkpoint helpers and the
+# single-image helpers (read_image, gaussian_smoothing, ...), which are timed through the stages using them.
+#
+# Every run appends its results to a JSON-lines file, so runs on different commits can be compared; with
+# --compare the run fails if a function got slower (or used more memory) than the previous run by more than
+# the tolerance.
+#
+# Usage: python benchmarks/bench_stages.py [--scales small medium] [--functions calculate_proximity ...]
+#                                          [--repeat 3] [--results benchmarks/results/bench_stages.jsonl]
+#                                          [--compare] [--tolerance 1.25]
+
+import argparse
+import functools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from ATTIICCpackage.synthetic import generate_plate
+
+# Plate sizes the functions are benchmarked at
+SCALES = {
+    'small': {'n_fields': 1, 'n_frames': 4, 'n_wells': 16, 'cells_per_well': 3},
+    'medium': {'n_fields': 2, 'n_frames': 8, 'n_wells': 64, 'cells_per_well': 4},
+    'large': {'n_fields': 4, 'n_frames': 12, 'n_wells': 144, 'cells_per_well': 5},
+}
+
+THRESHOLDS = {'thresholds_d0': 10000, 'thresholds_d1': 8000, 'thresholds_d2': 12000,
+              'area_threshold_d0': 200, 'area_threshold_d1': 200}
+
+# Effector-target distance of a contact for the killing events (the synthetic cells have a radius of 4-7 pixels)
+CONTACT_DISTANCE = 20
+
+DEFAULT_RESULTS = os.path.join(REPO_ROOT, 'benchmarks', 'results', 'bench_stages.jsonl')
+
+
+########### Cases ############
+def build_cases(plate_dir, scratch_dir):
+    """
+    Build the benchmark cases for a generated plate.
+
+    Every case is (name, setup, func): setup() returns the arguments of one call, so functions that modify their
+    input get a fresh copy every time, and the setup is not timed.
+
+    Parameters:
+    plate_dir (str): The plate written by generate_plate.
+    scratch_dir (str): A folder for the outputs of the functions.
+
+    Returns:
+    list: The cases.
+    """
+    import ATTIICCpackage as pkg
+
+    measurements = os.path.join(plate_dir, 'measurements')
+    out = lambda name: os.path.join(scratch_dir, name)
+
+    # Inputs are computed once; every setup hands out copies
+    channel_frames = {c: pkg.load_csv_files_from_subfolders(measurements, c) for c in ('d0', 'd1', 'd2')}
+    merged = pkg.merge_and_clean_dataframes(channel_frames['d0'], channel_frames['d1'], channel_frames['d2'], out('merged.csv'))
+    classified = pkg.classify_cell_types(merged.copy(), THRESHOLDS['thresholds_d0'], THRESHOLDS['thresholds_d1'],
+                                         THRESHOLDS['thresholds_d2'])
+    corrected = pkg.correct_cell_types(classified.copy(), THRESHOLDS['area_threshold_d0'],
+                                       THRESHOLDS['area_threshold_d1'], out('corrected.csv'))
+    processed = pkg.process_classified_data(corrected.copy(), out('processed.csv'))
+    counted = pkg.process_and_save_cell_count(processed.copy(), out('counted.csv'))
+    tracked = pkg.track_cells(processed.copy())
+    frames = sorted(counted['frame'].unique())
+    filled = pkg.fill_missing_frames(counted.copy(), frames)
+    try:
+        trends = pkg.add_trends_to_dataframe(filled.copy(), frames)
+    except Exception as e:
+        # Reported as the failure of add_trends_to_dataframe and add_event_column instead of stopping the run
+        trends = e
+
+    def trends_copy():
+        if isinstance(trends, Exception):
+            raise trends
+        return (trends.copy(),)
+
+    # object_matching is quadratic in the cells it is given, so it gets the frames of the first well only
+    first = counted[(counted['field'] == counted['field'].iloc[0]) & (counted['well'] == counted['well'].iloc[0])]
+    well_frames = [df[['X', 'Y']].reset_index(drop=True) for _, df in first.groupby('frame')]
+
+    labels_dir = os.path.join(plate_dir, 'labels')
+    labels_path = os.path.join(labels_dir, 'f00d3_png', 'p00_0_f00d3_label.png')
+    images_dir = os.path.join(plate_dir, 'images')
+
+    def frame_images():
+        import cv2
+        labels = cv2.imread(labels_path, cv2.IMREAD_UNCHANGED)
+        images = {c: cv2.imread(os.path.join(images_dir, f'f00{c}', f'p00_0_f00{c}.png'), cv2.IMREAD_UNCHANGED)
+                  for c in ('d0', 'd1', 'd2')}
+        return (labels, images)
+
+    # Microwells, measurement and QC montages work on the images of the first field
+    index = pkg.index_channel_csv_files(measurements)
+    grid = pkg.detect_field_wells('f00', images_dir)
+    background_dir = out('background')
+    pkg.process_images_bg(images_dir, background_dir, 5, 5, 5)
+
+    def segmented_images():
+        import cv2
+        folder = os.path.join(labels_dir, 'f00d3_png')
+        items = []
+        for file_name in sorted(os.listdir(folder)):
+            image_name = file_name.replace('_label', '')
+            image = cv2.imread(os.path.join(images_dir, 'f00d3_png', image_name), cv2.IMREAD_UNCHANGED)
+            items.append((image, cv2.imread(os.path.join(folder, file_name), cv2.IMREAD_UNCHANGED), image_name))
+        return items
+
+    montage_images = segmented_images()
+    montage = pkg.compose_montage(montage_images)
+
+    run_index = iter(range(1 << 30))
+
+    return [
+        ('load_csv_files_from_subfolders', lambda: (measurements, 'd0'), pkg.load_csv_files_from_subfolders),
+        ('load_all_channels_from_subfolders', lambda: (measurements,), pkg.load_all_channels_from_subfolders),
+        ('merge_and_clean_dataframes', lambda: tuple(df.copy() for df in channel_frames.values()) + (out('merged.csv'),),
+         pkg.merge_and_clean_dataframes),
+        ('classify_cell_types', lambda: (merged.copy(), THRESHOLDS['thresholds_d0'], THRESHOLDS['thresholds_d1'],
+                                         THRESHOLDS['thresholds_d2']), pkg.classify_cell_types),
+        ('correct_cell_types', lambda: (classified.copy(), THRESHOLDS['area_threshold_d0'],
+                                        THRESHOLDS['area_threshold_d1'], out('corrected.csv')), pkg.correct_cell_types),
+        ('process_classified_data', lambda: (corrected.copy(), out('processed.csv')), pkg.process_classified_data),
+        ('process_and_save_cell_count', lambda: (processed.copy(), out('counted.csv')), pkg.process_and_save_cell_count),
+        ('fill_missing_frames', lambda: (counted.copy(), frames), pkg.fill_missing_frames),
+        ('add_trends_to_dataframe', lambda: (filled.copy(), frames), pkg.add_trends_to_dataframe),
+        ('add_event_column', trends_copy, pkg.add_event_column),
+        ('calculate_moving_speed_and_mean', lambda: (counted.copy(), out('speed.csv'), out('mean_speed.csv')),
+         pkg.calculate_moving_speed_and_mean),
+        ('calculate_proximity', lambda: (counted.copy(),), pkg.calculate_proximity),
+        ('WellTimeSeriesStore.from_dataframe', lambda: (counted,), pkg.WellTimeSeriesStore.from_dataframe),
+        ('object_matching', lambda: ([df.copy() for df in well_frames],), pkg.object_matching),
+        ('track_cells', lambda: (counted.copy(),), pkg.track_cells),
+        ('measure_cells', frame_images, pkg.measure_cells),
+        # A new output folder every call, so the manifest does not skip the images
+        ('process_images_bg', lambda: (images_dir, out(f'background_{next(run_index)}'), 5, 5, 5), pkg.process_images_bg),
+        ('process_images_bg_rolling_ball', lambda: (images_dir, out(f'rolling_ball_{next(run_index)}'), 5, 5, 5),
+         pkg.process_images_bg_rolling_ball),
+        ('index_channel_csv_files', lambda: (measurements,), pkg.index_channel_csv_files),
+        ('load_indexed_channels', lambda: (index,), pkg.load_indexed_channels),
+        ('join_channel_dataframes', lambda: (channel_frames,), pkg.join_channel_dataframes),
+        ('detect_killing_events', lambda: (tracked.copy(), CONTACT_DISTANCE), pkg.detect_killing_events),
+        ('run_partitioned_analysis', lambda: (measurements, out(f'partitioned_{next(run_index)}')),
+         functools.partial(pkg.run_partitioned_analysis, **THRESHOLDS, contact_distance=CONTACT_DISTANCE)),
+        ('measure_field', lambda: ('f00', background_dir, labels_dir),
+         functools.partial(pkg.measure_field, grid=grid, d3_dir=images_dir)),
+        ('detect_field_wells', lambda: ('f00', images_dir), pkg.detect_field_wells),
+        ('crop_field_wells', lambda: ('f00', images_dir, out(f'crops_{next(run_index)}'), grid),
+         pkg.crop_field_wells),
+        ('compose_montage', lambda: (montage_images,), pkg.compose_montage),
+        ('write_montage', lambda: (montage, out('montage.png')), pkg.write_montage),
+    ]
+
+
+########### Measurement ############
+def run_case(setup, func, repeat):
+    """
+    Time a function over `repeat` calls, then measure the peak of the memory it allocates in one more call.
+
+    Returns:
+    dict: 'seconds' (all calls), 'seconds_median', 'seconds_min' and 'peak_mb' (tracemalloc peak).
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            args = setup()
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                start = time.perf_counter()
+                func(*args)
+                times.append(time.perf_counter() - start)
+            finally:
+                sys.stdout = stdout
+
+        # Memory is measured in a separate call, since tracing slows the function down
+        args = setup()
+        stdout, sys.stdout = sys.stdout, devnull
+        tracemalloc.start()
+        try:
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            sys.stdout = stdout
+    return {'seconds': times, 'seconds_median': statistics.median(times), 'seconds_min': min(times),
+            'peak_mb': peak / 2 ** 20}
+
+
+def git_commit():
+    """Return the current commit of the repository, or None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+########### Results ############
+def load_results(path):
+    """Read the stored results; a line cut short by an interrupted run is ignored."""
+    results = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    results.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return results
+
+
+def compare(current, previous, tolerance):
+    """
+    Compare the results of this run with the latest earlier result of the same scale and function.
+
+    Parameters:
+    current (list): The results of this run.
+    previous (list): The stored results of earlier runs.
+    tolerance (float): The allowed ratio of the new median time (and peak memory) to the old one.
+
+    Returns:
+    list: Descriptions of the regressions.
+    """
+    latest = {}
+    for result in previous:
+        latest[(result['scale'], result['function'])] = result
+
+    regressions = []
+    for result in current:
+        before = latest.get((result['scale'], result['function']))
+        if before is None:
+            continue
+        time_ratio = result['seconds_median'] / max(before['seconds_median'], 1e-9)
+        memory_ratio = result['peak_mb'] / max(before['peak_mb'], 1e-9)
+        flag = ''
+        # Very short calls are dominated by noise; only flag times above a millisecond
+        if time_ratio > tolerance and result['seconds_median'] > 1e-3:
+            flag = ' SLOWER'
+            regressions.append(f"{result['scale']} {result['function']}: {time_ratio:.2f}x time")
+        if memory_ratio > tolerance and result['peak_mb'] > 1:
+            flag += ' MORE MEMORY'
+            regressions.append(f"{result['scale']} {result['function']}: {memory_ratio:.2f}x memory")
+        print(f"  {result['scale']:<7} {result['function']:<36} {time_ratio:6.2f}x time {memory_ratio:6.2f}x memory "
+              f"(vs {before.get('commit')}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the package functions on synthetic plates.")
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=sorted(SCALES),
+                        help="plate sizes to benchmark")
+    parser.add_argument('--functions', nargs='+', help="only benchmark these functions")
+    parser.add_argument('--repeat', type=int, default=3, help="timed calls per function")
+    parser.add_argument('--results', default=DEFAULT_RESULTS, help="JSON-lines file the results are appended to")
+    parser.add_argument('--no-save', action='store_true', help="do not store the results")
+    parser.add_argument('--compare', action='store_true', help="compare with the previous stored results")
+    parser.add_argument('--tolerance', type=float, default=1.25, help="allowed slowdown ratio with --compare")
+    args = parser.parse_args()
+
+    previous = load_results(args.results)
+    run = {'run_id': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(),
+           'python': platform.python_version(), 'machine': platform.machine()}
+
+    current = []
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            plate_dir = os.path.join(temp_dir, 'plate')
+            scratch_dir = os.path.join(temp_dir, 'scratch')
+            os.makedirs(scratch_dir)
+
+            start = time.perf_counter()
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+            try:
+                truth = generate_plate(plate_dir, seed=0, **SCALES[scale])
+                cases = build_cases(plate_dir, scratch_dir)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            print(f"{scale}: {len(truth)} cells over {SCALES[scale]} (generated in {time.perf_counter() - start:.1f}s)")
+
+            for name, setup, func in cases:
+                if args.functions and name not in args.functions:
+                    continue
+                try:
+                    measured = run_case(setup, func, args.repeat)
+                except Exception as e:
+                    print(f"  {name:<36} FAILED: {e!r}")
+                    continue
+                result = {**run, 'scale': scale, 'plate': SCALES[scale], 'n_cells': len(truth), 'function': name,
+                          **measured}
+                current.append(result)
+                print(f"  {name:<36} median {result['seconds_median'] * 1000:10.2f} ms   "
+                      f"peak {result['peak_mb']:8.2f} MB")
+
+    regressions = []
+    if args.compare:
+        print("Compared with the previous results:")
+        regressions = compare(current, previous, args.tolerance)
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+        with open(args.results, 'a') as f:
+            for result in current:
+                f.write(json.dumps(result) + '\n')
+        print(f"Appended {len(current)} results to {args.results}")
+
+    if regressions:
+        print("FAIL: " + "; ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())